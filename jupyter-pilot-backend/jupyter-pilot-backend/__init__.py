@@ -1,22 +1,23 @@
-import asyncio
-import multiprocessing
-import langchain
+import tornado.ioloop
 from notebook.utils import url_path_join
 
+# Only light modules are imported here, langchain is loaded with the first request
 from .websocket_handler import RefactorWebSocketHandler, DebugWebSocketHandler, ExplainWebSocketHandler
-from .terminal.terminal import Terminal
+from .terminal_process import TerminalHandler, terminal_process
+from .metrics import MetricsHandler
+from .loop_monitor import EventLoopStallMonitor
+from .config import TRACEMALLOC, TERMINAL_EAGER
 
-import tracemalloc
-tracemalloc.start()
-
-langchain.debug = True
+if TRACEMALLOC:
+    import tracemalloc
+    tracemalloc.start()
 
 
 def _jupyter_server_extension_paths():
     return [{
         "module": "jupyter-pilot-backend",
     }]
-    
+
 
 def load_jupyter_server_extension(nbapp):
     web_app = nbapp.web_app
@@ -31,8 +32,18 @@ def load_jupyter_server_extension(nbapp):
     explain_route_pattern = url_path_join(web_app.settings['base_url'], '/explain')
     web_app.add_handlers(host_pattern, [(explain_route_pattern, ExplainWebSocketHandler)])
 
+    metrics_route_pattern = url_path_join(web_app.settings['base_url'], '/labpilot/metrics')
+    web_app.add_handlers(host_pattern, [(metrics_route_pattern, MetricsHandler)])
+
+    terminal_route_pattern = url_path_join(web_app.settings['base_url'], '/labpilot/terminal')
+    web_app.add_handlers(host_pattern, [(terminal_route_pattern, TerminalHandler)])
+
+    # Reports how long the server's IOLoop goes without yielding
+    monitor = EventLoopStallMonitor("jupyter")
+    tornado.ioloop.IOLoop.current().add_callback(monitor.start)
+
     kernel_manager = web_app.settings['kernel_manager']
-    
+
     # The list of running kernel IDs
     kernel_ids = list(kernel_manager._kernels.keys())
 
@@ -40,8 +51,7 @@ def load_jupyter_server_extension(nbapp):
         kernel = kernel_manager.get_kernel(kernel_id)
         print("kernel_name:", kernel.kernel_name)
 
-
-    term = Terminal()
-    process = multiprocessing.Process(target=lambda: asyncio.run(term.start()))
-    process.start()
-
+    # The terminal widget starts the backend through /labpilot/terminal when it opens
+    terminal_process.root_dir = nbapp.notebook_dir
+    if TERMINAL_EAGER:
+        terminal_process.start()
@@ -1,44 +1,104 @@
-import json
-from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.schema import LLMResult, AgentAction
 from typing import List, Dict, Any, Union
 
-class DefaultCallbackHandler(BaseCallbackHandler):
-    def __init__(self, writer):
+from .frames import FrameCoalescer
+
+class DefaultCallbackHandler(AsyncCallbackHandler):
+    def __init__(self, writer, compact=False):
+        # writer is a coroutine function taking a serialized frame
         self.writer = writer
+        self.frames = FrameCoalescer(writer, compact=compact)
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        await self.frames.token(token)
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        await self.frames.start()
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        await self.frames.done()
 
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        if token:
-            reply = {
-                "message": token, 
-                "done": False,
-                "start": False
-            }
-            self.writer(json.dumps(reply))
-
-    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
-        reply = {
-            "done": False,
-            "start": True
-        }
-        self.writer(json.dumps(reply))
-
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        reply = {
-            "done": True,
-            "start": False
-        }
-        self.writer(json.dumps(reply))
-    
-    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> Any:
+    async def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> Any:
         """Run when LLM errors."""
         print("error", error)
+        await self.frames.flush()
 
-    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> Any:
-        print(f"on_chain_start {serialized['name']}")
+    async def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> Any:
+        print(f"on_chain_start {serialized.get('name', serialized.get('id'))}")
 
-    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
         print(f"on_tool_start {serialized['name']}")
 
-    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
-        print(f"on_agent_action {action}")
\ No newline at end of file
+    async def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        print(f"on_agent_action {action}")
+
+
+class SectionSplitCallbackHandler(DefaultCallbackHandler):
+    """Streams a reply with two sections separated by a marker line as two completions.
+
+    The client sees start/tokens/done for the text before the marker, then
+    start/tokens/done for the text after it, exactly as if two LLM calls had
+    been made. Text that could be the beginning of the marker, and the
+    whitespace before it, is held back until the next tokens show whether
+    it is, so the first section never ends in the separator's whitespace
+    however the tokens are split. When the marker never comes the whole
+    reply is the first section and the second one says so.
+    """
+
+    missing_second_section = "No separate explanation was given."
+
+    def __init__(self, writer, marker, compact=False):
+        super().__init__(writer, compact=compact)
+        self.marker = marker
+        self.pending = ""
+        self.second_section = False
+        self.sections = ["", ""]
+
+    def _held_back(self, text):
+        # Trailing whitespace belongs to the separator if the marker follows it
+        stripped = text.rstrip()
+        for size in range(min(len(self.marker) - 1, len(stripped)), 0, -1):
+            if self.marker.startswith(stripped[-size:]):
+                return len(text) - len(stripped[:-size].rstrip())
+        return len(text) - len(stripped)
+
+    async def _emit(self, text):
+        if text:
+            self.sections[self.second_section] += text
+            await self.frames.token(text)
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if self.second_section:
+            if not self.sections[1]:
+                token = token.lstrip("\n")
+            await self._emit(token)
+            return
+
+        self.pending += token
+        index = self.pending.find(self.marker)
+        if index >= 0:
+            await self._emit(self.pending[:index].rstrip())
+            rest = self.pending[index + len(self.marker):]
+            self.pending = ""
+            await self.frames.done()
+            await self.frames.start()
+            self.second_section = True
+            await self.on_llm_new_token(rest)
+            return
+
+        held = self._held_back(self.pending)
+        await self._emit(self.pending[:len(self.pending) - held])
+        self.pending = self.pending[len(self.pending) - held:]
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        if not self.second_section:
+            # The marker never came, so everything was the first section
+            print(f"SectionSplitCallbackHandler: no {self.marker} in the reply")
+            await self._emit(self.pending.rstrip())
+            self.pending = ""
+            await self.frames.done()
+            await self.frames.start()
+            self.second_section = True
+            await self._emit(self.missing_second_section)
+        await self.frames.done()
@@ -0,0 +1,85 @@
+import langchain
+from langchain.chains.sequential import SequentialChain
+from langchain.chains import LLMChain
+from langchain.prompts import PromptTemplate
+
+from .prompt import debug_template, debug_explain_template, debug_single_pass_template, explain_template, refactor_template
+from .prompt import debug_examples, debug_explain_examples, debug_single_pass_examples, explain_examples, refactor_examples
+from .prompt_budget import PromptAssembler
+from .config import LANGCHAIN_DEBUG
+
+# langchain takes seconds to import, so the handlers load this module with their first request
+langchain.debug = LANGCHAIN_DEBUG
+
+
+refactor_prompt_template = PromptTemplate(input_variables=["examples", "memory", "code"], template=refactor_template)
+debug_prompt_template = PromptTemplate(input_variables=["examples", "code", "output", "error"], template=debug_template)
+debug_explain_prompt_template = PromptTemplate(input_variables=["explain_examples", "code", "output", "error", "refactored"], template=debug_explain_template)
+debug_single_pass_prompt_template = PromptTemplate(input_variables=["examples", "code", "output", "error"], template=debug_single_pass_template)
+explain_prompt_template = PromptTemplate(input_variables=["examples", "code"], template=explain_template)
+
+
+refactor_assembler = PromptAssembler("refactor", [refactor_template], {"examples": refactor_examples})
+debug_assembler = PromptAssembler(
+    "debug",
+    [debug_template, debug_explain_template],
+    {"examples": debug_examples, "explain_examples": debug_explain_examples}
+)
+debug_single_pass_assembler = PromptAssembler(
+    "debug_single_pass",
+    [debug_single_pass_template],
+    {"examples": debug_single_pass_examples},
+    completion_ratio=2.0
+)
+# Explanations are usually longer than the code they explain
+explain_assembler = PromptAssembler("explain", [explain_template], {"examples": explain_examples}, completion_ratio=1.5)
+
+
+def build_refactor_chain(llm):
+    # Memory is per cell, so it is loaded and saved around the shared chain
+    return LLMChain(
+        llm=llm,
+        prompt=refactor_prompt_template,
+        verbose=True
+    )
+
+
+def build_debug_chain(llm):
+    debug_chain = LLMChain(
+        llm=llm,
+        prompt=debug_prompt_template,
+        verbose=True,
+        output_key="refactored"
+    )
+
+    debug_explain_chain = LLMChain(
+        llm=llm,
+        prompt=debug_explain_prompt_template,
+        verbose=True,
+        output_key="explanation"
+    )
+
+    return SequentialChain(
+        chains=[debug_chain, debug_explain_chain],
+        input_variables=["examples", "explain_examples", "code", "output", "error"],
+        # Here we return multiple variables
+        output_variables=["refactored", "explanation"],
+        verbose=True
+    )
+
+
+def build_debug_single_pass_chain(llm):
+    # The fix and its explanation come from one call, split on DEBUG_EXPLANATION_MARKER
+    return LLMChain(
+        llm=llm,
+        prompt=debug_single_pass_prompt_template,
+        verbose=True
+    )
+
+
+def build_explain_chain(llm):
+    return LLMChain(
+        llm=llm,
+        prompt=explain_prompt_template,
+        verbose=True
+    )
@@ -0,0 +1,108 @@
+import os
+
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"config: ignoring invalid value {value!r} for {name}")
+        return default
+
+
+def env_int(name, default):
+    return int(env_float(name, default))
+
+
+def env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Event loop stall monitoring
+STALL_SAMPLE_INTERVAL = env_float("LABPILOT_STALL_SAMPLE_MS", 50) / 1000
+STALL_WARN_THRESHOLD = env_float("LABPILOT_STALL_WARN_MS", 10) / 1000
+
+# Pooled LLM clients
+LLM_POOL_SIZE = env_int("LABPILOT_LLM_POOL_SIZE", 32)
+LLM_KEEPALIVE_TIMEOUT = env_float("LABPILOT_LLM_KEEPALIVE_S", 60)
+
+# Streamed token coalescing, 0 for both sends one frame per token
+STREAM_FLUSH_INTERVAL = env_float("LABPILOT_STREAM_FLUSH_MS", 50) / 1000
+STREAM_FLUSH_BYTES = env_int("LABPILOT_STREAM_FLUSH_BYTES", 512)
+
+# Explain/refactor response cache, the disk tier is off unless a directory is set
+CACHE_MAX_BYTES = env_int("LABPILOT_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+CACHE_DIR = os.environ.get("LABPILOT_CACHE_DIR") or None
+CACHE_DISK_MAX_BYTES = env_int("LABPILOT_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024)
+
+# Per cell refactor memory shared by all connections
+CELL_MEMORY_WINDOW = env_int("LABPILOT_CELL_MEMORY_WINDOW", 3)
+CELL_MEMORY_MAX_BYTES = env_int("LABPILOT_CELL_MEMORY_MAX_BYTES", 16 * 1024 * 1024)
+CELL_MEMORY_TTL = env_float("LABPILOT_CELL_MEMORY_TTL_S", 6 * 60 * 60)
+
+# "single" streams the debug fix and its explanation from one call, "two_pass" uses two chained calls
+DEBUG_MODE = os.environ.get("LABPILOT_DEBUG_MODE", "single")
+
+# Debugging aids, both off in production since they slow every request down
+LANGCHAIN_DEBUG = env_bool("LABPILOT_LANGCHAIN_DEBUG", False)
+TRACEMALLOC = env_bool("LABPILOT_TRACEMALLOC", False)
+# Level of the terminal backend's own log, DEBUG logs every agent step
+TERMINAL_LOG_LEVEL = os.environ.get("LABPILOT_TERMINAL_LOG_LEVEL", "WARNING").upper()
+
+# Terminal backend, started with the first terminal widget unless eager
+TERMINAL_EAGER = env_bool("LABPILOT_TERMINAL_EAGER", False)
+TERMINAL_PORT = env_int("LABPILOT_TERMINAL_PORT", 8080)
+TERMINAL_SECONDARY_PORT = env_int("LABPILOT_TERMINAL_SECONDARY_PORT", 8081)
+TERMINAL_START_TIMEOUT = env_float("LABPILOT_TERMINAL_START_TIMEOUT_S", 60)
+
+# Prompt token budgets, output and error are cut to these sizes before they are sent
+PROMPT_MAX_OUTPUT_TOKENS = env_int("LABPILOT_PROMPT_MAX_OUTPUT_TOKENS", 1000)
+PROMPT_MAX_ERROR_TOKENS = env_int("LABPILOT_PROMPT_MAX_ERROR_TOKENS", 1500)
+PROMPT_MAX_MEMORY_TOKENS = env_int("LABPILOT_PROMPT_MAX_MEMORY_TOKENS", 1500)
+PROMPT_MIN_COMPLETION_TOKENS = env_int("LABPILOT_PROMPT_MIN_COMPLETION_TOKENS", 512)
+
+# Admission control for LLM requests, per process (the terminal backend has its own)
+SCHEDULER_MAX_CONCURRENT = env_int("LABPILOT_MAX_CONCURRENT_LLM", 8)
+SCHEDULER_MAX_QUEUED = env_int("LABPILOT_MAX_QUEUED", 64)
+SCHEDULER_MAX_QUEUED_PER_USER = env_int("LABPILOT_MAX_QUEUED_PER_USER", 4)
+
+# Deadlines for terminal agent runs and the tool calls they wait on in the browser
+TERMINAL_TOOL_TIMEOUT = env_float("LABPILOT_TERMINAL_TOOL_TIMEOUT_S", 60)
+TERMINAL_RUN_CELL_TIMEOUT = env_float("LABPILOT_TERMINAL_RUN_CELL_TIMEOUT_S", 600)
+TERMINAL_RUN_TIMEOUT = env_float("LABPILOT_TERMINAL_RUN_TIMEOUT_S", 1800)
+# Failed agent steps are retried from the last completed step, backing off from this many seconds
+TERMINAL_AGENT_MAX_RETRIES = env_int("LABPILOT_TERMINAL_AGENT_MAX_RETRIES", 3)
+TERMINAL_AGENT_RETRY_BACKOFF = env_float("LABPILOT_TERMINAL_AGENT_RETRY_BACKOFF_S", 1)
+
+# Tool observations in the agent's scratchpad, older ones are left out when the prompt doesn't fit the context window
+TERMINAL_MAX_OBSERVATION_TOKENS = env_int("LABPILOT_TERMINAL_MAX_OBSERVATION_TOKENS", 1500)
+TERMINAL_KEEP_OBSERVATIONS = env_int("LABPILOT_TERMINAL_KEEP_OBSERVATIONS", 2)
+
+# Cells the terminal agent runs on the kernel, outputs are cut to these sizes before the agent sees them
+TERMINAL_CELL_WAIT = env_float("LABPILOT_TERMINAL_CELL_WAIT_S", 30)
+# How long a finished cell's results stay around for poll_cell_execution_tool
+TERMINAL_EXECUTION_TTL = env_float("LABPILOT_TERMINAL_EXECUTION_TTL_S", 600)
+TERMINAL_MAX_CELL_OUTPUT_TOKENS = env_int("LABPILOT_TERMINAL_MAX_CELL_OUTPUT_TOKENS", 1000)
+TERMINAL_MAX_CELL_OUTPUT_CHARS = env_int("LABPILOT_TERMINAL_MAX_CELL_OUTPUT_CHARS", 100000)
+
+# Shell commands of the terminal agent
+TERMINAL_SHELL_TIMEOUT = env_float("LABPILOT_TERMINAL_SHELL_TIMEOUT_S", 120)
+TERMINAL_SHELL_CONCURRENCY = env_int("LABPILOT_TERMINAL_SHELL_CONCURRENCY", 2)
+TERMINAL_MAX_SHELL_OUTPUT_TOKENS = env_int("LABPILOT_TERMINAL_MAX_SHELL_OUTPUT_TOKENS", 1000)
+TERMINAL_MAX_SHELL_OUTPUT_CHARS = env_int("LABPILOT_TERMINAL_MAX_SHELL_OUTPUT_CHARS", 100000)
+
+# Per cell summaries for read_notebook_summary_tool, cached by cell content
+TERMINAL_SUMMARY_CACHE_SIZE = env_int("LABPILOT_TERMINAL_SUMMARY_CACHE_SIZE", 4096)
+TERMINAL_SUMMARY_CONCURRENCY = env_int("LABPILOT_TERMINAL_SUMMARY_CONCURRENCY", 8)
+
+# Notebook compaction, long outputs keep their first and last lines
+TERMINAL_COMPACT_MAX_OUTPUT_LINES = env_int("LABPILOT_TERMINAL_COMPACT_MAX_OUTPUT_LINES", 40)
+TERMINAL_COMPACT_MAX_LINE_CHARS = env_int("LABPILOT_TERMINAL_COMPACT_MAX_LINE_CHARS", 400)
+
+# Terminal agent chat memory, older turns are folded into a summary past this many tokens
+TERMINAL_MEMORY_MAX_TOKENS = env_int("LABPILOT_TERMINAL_MEMORY_MAX_TOKENS", 2000)
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+from .config import STREAM_FLUSH_INTERVAL, STREAM_FLUSH_BYTES
+from .metrics import metrics
+
+# Compact frames are JSON arrays instead of objects:
+#   [0, "<text>"]  tokens
+#   [1]            start of a completion
+#   [2]            end of a completion
+# Clients opt in by sending "frame_format": "compact" with their request.
+COMPACT_TOKEN = 0
+COMPACT_START = 1
+COMPACT_DONE = 2
+
+
+def wants_compact(data):
+    return data.get("frame_format") == "compact"
+
+
+class FrameCoalescer(object):
+    """Batches streamed tokens into fewer websocket frames.
+
+    Tokens are buffered and sent as a single frame once flush_bytes have
+    accumulated or flush_interval seconds have passed since the buffer was
+    last emptied. done() always flushes before the end frame. With both
+    limits at 0 every token is sent as its own frame, like before.
+    """
+
+    def __init__(self, send, extra=None, compact=False, flush_interval=STREAM_FLUSH_INTERVAL, flush_bytes=STREAM_FLUSH_BYTES):
+        self.send = send
+        self.extra = extra or {}
+        self.compact = compact
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._lock = asyncio.Lock()
+        # Tokens received so far and whether a completion is mid-stream
+        self.tokens = 0
+        self.streaming = False
+
+    def _frame(self, kind, text=None):
+        if self.compact:
+            return json.dumps([kind, text] if kind == COMPACT_TOKEN else [kind], separators=(",", ":"))
+        reply = {
+            "done": kind == COMPACT_DONE,
+            "start": kind == COMPACT_START
+        }
+        if kind == COMPACT_TOKEN:
+            reply["message"] = text
+        reply.update(self.extra)
+        return json.dumps(reply)
+
+    async def _send(self, frame):
+        metrics.inc("stream.frames")
+        metrics.inc("stream.frame_bytes", len(frame))
+        await self.send(frame)
+
+    async def start(self):
+        self.streaming = True
+        async with self._lock:
+            self._last_flush = time.monotonic()
+            await self._send(self._frame(COMPACT_START))
+
+    async def token(self, token):
+        if not token:
+            return
+        metrics.inc("stream.tokens")
+        self.tokens += 1
+        self._buffer.append(token)
+        self._buffered_bytes += len(token)
+
+        if self._buffered_bytes >= self.flush_bytes or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(max(0.0, self.flush_interval - (time.monotonic() - self._last_flush)))
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if self._timer is not None and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+                self._timer = None
+            self._last_flush = time.monotonic()
+            if not self._buffer:
+                return
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._buffered_bytes = 0
+            await self._send(self._frame(COMPACT_TOKEN, text))
+
+    async def done(self):
+        self.streaming = False
+        await self.flush()
+        async with self._lock:
+            await self._send(self._frame(COMPACT_DONE))
+
+
+async def replay_completion(send, text, extra=None, compact=False):
+    """Sends an already finished completion with the same frames as a live one."""
+    coalescer = FrameCoalescer(send, extra=extra, compact=compact)
+    await coalescer.start()
+    await coalescer.token(text)
+    await coalescer.done()
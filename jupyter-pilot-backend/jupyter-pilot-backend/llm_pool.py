@@ -0,0 +1,99 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from .config import LLM_POOL_SIZE, LLM_KEEPALIVE_TIMEOUT
+from .metrics import metrics
+
+
+class _PoolEntry(object):
+    def __init__(self, llm):
+        self.llm = llm
+        self.chains = {}
+
+
+class LLMPool(object):
+    """Bounded LRU of streaming ChatOpenAI clients keyed by (api key, model, temperature).
+
+    Clients are created without callbacks; streaming handlers are passed per
+    call (chain.acall(..., callbacks=[...])) so one client serves every request
+    with the same credentials. Chains built on a pooled client are cached with
+    it and dropped together on eviction.
+
+    The HTTP side is a keep-alive aiohttp session per api key, bound to the
+    calling task through openai.aiosession while a request is in flight.
+    """
+
+    def __init__(self, max_size=LLM_POOL_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._sessions = {}
+        self._session_users = {}
+
+    def _entry(self, openai_api_key, model, temperature):
+        key = (openai_api_key, model, float(temperature))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            metrics.inc("llm_pool.hits")
+            return entry
+
+        metrics.inc("llm_pool.misses")
+        # Imported here so loading the server extension doesn't pay for langchain
+        from langchain.chat_models import ChatOpenAI
+        llm = ChatOpenAI(openai_api_key=openai_api_key, model=model, temperature=temperature, streaming=True)
+        entry = _PoolEntry(llm)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            evicted_key, _ = self._entries.popitem(last=False)
+            metrics.inc("llm_pool.evictions")
+            self._maybe_close_session(evicted_key[0])
+        metrics.set("llm_pool.size", len(self._entries))
+        return entry
+
+    def get_llm(self, openai_api_key, model, temperature):
+        return self._entry(openai_api_key, model, temperature).llm
+
+    def get_chain(self, openai_api_key, model, temperature, name, factory):
+        """Returns the chain `name` built by factory(llm) on the pooled client."""
+        entry = self._entry(openai_api_key, model, temperature)
+        chain = entry.chains.get(name)
+        if chain is None:
+            chain = factory(entry.llm)
+            entry.chains[name] = chain
+        return chain
+
+    @asynccontextmanager
+    async def session(self, openai_api_key):
+        """Binds the keep-alive HTTP session for openai_api_key to the current task."""
+        import aiohttp
+        import openai
+        session = self._sessions.get(openai_api_key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(keepalive_timeout=LLM_KEEPALIVE_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[openai_api_key] = session
+            metrics.inc("llm_pool.sessions_opened")
+        self._session_users[openai_api_key] = self._session_users.get(openai_api_key, 0) + 1
+        token = openai.aiosession.set(session)
+        try:
+            yield session
+        finally:
+            openai.aiosession.reset(token)
+            self._session_users[openai_api_key] -= 1
+            self._maybe_close_session(openai_api_key)
+
+    def _maybe_close_session(self, openai_api_key):
+        # Close the HTTP session once no pooled client and no request uses the key
+        if self._session_users.get(openai_api_key, 0) > 0:
+            return
+        if any(key[0] == openai_api_key for key in self._entries):
+            return
+        session = self._sessions.pop(openai_api_key, None)
+        self._session_users.pop(openai_api_key, None)
+        if session is not None and not session.closed:
+            asyncio.ensure_future(session.close())
+            metrics.inc("llm_pool.sessions_closed")
+
+
+llm_pool = LLMPool()
@@ -0,0 +1,40 @@
+import asyncio
+
+from .config import STALL_SAMPLE_INTERVAL, STALL_WARN_THRESHOLD
+from .metrics import metrics
+
+
+class EventLoopStallMonitor(object):
+    """Samples how late the event loop wakes up a periodic sleep.
+
+    Any lateness beyond the sample interval is time the loop spent running
+    something else without yielding, so the recorded value is the stall a
+    websocket frame or kernel message would have seen at that moment.
+    """
+
+    def __init__(self, name="jupyter", interval=STALL_SAMPLE_INTERVAL, warn_threshold=STALL_WARN_THRESHOLD):
+        self.name = name
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            stall = max(0.0, loop.time() - expected)
+            metrics.observe(f"{self.name}.loop_stall_seconds", stall)
+            if stall > self.warn_threshold:
+                metrics.inc(f"{self.name}.loop_stalls_over_threshold")
+                print(f"EventLoopStallMonitor({self.name}): event loop blocked for {stall * 1000:.1f} ms")
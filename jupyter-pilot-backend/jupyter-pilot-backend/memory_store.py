@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+from .config import CELL_MEMORY_WINDOW, CELL_MEMORY_MAX_BYTES, CELL_MEMORY_TTL
+from .metrics import metrics
+
+
+def _memory_bytes(memory):
+    return sum(len(str(message.content).encode()) for message in memory.chat_memory.messages)
+
+
+class _Entry(object):
+    def __init__(self, memory):
+        self.memory = memory
+        self.bytes = 0
+        self.last_used = time.monotonic()
+
+
+class CellMemoryStore(object):
+    """Process wide refactor memory keyed by (notebook path, cell id).
+
+    Entries outlive the websocket that created them, so a cell keeps its
+    history across reconnects. They are dropped when unused for ttl
+    seconds, and least recently used entries go first once the stored
+    messages exceed max_bytes.
+    """
+
+    def __init__(self, k=CELL_MEMORY_WINDOW, max_bytes=CELL_MEMORY_MAX_BYTES, ttl=CELL_MEMORY_TTL):
+        self.k = k
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, path, cell_id):
+        """Returns the memory for the cell, creating it if needed."""
+        self._expire()
+        key = (path, cell_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            from langchain.memory import ConversationBufferWindowMemory
+            entry = _Entry(ConversationBufferWindowMemory(k=self.k, memory_key="memory", return_messages=True))
+            self._entries[key] = entry
+            metrics.inc("cell_memory.created")
+        else:
+            self._entries.move_to_end(key)
+            metrics.inc("cell_memory.reused")
+        entry.last_used = time.monotonic()
+        self._report()
+        return entry.memory
+
+    def update(self, path, cell_id):
+        """Re-accounts a cell's memory after new context was saved to it."""
+        entry = self._entries.get((path, cell_id))
+        if entry is None:
+            return
+        # The window memory only limits what is loaded, so trim what is kept as well
+        messages = entry.memory.chat_memory.messages
+        if len(messages) > 2 * self.k:
+            del messages[:len(messages) - 2 * self.k]
+        size = _memory_bytes(entry.memory)
+        self._bytes += size - entry.bytes
+        entry.bytes = size
+        entry.last_used = time.monotonic()
+
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.bytes
+            metrics.inc("cell_memory.evicted_lru")
+        self._report()
+
+    def _expire(self):
+        # Entries are kept in last-used order, so expired ones are at the front
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.last_used < self.ttl:
+                break
+            del self._entries[key]
+            self._bytes -= entry.bytes
+            metrics.inc("cell_memory.evicted_ttl")
+
+    def _report(self):
+        metrics.set("cell_memory.entries", len(self._entries))
+        metrics.set("cell_memory.bytes", self._bytes)
+
+
+cell_memory_store = CellMemoryStore()
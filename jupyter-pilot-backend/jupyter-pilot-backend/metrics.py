@@ -0,0 +1,56 @@
+import json
+import threading
+import tornado.web
+from notebook.base.handlers import IPythonHandler
+
+
+class Metrics(object):
+    """Process wide counters, gauges and timing summaries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0}
+                self._timings[name] = timing
+            timing["count"] += 1
+            timing["sum"] += value
+            timing["max"] = max(timing["max"], value)
+            timing["last"] = value
+
+    def snapshot(self):
+        with self._lock:
+            timings = {}
+            for name, timing in self._timings.items():
+                timings[name] = dict(timing, mean=timing["sum"] / timing["count"])
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": timings
+            }
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(IPythonHandler):
+    """The metrics as JSON, for logged in users only."""
+
+    @tornado.web.authenticated
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(metrics.snapshot()))
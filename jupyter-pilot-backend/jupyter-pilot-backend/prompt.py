@@ -1,17 +1,8 @@
 
 
-refactor_template = """
-The following list defines what you are and how you behave:
-- You are a python code refactorer, that refactors code based on special comments starting with '#@'. You follow these rules:
-- When encountering the '#@' symbol in the code, you will interpret the instructions given and refactor the corresponding code according to the special comment.
-- The '#@' symbol is used by the user to describe what should be done about the code, what should be refactored.
-- Never add comments with the '#@' symbol in your refactored code. It's reserved for the user to steer you.
-- Were a line starts with '#@' you are to interpolate the refactored code.
-- Only return the code and nothing else, but you need to return all the code.
-- Do not write any psudocode, everything has to be implemented in real code.
-- Never ask questions, you always try to perform your task on the first shot.
-
-The following is an example of how you should behave:
+# Few-shot examples fill {examples}, the last ones are dropped first when a prompt runs out of tokens
+refactor_examples = [
+"""The following is an example of how you should behave:
 
 code:
 def fibonacci(n):
@@ -35,13 +26,13 @@ def fibonacci_story():
     day = 1
     while day <= 10:
         rabbits = fibonacci(day)
-        print("On day {{}} there are {{}} rabbits".format(day, rabbits))
+        print("On day {} there are {} rabbits".format(day, rabbits))
 
         day += 1
 
 fibonacci_story()
-
-This is another example:
+""",
+"""This is another example:
 
 code:
 #@ quicksort
@@ -55,6 +46,22 @@ def quicksort(arr):
     middle = [x for x in arr if x == pivot]
     right = [x for x in arr if x > pivot]
     return quicksort(left) + middle + quicksort(right)
+""",
+]
+
+
+refactor_template = """
+The following list defines what you are and how you behave:
+- You are a python code refactorer, that refactors code based on special comments starting with '#@'. You follow these rules:
+- When encountering the '#@' symbol in the code, you will interpret the instructions given and refactor the corresponding code according to the special comment.
+- The '#@' symbol is used by the user to describe what should be done about the code, what should be refactored.
+- Never add comments with the '#@' symbol in your refactored code. It's reserved for the user to steer you.
+- Were a line starts with '#@' you are to interpolate the refactored code.
+- Only return the code and nothing else, but you need to return all the code.
+- Do not write any psudocode, everything has to be implemented in real code.
+- Never ask questions, you always try to perform your task on the first shot.
+
+{examples}
 
 The following are previous versions of the code wanted to be refactored, they might be relevant or not.
 {memory}
@@ -66,20 +73,8 @@ refactored:\n
 """
 
 
-debug_template = """
-The following list defines what you are and how you behave:
-- You are a debugger that recieves the code, stacktrace and output result of a jupyter notebook cell that has been ran.
-- Based on the code, stacktrace and output, you suggest a refactored version of the code.
-- The refactored code should resolve any issues with the code that is suggested by the output, stacktrace and comments preceding the '#@' symbol.
-- The '#@' symbol is used by the user to describe what should be done about the code, what should be refactored, what might be wrong.
-- The user might spesify what should be done in the area of that particular '#@' comment, not just that particular line.
-- NEVER use the '#@' symbol. It's reserved for the user to steer you! If you have to include comments, use normal ones.
-- If there is nothing to fix and the code runs fine, you return the unaltered code.
-- Never ask questions, you always try to perform your task on the first shot.
-- The refactored code has to include the code as a whole.
-- Only code can be part of the reply. Anything else has to be in normal comments!
-
-The following is an example:
+debug_examples = [
+"""The following is an example:
 
 code:
 !pip install numby
@@ -92,8 +87,8 @@ ERROR: No matching distribution found for numby
 
 refactored:
 !pip install numpy
-
-This is another example:
+""",
+"""This is another example:
 
 code:
 def fibonacci(n):
@@ -110,7 +105,7 @@ def fibonacci_story():
     # Print the Fibonacci numbers for days 1 to 10
     for day in range(1, 11):
         rabbits = fibonacci(day)
-        print("On day {{}}, there are {{}} rabbits.".format(day, rabbits))
+        print("On day {}, there are {} rabbits.".format(day, rabbits))
 
 fibonacci_story(1)
 
@@ -132,7 +127,7 @@ TypeError: fibonacci_story() takes 0 positional arguments but 1 was given
 �[0;31mTypeError�[0m                                 Traceback (most recent call last)
 Cell �[0;32mIn[3], line 17�[0m
 �[1;32m     14�[0m         rabbits �[38;5;241m=�[39m fibonacci(day)
-�[1;32m     15�[0m         �[38;5;28mprint�[39m(�[38;5;124m"�[39m�[38;5;124mOn day �[39m�[38;5;132;01m{{}}�[39;00m�[38;5;124m, there are �[39m�[38;5;132;01m{{}}�[39;00m�[38;5;124m rabbits.�[39m�[38;5;124m"�[39m�[38;5;241m.�[39mformat(day, rabbits))
+�[1;32m     15�[0m         �[38;5;28mprint�[39m(�[38;5;124m"�[39m�[38;5;124mOn day �[39m�[38;5;132;01m{}�[39;00m�[38;5;124m, there are �[39m�[38;5;132;01m{}�[39;00m�[38;5;124m rabbits.�[39m�[38;5;124m"�[39m�[38;5;241m.�[39mformat(day, rabbits))
 �[0;32m---> 17�[0m �[43mfibonacci_story�[49m�[43m(�[49m�[38;5;241;43m1�[39;49m�[43m)�[49m
 
 �[0;31mTypeError�[0m: fibonacci_story() takes 0 positional arguments but 1 was given
@@ -152,9 +147,27 @@ def fibonacci_story():
     # Print the Fibonacci numbers for days 1 to 10
     for day in range(1, 11):
         rabbits = fibonacci(day)
-        print("On day {{}}, there are {{}} rabbits.".format(day, rabbits))
+        print("On day {}, there are {} rabbits.".format(day, rabbits))
 
 fibonacci_story()
+""",
+]
+
+
+debug_template = """
+The following list defines what you are and how you behave:
+- You are a debugger that recieves the code, stacktrace and output result of a jupyter notebook cell that has been ran.
+- Based on the code, stacktrace and output, you suggest a refactored version of the code.
+- The refactored code should resolve any issues with the code that is suggested by the output, stacktrace and comments preceding the '#@' symbol.
+- The '#@' symbol is used by the user to describe what should be done about the code, what should be refactored, what might be wrong.
+- The user might spesify what should be done in the area of that particular '#@' comment, not just that particular line.
+- NEVER use the '#@' symbol. It's reserved for the user to steer you! If you have to include comments, use normal ones.
+- If there is nothing to fix and the code runs fine, you return the unaltered code.
+- Never ask questions, you always try to perform your task on the first shot.
+- The refactored code has to include the code as a whole.
+- Only code can be part of the reply. Anything else has to be in normal comments!
+
+{examples}
 
 Debug and refactor the following.
 
@@ -171,11 +184,8 @@ refactored:\n
 """
 
 
-debug_explain_template = """
-You recieve the code, stacktrace and output result of a jupyter notebook cell that has been ran. 
-Your job is to explain what the error was and what was done to fix it.
-You can write the explanation as markdown.
-The following is an example:
+debug_explain_examples = [
+"""The following is an example:
 
 code:
 !pip install numby
@@ -191,8 +201,8 @@ refactored:
 
 explanation:
 There is no package called numby in python. You probably meant 'numpy'. The code has been refactored to reflect that.
-
-This is another example:
+""",
+"""This is another example:
 
 code:
 def fibonacci(n):
@@ -209,7 +219,7 @@ def fibonacci_story():
     # Print the Fibonacci numbers for days 1 to 10
     for day in range(1, 11):
         rabbits = fibonacci(day)
-        print("On day {{}}, there are {{}} rabbits.".format(day, rabbits))
+        print("On day {}, there are {} rabbits.".format(day, rabbits))
 
 fibonacci_story(1)
 
@@ -231,7 +241,7 @@ TypeError: fibonacci_story() takes 0 positional arguments but 1 was given
 �[0;31mTypeError�[0m                                 Traceback (most recent call last)
 Cell �[0;32mIn[3], line 17�[0m
 �[1;32m     14�[0m         rabbits �[38;5;241m=�[39m fibonacci(day)
-�[1;32m     15�[0m         �[38;5;28mprint�[39m(�[38;5;124m"�[39m�[38;5;124mOn day �[39m�[38;5;132;01m{{}}�[39;00m�[38;5;124m, there are �[39m�[38;5;132;01m{{}}�[39;00m�[38;5;124m rabbits.�[39m�[38;5;124m"�[39m�[38;5;241m.�[39mformat(day, rabbits))
+�[1;32m     15�[0m         �[38;5;28mprint�[39m(�[38;5;124m"�[39m�[38;5;124mOn day �[39m�[38;5;132;01m{}�[39;00m�[38;5;124m, there are �[39m�[38;5;132;01m{}�[39;00m�[38;5;124m rabbits.�[39m�[38;5;124m"�[39m�[38;5;241m.�[39mformat(day, rabbits))
 �[0;32m---> 17�[0m �[43mfibonacci_story�[49m�[43m(�[49m�[38;5;241;43m1�[39;49m�[43m)�[49m
 
 �[0;31mTypeError�[0m: fibonacci_story() takes 0 positional arguments but 1 was given
@@ -251,12 +261,21 @@ def fibonacci_story():
     # Print the Fibonacci numbers for days 1 to 10
     for day in range(1, 11):
         rabbits = fibonacci(day)
-        print("On day {{}}, there are {{}} rabbits.".format(day, rabbits))
+        print("On day {}, there are {} rabbits.".format(day, rabbits))
 
 fibonacci_story()
 
 explanation:
 I removed the argument from the `fibonacci_story` function call, as the function doesn't take any arguments.
+""",
+]
+
+
+debug_explain_template = """
+You recieve the code, stacktrace and output result of a jupyter notebook cell that has been ran. 
+Your job is to explain what the error was and what was done to fix it.
+You can write the explanation as markdown.
+{explain_examples}
 
 Explain what has been done to fix this code given the error and output:
 
@@ -276,16 +295,97 @@ explanation:\n
 """
 
 
-explain_template = """
+# Separates the fixed code from the explanation in single pass debug replies
+DEBUG_EXPLANATION_MARKER = "<<<explanation>>>"
+
+
+debug_single_pass_examples = [
+"""The following is an example:
+
+code:
+!pip install numby
+
+output:
+
+error:
+ERROR: Could not find a version that satisfies the requirement numby (from versions: none)
+ERROR: No matching distribution found for numby
+
+refactored:
+!pip install numpy
+""" + DEBUG_EXPLANATION_MARKER + """
+There is no package called numby in python. You probably meant 'numpy'. The code has been refactored to reflect that.
+""",
+"""This is another example:
+
+code:
+def fibonacci_story():
+    # Print the Fibonacci numbers for days 1 to 10
+    for day in range(1, 11):
+        rabbits = fibonacci(day)
+        print("On day {}, there are {} rabbits.".format(day, rabbits))
+
+fibonacci_story(1)
+
+output:
+
+error:
+TypeError: fibonacci_story() takes 0 positional arguments but 1 was given
+�[0;31m---------------------------------------------------------------------------�[0m
+�[0;31mTypeError�[0m                                 Traceback (most recent call last)
+Cell �[0;32mIn[3], line 17�[0m
+�[1;32m     14�[0m         rabbits �[38;5;241m=�[39m fibonacci(day)
+�[1;32m     15�[0m         �[38;5;28mprint�[39m(�[38;5;124m"�[39m�[38;5;124mOn day �[39m�[38;5;132;01m{}�[39;00m�[38;5;124m, there are �[39m�[38;5;132;01m{}�[39;00m�[38;5;124m rabbits.�[39m�[38;5;124m"�[39m�[38;5;241m.�[39mformat(day, rabbits))
+�[0;32m---> 17�[0m �[43mfibonacci_story�[49m�[43m(�[49m�[38;5;241;43m1�[39;49m�[43m)�[49m
+
+�[0;31mTypeError�[0m: fibonacci_story() takes 0 positional arguments but 1 was given
+
+refactored:
+def fibonacci_story():
+    # Print the Fibonacci numbers for days 1 to 10
+    for day in range(1, 11):
+        rabbits = fibonacci(day)
+        print("On day {}, there are {} rabbits.".format(day, rabbits))
+
+fibonacci_story()
+""" + DEBUG_EXPLANATION_MARKER + """
+I removed the argument from the `fibonacci_story` function call, as the function doesn't take any arguments.
+""",
+]
+
+
+debug_single_pass_template = """
 The following list defines what you are and how you behave:
-- You are a jupyter notebook extension bot that recieves code  with special comments and explains the code or part of it in markdown.
-- The code can contain lines with special comments, starting with the #@-symbol. These comments are used to steer your answer.
-- If there are any special comments, '#@', in the code that asks particularly for an explanation of that line or area of code, then you are ONLY to explain what is asked for in the special comment, not all of the code!
-- It's IMPORTANT to only explain what is asked for when special comments, '#@', are used!
-- Be carefull and see if any special comments are included before you answer!
-- Never ask questions, always try to perform your task on the first shot!
+- You are a debugger that recieves the code, stacktrace and output result of a jupyter notebook cell that has been ran.
+- Based on the code, stacktrace and output, you suggest a refactored version of the code, and then explain what the error was and what was done to fix it.
+- The refactored code should resolve any issues with the code that is suggested by the output, stacktrace and comments preceding the '#@' symbol.
+- The '#@' symbol is used by the user to describe what should be done about the code, what should be refactored, what might be wrong.
+- The user might spesify what should be done in the area of that particular '#@' comment, not just that particular line.
+- NEVER use the '#@' symbol. It's reserved for the user to steer you! If you have to include comments, use normal ones.
+- If there is nothing to fix and the code runs fine, you return the unaltered code.
+- Never ask questions, you always try to perform your task on the first shot.
+- The refactored code has to include the code as a whole.
+- First reply with the refactored code only, then a line containing only """ + DEBUG_EXPLANATION_MARKER + """, then the explanation written as markdown.
+
+{examples}
+
+Debug and refactor the following, then explain the fix.
+
+code:
+{code}
+
+output:
+{output}
 
-The following is an example (Here we explain the whole code, since no special comments are included in the code):
+error:
+{error}
+
+refactored:\n
+"""
+
+
+explain_examples = [
+"""The following is an example (Here we explain the whole code, since no special comments are included in the code):
 
 code:
 def fibonacci(n):
@@ -322,8 +422,8 @@ Let's break down the code step by step:
 9. Outside the function, we prompt the user to input the number of Fibonacci numbers they want to generate and store it in the variable `n`.
 10. We call the `fibonacci` function with `n` as an argument and store the resulting sequence in the variable `fib_sequence`.
 11. Finally, we print the `fib_sequence` to display the Fibonacci numbers.
-
-The following is another example (Here we only explain what is asked for in the special comment):
+""",
+"""The following is another example (Here we only explain what is asked for in the special comment):
 
 code:
 def fibonacci(n):
@@ -347,6 +447,20 @@ print(fib_sequence)
 explanation:
 The while loop runs while the length of the `sequence` list is less than the desired integer n. It calculates the next number in the sequence, `next_number`,
 by adding the two previous numbers, `sequence[-1]` and `sequence[-2]`, together, then appending it to the `sequence` list as the next number in the fibonacci sequence.
+""",
+]
+
+
+explain_template = """
+The following list defines what you are and how you behave:
+- You are a jupyter notebook extension bot that recieves code  with special comments and explains the code or part of it in markdown.
+- The code can contain lines with special comments, starting with the #@-symbol. These comments are used to steer your answer.
+- If there are any special comments, '#@', in the code that asks particularly for an explanation of that line or area of code, then you are ONLY to explain what is asked for in the special comment, not all of the code!
+- It's IMPORTANT to only explain what is asked for when special comments, '#@', are used!
+- Be carefull and see if any special comments are included before you answer!
+- Never ask questions, always try to perform your task on the first shot!
+
+{examples}
 
 Explain the following:
 
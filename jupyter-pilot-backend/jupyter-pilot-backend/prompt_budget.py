@@ -0,0 +1,233 @@
+import re
+import string
+
+from .config import PROMPT_MAX_OUTPUT_TOKENS, PROMPT_MAX_ERROR_TOKENS, PROMPT_MAX_MEMORY_TOKENS, PROMPT_MIN_COMPLETION_TOKENS
+from .metrics import metrics
+from .tokens import count_tokens
+
+# Context windows by model name prefix, the longest matching prefix wins
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+# Characters per token kept before counting, twice the usual four so dedupe and truncate_middle still have text to work with
+WINDOW_CHARS_PER_TOKEN = 8
+
+# Terminal colors, also in the mangled form where ESC became U+FFFD
+ANSI_ESCAPE = re.compile("(?:\x1b|\ufffd)\\[[0-9;?]*[A-Za-z]")
+
+
+def _fields(template):
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field}
+
+
+def context_tokens(model):
+    matches = [prefix for prefix in MODEL_CONTEXT_TOKENS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_TOKENS
+    return MODEL_CONTEXT_TOKENS[max(matches, key=len)]
+
+
+def strip_ansi(text):
+    return ANSI_ESCAPE.sub("", text)
+
+
+def dedupe_repeated_lines(text, max_block=12, min_repeats=3):
+    """Collapses a block of lines repeated back to back, like recursive traceback frames."""
+    lines = text.split("\n")
+    result = []
+    i = 0
+    while i < len(lines):
+        best_size, best_repeats = 1, 1
+        for size in range(1, max_block + 1):
+            block = lines[i:i + size]
+            if len(block) < size:
+                break
+            if not any(line.strip() for line in block):
+                continue
+            repeats = 1
+            while lines[i + repeats * size:i + (repeats + 1) * size] == block:
+                repeats += 1
+            if repeats >= min_repeats and size * repeats > best_size * best_repeats:
+                best_size, best_repeats = size, repeats
+
+        result.extend(lines[i:i + best_size])
+        if best_repeats > 1:
+            result.append(f"[... previous {best_size} line(s) repeated {best_repeats - 1} more times ...]")
+        i += best_size * best_repeats
+    return "\n".join(result)
+
+
+def clip_chars(text, max_chars, head_ratio=0.3):
+    """Keeps the first and last lines of text within max_chars, without counting tokens."""
+    if len(text) <= max_chars:
+        return text
+    head_chars = int(max_chars * head_ratio)
+    head = text[:head_chars]
+    if "\n" in head:
+        head = head[:head.rindex("\n")]
+    tail = text[len(text) - (max_chars - head_chars):]
+    if "\n" in tail:
+        tail = tail[tail.index("\n") + 1:]
+    omitted = text.count("\n", len(head), len(text) - len(tail))
+    marker = f"[... {omitted} lines omitted ...]"
+    return "\n".join(part for part in (head, marker, tail) if part)
+
+
+def truncate_middle(text, max_tokens, model, head_ratio=0.3):
+    """Keeps the first and last lines of text within max_tokens, dropping the middle.
+
+    With head_ratio=0 only the end is kept.
+    """
+    tokens = count_tokens(text, model)
+    if tokens <= max_tokens:
+        return text, 0
+    chars_per_token = len(text) / tokens
+    head_chars = int(max_tokens * head_ratio * chars_per_token)
+    tail_chars = int(max_tokens * (1 - head_ratio) * chars_per_token)
+
+    head = text[:head_chars]
+    if "\n" in head:
+        head = head[:head.rindex("\n")]
+    tail = text[len(text) - tail_chars:] if tail_chars else ""
+    if "\n" in tail:
+        tail = tail[tail.index("\n") + 1:]
+    middle = text[len(head):len(text) - len(tail)]
+
+    omitted = tokens - count_tokens(head, model) - count_tokens(tail, model)
+    marker = f"[... {middle.count(chr(10))} lines, about {omitted} tokens omitted ...]"
+    return "\n".join(part for part in (head, marker, tail) if part), omitted
+
+
+class CappedText(object):
+    """Keeps the start and the end of text that may grow without bounds."""
+
+    def __init__(self, max_chars):
+        self.half = max_chars // 2
+        self.head = ""
+        self.tail = ""
+        self.omitted = 0
+
+    def append(self, text):
+        if len(self.head) < self.half:
+            room = self.half - len(self.head)
+            self.head += text[:room]
+            text = text[room:]
+        if text:
+            self.tail += text
+            if len(self.tail) > self.half:
+                self.omitted += len(self.tail) - self.half
+                self.tail = self.tail[-self.half:]
+
+    def text(self):
+        if self.omitted:
+            return f"{self.head}\n[... {self.omitted} characters omitted ...]\n{self.tail}"
+        return self.head + self.tail
+
+
+class PromptAssembler(object):
+    """Fits the inputs of one request into the model's context window.
+
+    templates are the prompts the inputs are used in, one per LLM call, and
+    examples maps their few-shot variables to lists of examples. Output and
+    error are cut to a character window around their cap, stripped of
+    terminal colors, and repeated traceback frames are collapsed. The text
+    sections are head/tail truncated to their caps and then to what is left
+    after the code, the fixed instructions and room for the completion. Examples are dropped from the end while they don't
+    fit. Template variables that aren't inputs are the outputs of earlier
+    calls and are assumed to be about the size of the code.
+    """
+
+    # Section name: (cap in tokens, share of a truncated section kept from its start)
+    sections = {
+        "memory": (PROMPT_MAX_MEMORY_TOKENS, 0.0),
+        "output": (PROMPT_MAX_OUTPUT_TOKENS, 0.3),
+        "error": (PROMPT_MAX_ERROR_TOKENS, 0.3),
+    }
+
+    def __init__(self, name, templates, examples, completion_ratio=1.0):
+        self.name = name
+        self.templates = templates
+        self.examples = examples
+        self.completion_ratio = completion_ratio
+        self._fixed = {}
+
+    def _fixed_tokens(self, template, model):
+        key = (template, model)
+        if key not in self._fixed:
+            empty = {field: "" for field in _fields(template)}
+            self._fixed[key] = count_tokens(template.format(**empty), model)
+        return self._fixed[key]
+
+    def assemble(self, model, inputs):
+        """Returns the inputs with trimmed sections and the examples that fit."""
+        inputs = dict(inputs)
+        breakdown = {}
+        trimmed = 0
+
+        for section in ("output", "error"):
+            if inputs.get(section):
+                # Huge outputs are cut to a window around their cap first, deduping and counting all of it blocks the IOLoop
+                cap, head_ratio = self.sections[section]
+                text = clip_chars(inputs[section], cap * WINDOW_CHARS_PER_TOKEN, head_ratio)
+                inputs[section] = dedupe_repeated_lines(strip_ansi(text))
+
+        code_tokens = count_tokens(inputs.get("code", ""), model)
+        completion = max(PROMPT_MIN_COMPLETION_TOKENS, int(code_tokens * self.completion_ratio))
+        budget = context_tokens(model) - min(completion, context_tokens(model) // 2)
+
+        # The largest call decides how much room is left for the optional sections
+        fields = set()
+        fixed = 0
+        for template in self.templates:
+            names = _fields(template)
+            generated = sum(code_tokens for field in names if field not in inputs and field not in self.examples)
+            fixed = max(fixed, self._fixed_tokens(template, model) + generated)
+            fields |= names
+        breakdown["instructions"] = fixed
+        breakdown["code"] = code_tokens
+        room = budget - fixed - code_tokens
+
+        sizes = {}
+        for section in self.sections:
+            if section in fields and inputs.get(section):
+                sizes[section] = count_tokens(inputs[section], model)
+        for section, size in sizes.items():
+            cap, head_ratio = self.sections[section]
+            # Sections share what is left in proportion to their size, but never get more than their cap
+            share = max(0, room) * size // max(1, sum(sizes.values()))
+            limit = min(cap, max(share, 64))
+            if size > limit:
+                inputs[section], omitted = truncate_middle(inputs[section], limit, model, head_ratio)
+                trimmed += omitted
+                size = count_tokens(inputs[section], model)
+            breakdown[section] = size
+        room -= sum(breakdown.get(section, 0) for section in sizes)
+
+        dropped = 0
+        for variable, examples in self.examples.items():
+            kept = []
+            for example in examples:
+                tokens = count_tokens(example, model)
+                if tokens > room:
+                    break
+                kept.append(example)
+                room -= tokens
+            dropped += len(examples) - len(kept)
+            inputs[variable] = "\n".join(kept)
+            breakdown["examples"] = breakdown.get("examples", 0) + count_tokens(inputs[variable], model)
+
+        total = sum(breakdown.values())
+        metrics.observe(f"prompt.{self.name}.tokens", total)
+        metrics.inc("prompt.examples_dropped", dropped)
+        metrics.inc("prompt.tokens_trimmed", trimmed)
+        parts = " ".join(f"{section}={tokens}" for section, tokens in breakdown.items())
+        print(f"{self.name} prompt tokens: {parts} total={total} budget={budget} "
+              f"examples_dropped={dropped} trimmed={trimmed}")
+        if room < 0:
+            print(f"{self.name} prompt is over the {model} budget by {-room} tokens")
+        return inputs
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .config import CACHE_MAX_BYTES, CACHE_DIR, CACHE_DISK_MAX_BYTES
+from .metrics import metrics
+
+
+def normalize_code(code):
+    # Line endings, trailing whitespace and surrounding blank lines don't change the answer
+    lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+class ResponseCache(object):
+    """Content addressed cache of finished explain/refactor completions.
+
+    Keys hash the normalized code together with the prompt template, the
+    model and any extra context (like refactor memory). Entries live in a
+    byte bounded in-memory LRU and, when disk_dir is set, in a byte bounded
+    directory of json files that survives server restarts.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, disk_dir=CACHE_DIR, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = None
+        self._disk_lock = threading.Lock()
+
+    @staticmethod
+    def applies(temp, data):
+        """Completions are only reused when they are deterministic or the user asked for it."""
+        try:
+            deterministic = float(temp) == 0
+        except (TypeError, ValueError):
+            deterministic = False
+        return deterministic or data.get("cache") is True
+
+    @staticmethod
+    def key(kind, template, model, code, extra=""):
+        digest = hashlib.sha256()
+        for part in (kind, hashlib.sha256(template.encode()).hexdigest(), model, normalize_code(code), extra):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    async def get(self, key):
+        text = self._entries.get(key)
+        if text is not None:
+            self._entries.move_to_end(key)
+            metrics.inc("response_cache.hits")
+            metrics.inc("response_cache.memory_hits")
+            return text
+
+        if self.disk_dir:
+            text = await asyncio.get_event_loop().run_in_executor(None, self._read_disk, key)
+            if text is not None:
+                self._put_memory(key, text)
+                metrics.inc("response_cache.hits")
+                metrics.inc("response_cache.disk_hits")
+                return text
+
+        metrics.inc("response_cache.misses")
+        return None
+
+    async def put(self, key, text):
+        self._put_memory(key, text)
+        if self.disk_dir:
+            await asyncio.get_event_loop().run_in_executor(None, self._write_disk, key, text)
+
+    def _put_memory(self, key, text):
+        size = len(text.encode())
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous.encode())
+        self._entries[key] = text
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.encode())
+            metrics.inc("response_cache.evictions")
+        metrics.set("response_cache.entries", len(self._entries))
+        metrics.set("response_cache.bytes", self._bytes)
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = json.load(f)["text"]
+            os.utime(path)  # Keeps recently read entries out of eviction
+            return text
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, text):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"text": text}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"ResponseCache: failed to write {path}: {e}")
+            return
+
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+            else:
+                self._disk_bytes += os.path.getsize(path)
+            if self._disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _scan_disk(self):
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        files = sorted(self._scan_disk(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        # Evict down to 90% so every write past the limit doesn't rescan the directory
+        target = self.disk_max_bytes * 0.9
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                metrics.inc("response_cache.disk_evictions")
+            except OSError:
+                pass
+        self._disk_bytes = total
+        metrics.set("response_cache.disk_bytes", total)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from .config import SCHEDULER_MAX_CONCURRENT, SCHEDULER_MAX_QUEUED, SCHEDULER_MAX_QUEUED_PER_USER
+from .metrics import metrics
+
+# Higher runs first when requests are waiting for a slot
+PRIORITIES = {
+    "memory": 0,
+    "explain": 0,
+    "refactor": 1,
+    "debug": 1,
+    "agent": 2,
+}
+
+
+class SchedulerRejected(Exception):
+    """Raised when a request can't be queued because the queues are full."""
+
+
+def user_key(openai_api_key, fallback=None):
+    # Requests are grouped by the API key they are billed to, without keeping the key itself
+    if openai_api_key:
+        return hashlib.sha256(openai_api_key.encode()).hexdigest()[:16]
+    return fallback or "anonymous"
+
+
+class _Waiter(object):
+    def __init__(self, user, kind):
+        self.user = user
+        self.kind = kind
+        self.future = asyncio.get_event_loop().create_future()
+        self.queued_at = time.monotonic()
+
+
+class Scheduler(object):
+    """Admission control for LLM requests.
+
+    At most max_concurrent requests hold a slot at a time. The rest wait in
+    per-user queues: waiters of a higher priority kind always go first, and
+    users of the same priority take turns, so one user's burst can't starve
+    the others. A request is rejected right away when its user already has
+    max_queued_per_user waiting or max_queued are waiting in total.
+    """
+
+    def __init__(self, max_concurrent=SCHEDULER_MAX_CONCURRENT, max_queued=SCHEDULER_MAX_QUEUED, max_queued_per_user=SCHEDULER_MAX_QUEUED_PER_USER):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.active = 0
+        # priority -> user -> waiters, users in turn order
+        self._queues = {}
+        self._queued = 0
+        self._queued_by_user = {}
+
+    def position(self, waiter):
+        """Number of waiters that will be admitted before waiter."""
+        ahead = 0
+        priority = PRIORITIES.get(waiter.kind, 0)
+        for other_priority, users in self._queues.items():
+            if other_priority > priority:
+                ahead += sum(len(waiters) for waiters in users.values())
+            elif other_priority == priority:
+                own = users.get(waiter.user, ())
+                index = own.index(waiter) if waiter in own else 0
+                # Every other user gets a turn for each of our waiters ahead of this one
+                ahead += index + sum(min(len(waiters), index + 1) for user, waiters in users.items() if user != waiter.user)
+        return ahead
+
+    @asynccontextmanager
+    async def slot(self, user, kind, on_queued=None):
+        """Holds one of the concurrent slots for the body of the with block.
+
+        on_queued(position) is awaited when the request has to wait.
+        Raises SchedulerRejected when the queues are full.
+        """
+        start = time.monotonic()
+        if self.active < self.max_concurrent and not self._queued:
+            self.active += 1
+        else:
+            if self._queued >= self.max_queued or self._queued_by_user.get(user, 0) >= self.max_queued_per_user:
+                metrics.inc("scheduler.rejected")
+                metrics.inc(f"scheduler.rejected_{kind}")
+                raise SchedulerRejected(f"Too many requests are waiting, try again in a moment ({self._queued} queued)")
+
+            waiter = self._enqueue(user, kind)
+            try:
+                if on_queued is not None:
+                    await on_queued(self.position(waiter))
+                await waiter.future
+            except BaseException:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # The slot was handed over just as the wait was cancelled
+                    self._release()
+                else:
+                    self._remove(waiter)
+                raise
+
+        waited = time.monotonic() - start
+        metrics.observe("scheduler.wait_seconds", waited)
+        metrics.observe(f"scheduler.{kind}.wait_seconds", waited)
+        self._report()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _enqueue(self, user, kind):
+        waiter = _Waiter(user, kind)
+        users = self._queues.setdefault(PRIORITIES.get(kind, 0), OrderedDict())
+        users.setdefault(user, deque()).append(waiter)
+        self._queued += 1
+        self._queued_by_user[user] = self._queued_by_user.get(user, 0) + 1
+        metrics.inc("scheduler.queued")
+        self._report()
+        return waiter
+
+    def _remove(self, waiter):
+        users = self._queues.get(PRIORITIES.get(waiter.kind, 0), {})
+        waiters = users.get(waiter.user)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del users[waiter.user]
+        self._dequeued(waiter)
+
+    def _dequeued(self, waiter):
+        self._queued -= 1
+        self._queued_by_user[waiter.user] -= 1
+        if not self._queued_by_user[waiter.user]:
+            del self._queued_by_user[waiter.user]
+        self._report()
+
+    def _release(self):
+        self.active -= 1
+        while self.active < self.max_concurrent:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self.active += 1
+            waiter.future.set_result(None)
+        self._report()
+
+    def _next_waiter(self):
+        for priority in sorted(self._queues, reverse=True):
+            users = self._queues[priority]
+            if not users:
+                continue
+            user, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+            # The user goes to the back of the line for its next turn
+            del users[user]
+            if waiters:
+                users[user] = waiters
+            self._dequeued(waiter)
+            return waiter
+        return None
+
+    def _report(self):
+        metrics.set("scheduler.active", self.active)
+        metrics.set("scheduler.queue_depth", self._queued)
+
+
+scheduler = Scheduler()
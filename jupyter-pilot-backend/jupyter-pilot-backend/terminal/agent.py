@@ -1,13 +1,17 @@
 """Module implements an agent that uses OpenAI's APIs function enabled API."""
 import json
 import asyncio
+import logging
+import time
 from dataclasses import dataclass
 from json import JSONDecodeError
-from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-from langchain.pydantic_v1 import root_validator
+from langchain.pydantic_v1 import PrivateAttr, root_validator
 
-from langchain.agents import BaseMultiActionAgent
+from langchain.agents import AgentExecutor, BaseMultiActionAgent
+from langchain.agents.agent import ExceptionTool
+from langchain.agents.tools import InvalidTool
 from langchain.callbacks.base import BaseCallbackManager
 from langchain.callbacks.manager import Callbacks, AsyncCallbackManagerForChainRun
 from langchain.chat_models.openai import ChatOpenAI
@@ -31,13 +35,29 @@ from langchain.schema.messages import (
     SystemMessage,
 )
 from langchain.tools import BaseTool
+from langchain.utilities.asyncio import asyncio_timeout
+from langchain.utils.input import get_color_mapping
+import openai
 
+from .context import ContextBudget
+from ..metrics import metrics
+
+logger = logging.getLogger(__name__)
 
 @dataclass
 class _FunctionsAgentAction(AgentAction):
     message_log: List[BaseMessage]
 
 
+def _observation_text(observation: Any) -> str:
+    if isinstance(observation, str):
+        return observation
+    try:
+        return json.dumps(observation, ensure_ascii=False)
+    except Exception:
+        return str(observation)
+
+
 def _convert_agent_action_to_messages(
     agent_action: AgentAction, observation: str
 ) -> List[BaseMessage]:
@@ -56,7 +76,9 @@ def _convert_agent_action_to_messages(
             _create_function_message(agent_action, observation)
         ]
     else:
-        return [AIMessage(content=agent_action.log)]
+        # Like the _Exception action of a response that couldn't be parsed. There was no function call to
+        # answer with a FunctionMessage, but the model needs to know what went wrong.
+        return [AIMessage(content=agent_action.log), SystemMessage(content=_observation_text(observation))]
 
 
 def _create_function_message(
@@ -69,37 +91,114 @@ def _create_function_message(
     Returns:
         FunctionMessage that corresponds to the original tool invocation
     """
-    if not isinstance(observation, str):
-        try:
-            content = json.dumps(observation, ensure_ascii=False)
-        except Exception:
-            content = str(observation)
-    else:
-        content = observation
     return FunctionMessage(
         name=agent_action.tool,
-        content=content,
+        content=_observation_text(observation),
     )
 
 
+def _convert_multi_tool_use_to_messages(
+    steps: List[Tuple[AgentAction, str]], cap: Callable[[str], str]
+) -> List[BaseMessage]:
+    """The multi_tool_use call and one FunctionMessage with the results of all its tools, in order."""
+    results = []
+    for action, observation in steps:
+        text = _observation_text(observation)
+        capped = cap(text)
+        # Results that weren't cut stay objects, not JSON in a string
+        results.append({"name": action.tool, "result": observation if capped is text and not isinstance(observation, str) else capped})
+    content = json.dumps({"results": results}, ensure_ascii=False)
+    return steps[0][0].message_log + [FunctionMessage(name=MULTI_TOOL_USE, content=content)]
+
+
 def _format_intermediate_steps(
     intermediate_steps: List[Tuple[AgentAction, str]],
+    cap: Optional[Callable[[str], str]] = None,
 ) -> List[BaseMessage]:
     """Format intermediate steps.
+
+    Every function call of the model is answered by exactly one
+    FunctionMessage, the actions of a multi_tool_use call share one.
+
     Args:
         intermediate_steps: Steps the LLM has taken to date, along with observations
+        cap: cuts every observation before it goes into a message
     Returns:
         list of messages to send to the LLM for the next prediction
     """
+    cap = cap or (lambda text: text)
     messages = []
 
-    for intermediate_step in intermediate_steps:
-        agent_action, observation = intermediate_step
-        messages.extend(_convert_agent_action_to_messages(agent_action, observation))
+    i = 0
+    while i < len(intermediate_steps):
+        agent_action, observation = intermediate_steps[i]
+        # The other actions of the same model message have no message_log of their own
+        j = i + 1
+        while j < len(intermediate_steps) and _continues_call(intermediate_steps[j][0]):
+            j += 1
+        if _is_multi_tool_use(agent_action):
+            messages.extend(_convert_multi_tool_use_to_messages(intermediate_steps[i:j], cap))
+        else:
+            for agent_action, observation in intermediate_steps[i:j]:
+                messages.extend(_convert_agent_action_to_messages(agent_action, cap(_observation_text(observation))))
+        i = j
 
     return messages
 
 
+# Function the model calls to use several tools in one response
+MULTI_TOOL_USE = "multi_tool_use"
+
+
+def _is_multi_tool_use(agent_action: AgentAction) -> bool:
+    if not isinstance(agent_action, _FunctionsAgentAction) or not agent_action.message_log:
+        return False
+    function_call = agent_action.message_log[-1].additional_kwargs.get("function_call") or {}
+    return function_call.get("name") == MULTI_TOOL_USE
+
+
+def _continues_call(agent_action: AgentAction) -> bool:
+    return isinstance(agent_action, _FunctionsAgentAction) and not agent_action.message_log
+
+
+def _multi_tool_use_function(tools: Sequence[BaseTool]) -> dict:
+    return {
+        "name": MULTI_TOOL_USE,
+        "description": "Use several tools at once, in the given order, when no call needs the result of another, "
+                       "e.g. to read several cells. Calls that change the same notebook are done one after the other. "
+                       "The results come back together, in the order of the calls.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "tool_uses": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string", "enum": [tool.name for tool in tools]},
+                            "arguments": {"type": "object", "description": "The arguments of the tool."}
+                        },
+                        "required": ["name", "arguments"]
+                    }
+                }
+            },
+            "required": ["tool_uses"]
+        }
+    }
+
+
+def _parse_tool_input(_tool_input: dict) -> Union[str, dict]:
+    # HACK HACK HACK:
+    # The code that encodes tool input into Open AI uses a special variable
+    # name called `__arg1` to handle old style tools that do not expose a
+    # schema and expect a single string argument as an input.
+    # We unpack the argument here if it exists.
+    # Open AI does not support passing in a JSON array as an argument.
+    if "__arg1" in _tool_input:
+        return _tool_input["__arg1"]
+    return _tool_input
+
+
 def _parse_ai_message(message: BaseMessage) -> Union[List[AgentAction], AgentFinish]:
     """Parse an AI message."""
     if not isinstance(message, AIMessage):
@@ -112,29 +211,46 @@ def _parse_ai_message(message: BaseMessage) -> Union[List[AgentAction], AgentFin
 
         final_tools: List[AgentAction] = []
 
-        _tool_input = json.loads(tool["arguments"])
         function_name = tool["name"]
+        try:
+            _tool_input = json.loads(tool["arguments"])
+        except JSONDecodeError:
+            raise OutputParserException(
+                f"Could not parse the arguments of {function_name}: {tool['arguments']}",
+                observation=f"The arguments of {function_name} weren't valid JSON. "
+                            "Call it again with the arguments as a JSON object that conforms to its parameters.",
+                llm_output=tool["arguments"],
+                send_to_llm=True,
+            )
 
-        # HACK HACK HACK:
-        # The code that encodes tool input into Open AI uses a special variable
-        # name called `__arg1` to handle old style tools that do not expose a
-        # schema and expect a single string argument as an input.
-        # We unpack the argument here if it exists.
-        # Open AI does not support passing in a JSON array as an argument.
-        if "__arg1" in _tool_input:
-            tool_input = _tool_input["__arg1"]
+        if function_name in (MULTI_TOOL_USE, f"{MULTI_TOOL_USE}.parallel"):
+            # The models sometimes use their own format, {"recipient_name": "functions.x", "parameters": {...}}
+            tool_uses = [
+                (use.get("name") or use.get("recipient_name", "").split(".")[-1], use.get("arguments", use.get("parameters", {})))
+                for use in _tool_input.get("tool_uses", [])
+            ]
+            # The scratchpad repeats the call in the declared format, which its FunctionMessage is named after
+            message = AIMessage(content=message.content, additional_kwargs=dict(message.additional_kwargs, function_call={
+                "name": MULTI_TOOL_USE,
+                "arguments": json.dumps({"tool_uses": [{"name": name, "arguments": args} for name, args in tool_uses]}),
+            }))
         else:
-            tool_input = _tool_input
+            tool_uses = [(function_name, _tool_input)]
+        if not tool_uses:
+            raise OutputParserException(f"{MULTI_TOOL_USE} was called without any tool uses")
 
         content_msg = "responded: {content}\n" if message.content else "\n"
-        log = f"\nInvoking: `{function_name}` with `{tool_input}`\n{content_msg}\n"
-        _tool = _FunctionsAgentAction(
-            tool=function_name,
-            tool_input=tool_input,
-            log=log,
-            message_log=[message],
-        )
-        final_tools.append(_tool)
+        for i, (function_name, _tool_input) in enumerate(tool_uses):
+            tool_input = _parse_tool_input(_tool_input)
+            log = f"\nInvoking: `{function_name}` with `{tool_input}`\n{content_msg}\n"
+            _tool = _FunctionsAgentAction(
+                tool=function_name,
+                tool_input=tool_input,
+                log=log,
+                # The model's message goes into the scratchpad once, before the first observation
+                message_log=[message] if i == 0 else [],
+            )
+            final_tools.append(_tool)
 
         return final_tools
 
@@ -157,6 +273,18 @@ class OpenAIMultiFunctionsAgent(BaseMultiActionAgent):
     tools: Sequence[BaseTool]
     prompt: BasePromptTemplate
 
+    _functions: Optional[List[dict]] = PrivateAttr(default=None)
+    # Steps already converted to scratchpad messages, extended as a run adds steps
+    _scratchpad_steps: List[Tuple[AgentAction, str]] = PrivateAttr(default_factory=list)
+    _scratchpad: List[BaseMessage] = PrivateAttr(default_factory=list)
+    _scratchpad_tokens: List[int] = PrivateAttr(default_factory=list)
+    # Prompt messages before the scratchpad and the inputs they were formatted with
+    _prefix_inputs: tuple = PrivateAttr(default=())
+    _prefix: List[BaseMessage] = PrivateAttr(default_factory=list)
+    # Tokens of the prompt outside the scratchpad, by part
+    _fixed_tokens: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _context: Optional[ContextBudget] = PrivateAttr(default=None)
+
     def get_allowed_tools(self) -> List[str]:
         """Get allowed tools."""
         return [t.name for t in self.tools]
@@ -184,18 +312,88 @@ class OpenAIMultiFunctionsAgent(BaseMultiActionAgent):
 
     @property
     def functions(self) -> List[dict]:
-        functions = []
-        for tool in self.tools:
-            function = {
-                "name": tool.name,
-                "description": tool.description,
-                "parameters": {
-                    "type": "object",
-                    "properties": tool.args
+        # Built once, generating the schemas from tool.args every step is wasted work
+        if self._functions is None:
+            functions = []
+            for tool in self.tools:
+                function = {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": {
+                        "type": "object",
+                        "properties": tool.args
+                    }
                 }
-            }
-            functions.append(function)
-        return functions
+                functions.append(function)
+            functions.append(_multi_tool_use_function(self.tools))
+            self._functions = functions
+        return self._functions
+
+    @property
+    def context(self) -> ContextBudget:
+        if self._context is None:
+            self._context = ContextBudget(self.llm.model_name)
+            self._fixed_tokens["functions"] = self._context.count(json.dumps(self.functions))
+        return self._context
+
+    def _format_scratchpad(self, intermediate_steps: List[Tuple[AgentAction, str]]) -> List[BaseMessage]:
+        """The scratchpad messages, only converting the steps added since the last call."""
+        done = len(self._scratchpad_steps)
+        if done > len(intermediate_steps) or (done and intermediate_steps[done - 1] is not self._scratchpad_steps[-1]):
+            # Steps of another run
+            self._scratchpad_steps = []
+            self._scratchpad = []
+            self._scratchpad_tokens = []
+            done = 0
+        new_steps = intermediate_steps[done:]
+        self._scratchpad_steps.extend(new_steps)
+        # Observations are cut to their budget once, when they come in
+        messages = _format_intermediate_steps(new_steps, self.context.cap_text)
+        self._scratchpad.extend(messages)
+        self._scratchpad_tokens.extend(self.context.message_tokens(message) for message in messages)
+        if new_steps and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Agent scratchpad: %d steps, added %s", len(self._scratchpad_steps), new_steps)
+        return self._scratchpad
+
+    def _format_messages(self, agent_scratchpad: List[BaseMessage], **kwargs: Any) -> List[BaseMessage]:
+        """The prompt messages, reusing the ones before the scratchpad while the inputs are the same.
+
+        Older observations are left out of the scratchpad when the prompt
+        would not fit the context window, see ContextBudget.
+        """
+        selected_inputs = {
+            k: kwargs[k] for k in self.prompt.input_variables if k != "agent_scratchpad"
+        }
+        last = getattr(self.prompt, "messages", [None])[-1]
+        if not (isinstance(last, MessagesPlaceholder) and last.variable_name == "agent_scratchpad"):
+            full_inputs = dict(**selected_inputs, agent_scratchpad=agent_scratchpad)
+            return self.prompt.format_prompt(**full_inputs).to_messages()
+        # The inputs of a run are the same objects on every step of it
+        inputs = tuple(selected_inputs.items())
+        if len(inputs) != len(self._prefix_inputs) or any(
+            k != pk or v is not pv for (k, v), (pk, pv) in zip(inputs, self._prefix_inputs)
+        ):
+            self._prefix = self.prompt.format_prompt(**selected_inputs, agent_scratchpad=[]).to_messages()
+            self._prefix_inputs = inputs
+            memory = selected_inputs.get("memory")
+            memory = memory if isinstance(memory, list) else []
+            self._fixed_tokens["memory"] = sum(self.context.message_tokens(message) for message in memory)
+            self._fixed_tokens["instructions"] = sum(
+                self.context.message_tokens(message) for message in self._prefix
+            ) - self._fixed_tokens["memory"]
+
+        fixed = sum(self._fixed_tokens.values())
+        scratchpad, scratchpad_tokens, elided = self.context.fit(agent_scratchpad, self._scratchpad_tokens, fixed)
+        total = fixed + scratchpad_tokens
+        metrics.observe("terminal.agent_prompt_tokens", total)
+        logger.info(
+            "Agent prompt tokens: %s scratchpad=%d total=%d budget=%d elided=%d",
+            " ".join(f"{part}={tokens}" for part, tokens in self._fixed_tokens.items()),
+            scratchpad_tokens, total, self.context.budget, elided,
+        )
+        if total > self.context.budget:
+            logger.warning("Agent prompt is over the %s budget by %d tokens", self.context.model, total - self.context.budget)
+        return self._prefix + scratchpad
 
     def plan(
         self,
@@ -221,23 +419,13 @@ class OpenAIMultiFunctionsAgent(BaseMultiActionAgent):
         Returns:
             Action specifying what tool to use.
         """
-        agent_scratchpad = _format_intermediate_steps(intermediate_steps)
-        print("AGENT SCRATCHPAD", agent_scratchpad)
-        selected_inputs = {
-            k: kwargs[k] for k in self.prompt.input_variables if k != "agent_scratchpad"
-        }
-        full_inputs = dict(**selected_inputs, agent_scratchpad=agent_scratchpad)
-        prompt = self.prompt.format_prompt(**full_inputs)
-        messages = prompt.to_messages()
+        agent_scratchpad = self._format_scratchpad(intermediate_steps)
+        messages = self._format_messages(agent_scratchpad, **kwargs)
         predicted_message = await self.llm.apredict_messages(
             messages, functions=self.functions, callbacks=callbacks
         )
         agent_decision = _parse_ai_message(predicted_message)
-
-        print()
-        print("AGENT DECISION:", agent_decision)
-        print()
-        
+        logger.debug("Agent decision: %s", agent_decision)
         return agent_decision
 
     @classmethod
@@ -299,4 +487,209 @@ class OpenAIMultiFunctionsAgent(BaseMultiActionAgent):
             callback_manager=callback_manager,
             **kwargs,
         )
-    
\ No newline at end of file
+    
+
+class OrderedAgentExecutor(AgentExecutor):
+    """AgentExecutor that runs the actions of one step concurrently, except where order matters.
+
+    order_key(action) returns None for actions that can run at any time,
+    like polling a running cell, and otherwise what they act on, like a
+    notebook. Of the actions with the same key, the ones read_only(action)
+    is true for wait for the last write before them and run alongside each
+    other. The others, like edits, wait for every action on the key before
+    them, so the key's writes run in the order the model gave them.
+    Without read_only every action with a key is a write.
+    """
+
+    order_key: Optional[Callable[[AgentAction], Optional[str]]] = None
+    read_only: Optional[Callable[[AgentAction], bool]] = None
+
+    async def _atake_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Union[AgentFinish, List[Tuple[AgentAction, str]]]:
+        try:
+            intermediate_steps = self._prepare_intermediate_steps(intermediate_steps)
+
+            # Call the LLM to see what to do.
+            output = await self.agent.aplan(
+                intermediate_steps,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **inputs,
+            )
+        except OutputParserException as e:
+            if self.handle_parsing_errors is False:
+                raise e
+            text = str(e)
+            if isinstance(self.handle_parsing_errors, str):
+                observation = self.handle_parsing_errors
+            elif callable(self.handle_parsing_errors):
+                observation = self.handle_parsing_errors(e)
+            elif e.send_to_llm:
+                observation = str(e.observation)
+                text = str(e.llm_output)
+            else:
+                observation = "Invalid or incomplete response"
+            output = AgentAction("_Exception", observation, text)
+            observation = await ExceptionTool().arun(
+                output.tool_input,
+                verbose=self.verbose,
+                color=None,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **self.agent.tool_run_logging_kwargs(),
+            )
+            return [(output, observation)]
+        # If the tool chosen is the finishing tool, then we end and return.
+        if isinstance(output, AgentFinish):
+            return output
+        actions = [output] if isinstance(output, AgentAction) else output
+
+        async def _aperform_agent_action(agent_action: AgentAction) -> str:
+            if run_manager:
+                await run_manager.on_agent_action(agent_action, verbose=self.verbose, color="green")
+            tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+            if agent_action.tool in name_to_tool_map:
+                tool = name_to_tool_map[agent_action.tool]
+                if tool.return_direct:
+                    tool_run_kwargs["llm_prefix"] = ""
+                try:
+                    return await tool.arun(
+                        agent_action.tool_input,
+                        verbose=self.verbose,
+                        color=color_mapping[agent_action.tool],
+                        callbacks=run_manager.get_child() if run_manager else None,
+                        **tool_run_kwargs,
+                    )
+                except Exception as e:
+                    # The model can fix its input, the step isn't lost
+                    logger.warning("Tool %s failed: %r", agent_action.tool, e)
+                    metrics.inc("terminal.tool_errors")
+                    return f"{agent_action.tool} failed: {type(e).__name__}: {e}. Check the input and try again."
+            return await InvalidTool().arun(
+                {
+                    "requested_tool_name": agent_action.tool,
+                    "available_tool_names": list(name_to_tool_map.keys()),
+                },
+                verbose=self.verbose,
+                color=None,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **tool_run_kwargs,
+            )
+
+        async def _aperform_after(after: List[asyncio.Future], agent_action: AgentAction) -> str:
+            if after:
+                await asyncio.wait(after)
+            return await _aperform_agent_action(agent_action)
+
+        # By key, the last write and the reads started after it
+        last_write: Dict[Any, asyncio.Future] = {}
+        reads: Dict[Any, List[asyncio.Future]] = {}
+        tasks: List[asyncio.Future] = []
+        for action in actions:
+            key = self.order_key(action) if self.order_key else None
+            after = [last_write[key]] if key in last_write else []
+            if key is None:
+                task = asyncio.ensure_future(_aperform_after([], action))
+            elif self.read_only and self.read_only(action):
+                task = asyncio.ensure_future(_aperform_after(after, action))
+                reads.setdefault(key, []).append(task)
+            else:
+                task = asyncio.ensure_future(_aperform_after(after + reads.pop(key, []), action))
+                last_write[key] = task
+            tasks.append(task)
+
+        observations = await asyncio.gather(*tasks)
+        return list(zip(actions, observations))
+
+
+# Errors a retry won't fix
+NON_RETRYABLE_ERRORS = (
+    openai.error.AuthenticationError,
+    openai.error.InvalidRequestError,
+    openai.error.PermissionError,
+)
+
+
+class CheckpointedAgentExecutor(OrderedAgentExecutor):
+    """OrderedAgentExecutor that retries a failed step instead of failing the run.
+
+    The steps taken so far are the checkpoint, a step is only added to it
+    once all its observations are in. When planning or acting fails, the
+    step is tried again from the checkpoint after retry_backoff,
+    2 * retry_backoff, ... seconds, up to max_retries times per run, so
+    the steps that succeeded aren't paid for again.
+    """
+
+    max_retries: int = 3
+    retry_backoff: float = 1.0
+
+    async def _acall(
+        self,
+        inputs: Dict[str, str],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, str]:
+        """Run text through and get agent response."""
+        name_to_tool_map = {tool.name: tool for tool in self.tools}
+        color_mapping = get_color_mapping(
+            [tool.name for tool in self.tools], excluded_colors=["green"]
+        )
+        intermediate_steps: List[Tuple[AgentAction, str]] = []
+        iterations = 0
+        retries = 0
+        time_elapsed = 0.0
+        start_time = time.time()
+        async with asyncio_timeout(self.max_execution_time):
+            try:
+                while self._should_continue(iterations, time_elapsed):
+                    try:
+                        next_step_output = await self._atake_next_step(
+                            name_to_tool_map,
+                            color_mapping,
+                            inputs,
+                            # A copy, a failed step mustn't leave anything in the checkpoint
+                            list(intermediate_steps),
+                            run_manager=run_manager,
+                        )
+                    except NON_RETRYABLE_ERRORS:
+                        raise
+                    except Exception as e:
+                        if retries >= self.max_retries:
+                            raise
+                        delay = self.retry_backoff * 2 ** retries
+                        retries += 1
+                        metrics.inc("terminal.agent_retries")
+                        logger.warning("Agent step %d failed, retry %d of %d in %g s: %r",
+                                       iterations + 1, retries, self.max_retries, delay, e)
+                        await asyncio.sleep(delay)
+                        time_elapsed = time.time() - start_time
+                        continue
+                    if isinstance(next_step_output, AgentFinish):
+                        return await self._areturn(
+                            next_step_output, intermediate_steps, run_manager=run_manager
+                        )
+
+                    intermediate_steps.extend(next_step_output)
+                    if len(next_step_output) == 1:
+                        # See if tool should return directly
+                        tool_return = self._get_tool_return(next_step_output[0])
+                        if tool_return is not None:
+                            return await self._areturn(
+                                tool_return, intermediate_steps, run_manager=run_manager
+                            )
+
+                    iterations += 1
+                    time_elapsed = time.time() - start_time
+                output = self.agent.return_stopped_response(
+                    self.early_stopping_method, intermediate_steps, **inputs
+                )
+                return await self._areturn(output, intermediate_steps, run_manager=run_manager)
+            except TimeoutError:
+                # stop early when interrupted by the async timeout
+                output = self.agent.return_stopped_response(
+                    self.early_stopping_method, intermediate_steps, **inputs
+                )
+                return await self._areturn(output, intermediate_steps, run_manager=run_manager)
@@ -1,42 +1,28 @@
-import json
-from langchain.callbacks.base import BaseCallbackHandler, AsyncCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler
 from typing import List, Dict, Any, Union
 from langchain.schema import LLMResult, AgentAction
 
+from ..frames import FrameCoalescer
+
 
 class DefaultCallbackHandler(AsyncCallbackHandler):
-    def __init__(self, ws):
+    def __init__(self, ws, compact=False):
         self.terminal_ws = ws
+        self.frames = FrameCoalescer(ws.send, extra={"method": "default"}, compact=compact)
 
     async def on_llm_new_token(self, token: str, **kwargs) -> None:
-        if token:
-            reply = {
-                "message": token, 
-                "done": False,
-                "start": False,
-                "method": "default"
-            }
-            await self.terminal_ws.send(json.dumps(reply))
+        await self.frames.token(token)
 
     async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
-        reply = {
-            "done": False,
-            "start": True,
-            "method": "default"
-        }
-        await self.terminal_ws.send(json.dumps(reply))
+        await self.frames.start()
 
     async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        reply = {
-            "done": True,
-            "start": False,
-            "method": "default"
-        }
-        await self.terminal_ws.send(json.dumps(reply))
+        await self.frames.done()
     
     async def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> Any:
         print("DefaultCallbackHandler.error error: ", error)
         print("DefaultCallbackHandler.error kwargs: ", error)
+        await self.frames.flush()
 
     async def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> Any:
         print(f"DefaultCallbackHandler.on_chain_start serialized: {serialized}")
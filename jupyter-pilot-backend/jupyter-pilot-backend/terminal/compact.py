@@ -0,0 +1,94 @@
+import json
+
+from ..config import TERMINAL_COMPACT_MAX_OUTPUT_LINES, TERMINAL_COMPACT_MAX_LINE_CHARS
+from ..metrics import metrics
+from ..prompt_budget import strip_ansi
+
+# Mime types that are never worth sending to the model, only mentioned by a placeholder
+BINARY_MIME_PREFIXES = ("image/", "video/", "audio/", "application/pdf", "application/vnd.")
+
+
+def _text(value):
+    return "".join(value) if isinstance(value, list) else (value or "")
+
+
+def truncate_lines(text, max_lines=TERMINAL_COMPACT_MAX_OUTPUT_LINES, max_line_chars=TERMINAL_COMPACT_MAX_LINE_CHARS):
+    """Cuts long lines and keeps the first and last lines of long text, like the rows of a big table."""
+    lines = [line if len(line) <= max_line_chars else line[:max_line_chars] + " [...]" for line in text.split("\n")]
+    if len(lines) > max_lines:
+        tail = max_lines // 4
+        head = max_lines - tail
+        lines = lines[:head] + [f"[... {len(lines) - max_lines} lines omitted ...]"] + lines[-tail:]
+    return "\n".join(lines)
+
+
+def collapse_carriage_returns(text):
+    # Progress bars rewrite their line with \r, only the last version of each line is kept
+    return "\n".join(line.rsplit("\r", 1)[-1] for line in text.split("\n"))
+
+
+def _placeholder(mime, data):
+    size = len(_text(data)) if not isinstance(data, dict) else len(json.dumps(data))
+    return f"[{mime} output, {size // 1024} KB]"
+
+
+def compact_outputs(outputs):
+    """The outputs of a code cell as short texts: streams merged, binary data replaced by placeholders."""
+    compacted = []
+    # Index in compacted of the merged text of each stream
+    streams = {}
+    for output in outputs:
+        output_type = output.get("output_type")
+        if output_type == "stream":
+            name = output.get("name", "stdout")
+            if name in streams:
+                compacted[streams[name]] += _text(output.get("text"))
+            else:
+                streams[name] = len(compacted)
+                compacted.append(_text(output.get("text")))
+            continue
+        if output_type == "error":
+            compacted.append(f"{output.get('ename')}: {output.get('evalue')}")
+            continue
+        data = output.get("data", {})
+        text = _text(data.get("text/plain"))
+        placeholders = [_placeholder(mime, value) for mime, value in data.items() if mime.startswith(BINARY_MIME_PREFIXES)]
+        compacted.append("\n".join(part for part in [text] + placeholders if part))
+    for index in streams.values():
+        compacted[index] = collapse_carriage_returns(compacted[index])
+    return [truncate_lines(strip_ansi(text)) for text in compacted if text]
+
+
+def _raw_size(cell):
+    # The characters of the source and outputs, close enough to the JSON size without serializing the cell
+    size = len(_text(cell.get("source")))
+    for output in cell.get("outputs", []):
+        size += len(_text(output.get("text"))) + len(_text(output.get("traceback")))
+        size += sum(len(_text(value)) for value in output.get("data", {}).values() if not isinstance(value, dict))
+    return size
+
+
+def cell_text(cell):
+    """The compact text form of a compacted cell, as the model gets it."""
+    parts = [f"type: {cell['cell_type']}", "source:", cell["source"]]
+    if cell.get("outputs"):
+        parts += ["outputs:"] + cell["outputs"]
+    return "\n".join(parts)
+
+
+def compact_cell(cell):
+    """A notebook cell without ids, metadata or binary outputs, recording the characters and estimated tokens saved."""
+    compacted = {"cell_type": cell.get("cell_type"), "source": _text(cell.get("source"))}
+    if compacted["cell_type"] == "code":
+        compacted["outputs"] = compact_outputs(cell.get("outputs", []))
+    saved = _raw_size(cell) - len(cell_text(compacted))
+    metrics.inc("compact.cells")
+    metrics.observe("compact.chars_saved", saved)
+    # About four characters per token, tokenizing base64 images to count them exactly isn't worth it
+    metrics.observe("compact.tokens_saved", saved // 4)
+    return compacted
+
+
+def compact_notebook(nb):
+    """The cells of nb in compact form."""
+    return [compact_cell(cell) for cell in nb.get("cells", [])]
@@ -0,0 +1,97 @@
+from langchain.schema.messages import FunctionMessage
+
+from ..config import TERMINAL_MAX_OBSERVATION_TOKENS, TERMINAL_KEEP_OBSERVATIONS, PROMPT_MIN_COMPLETION_TOKENS
+from ..metrics import metrics
+from ..prompt_budget import context_tokens, truncate_middle
+from ..tokens import count_tokens
+
+# Tokens the chat format adds to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# The newest observations are never cut below this
+MIN_OBSERVATION_TOKENS = 200
+# Notes kept for the older observations of a run
+MAX_NOTES = 1024
+
+
+class ContextBudget(object):
+    """Keeps the terminal agent's prompt within the model's context window.
+
+    Every observation, also each one in a multi_tool_use result, is cut to
+    max_observation_tokens when it enters the scratchpad. When the prompt
+    is still over budget, the oldest observations are replaced by a short
+    note. The newest keep_recent are only cut further when that is not
+    enough, the newest one last.
+    """
+
+    def __init__(self, model, max_observation_tokens=TERMINAL_MAX_OBSERVATION_TOKENS,
+                 keep_recent=TERMINAL_KEEP_OBSERVATIONS, completion_tokens=PROMPT_MIN_COMPLETION_TOKENS):
+        self.model = model
+        self.max_observation_tokens = max_observation_tokens
+        self.keep_recent = keep_recent
+        self.budget = context_tokens(model) - completion_tokens
+        # (name, tokens, first line) -> note and its tokens, every step leaves out the same older observations again
+        self._notes = {}
+
+    def count(self, text):
+        return count_tokens(text, self.model)
+
+    def message_tokens(self, message):
+        tokens = count_tokens(message.content, self.model) + MESSAGE_OVERHEAD_TOKENS
+        function_call = message.additional_kwargs.get("function_call")
+        if function_call:
+            tokens += count_tokens(function_call.get("name", "") + function_call.get("arguments", ""), self.model)
+        return tokens
+
+    def cap_text(self, text):
+        """An observation cut to max_observation_tokens."""
+        content, omitted = truncate_middle(text, self.max_observation_tokens, self.model)
+        if omitted:
+            metrics.inc("terminal.observation_tokens_trimmed", omitted)
+        return content
+
+    def elide(self, message, tokens):
+        """A note in place of an older observation and its tokens."""
+        first_line = message.content.lstrip()[:120].split("\n", 1)[0]
+        key = (message.name, tokens, first_line)
+        cached = self._notes.get(key)
+        if cached is None:
+            note = FunctionMessage(name=message.name, content=(
+                f"[Older result of {message.name}, {tokens} tokens, left out to fit the context window. "
+                f"Call {message.name} again if you need it. It started with: {first_line}]"
+            ))
+            if len(self._notes) >= MAX_NOTES:
+                self._notes.clear()
+            cached = self._notes[key] = (note, self.message_tokens(note))
+        return cached
+
+    def fit(self, scratchpad, tokens, fixed_tokens):
+        """Returns the scratchpad messages that fit next to fixed_tokens of prompt, their tokens and how many were elided.
+
+        tokens are the message_tokens of the scratchpad messages.
+        """
+        room = self.budget - fixed_tokens
+        total = sum(tokens)
+        if total <= room:
+            return scratchpad, total, 0
+        messages = list(scratchpad)
+        observations = [i for i, message in enumerate(messages) if isinstance(message, FunctionMessage)]
+        split = max(0, len(observations) - self.keep_recent)
+        elided = 0
+        for i in observations[:split]:
+            if total <= room:
+                break
+            note, note_tokens = self.elide(messages[i], tokens[i])
+            if note_tokens < tokens[i]:
+                messages[i] = note
+                total -= tokens[i] - note_tokens
+                elided += 1
+        for i in observations[split:]:
+            if total <= room:
+                break
+            limit = max(MIN_OBSERVATION_TOKENS, tokens[i] - MESSAGE_OVERHEAD_TOKENS - (total - room))
+            content, omitted = truncate_middle(messages[i].content, limit, self.model)
+            if omitted:
+                messages[i] = FunctionMessage(name=messages[i].name, content=content)
+                total -= tokens[i] - self.message_tokens(messages[i])
+        metrics.inc("terminal.observations_elided", elided)
+        return messages, total, elided
@@ -0,0 +1,143 @@
+import asyncio
+import os.path as osp
+import queue
+import re
+import time
+import uuid
+
+from jupyter_client.asynchronous import AsyncKernelClient
+from jupyter_core.paths import jupyter_runtime_dir
+from nbformat.v4 import output_from_msg
+
+from ..config import TERMINAL_MAX_CELL_OUTPUT_CHARS, TERMINAL_MAX_CELL_OUTPUT_TOKENS, TERMINAL_START_TIMEOUT
+from ..metrics import metrics
+from ..prompt_budget import CappedText, dedupe_repeated_lines, strip_ansi, truncate_middle
+
+KERNEL_ID = re.compile(r"^[0-9a-fA-F-]+$")
+# Seconds to wait for an execute_reply once the kernel is idle again
+SHELL_REPLY_TIMEOUT = 1
+
+
+class CellExecution(object):
+    """A cell running on a kernel and what it has output so far."""
+
+    def __init__(self, path, index, code):
+        self.id = uuid.uuid4().hex[:8]
+        self.path = path
+        self.index = index
+        self.code = code
+        self.status = "running"
+        self.execution_count = None
+        # The outputs as saved in the notebook, consecutive streams merged
+        self.outputs = []
+        # What the agent sees, split like the frontend did
+        self.output = CappedText(TERMINAL_MAX_CELL_OUTPUT_CHARS)
+        self.error = CappedText(TERMINAL_MAX_CELL_OUTPUT_CHARS)
+        self.started = time.monotonic()
+        self.done = asyncio.Event()
+        self.task = None
+
+    def add(self, msg):
+        """Records an iopub message, returns the output it adds to the cell or None."""
+        msg_type = msg["msg_type"]
+        content = msg["content"]
+        if msg_type == "execute_input":
+            self.execution_count = content.get("execution_count")
+            return None
+        if msg_type not in ("stream", "display_data", "execute_result", "error"):
+            return None
+
+        output = output_from_msg(msg)
+        if msg_type == "stream":
+            (self.error if content["name"] == "stderr" else self.output).append(content["text"])
+            last = self.outputs[-1] if self.outputs else None
+            if last is not None and last.output_type == "stream" and last.name == content["name"]:
+                last.text += content["text"]
+            else:
+                self.outputs.append(output)
+        elif msg_type == "error":
+            self.status = "error"
+            self.error.append(f"{content['ename']}: {content['evalue']}\n" + "\n".join(content["traceback"]))
+            self.outputs.append(output)
+        else:
+            self.output.append(content["data"].get("text/plain", "") + "\n")
+            self.outputs.append(output)
+        return output
+
+    def observation(self, model=None):
+        """The state of the execution for the agent, outputs cut to TERMINAL_MAX_CELL_OUTPUT_TOKENS."""
+        result = {"status": self.status, "execution_count": self.execution_count}
+        for name, text in (("output", self.output.text()), ("error", self.error.text())):
+            text = dedupe_repeated_lines(strip_ansi(text))
+            result[name], _ = truncate_middle(text, TERMINAL_MAX_CELL_OUTPUT_TOKENS, model or "gpt-3.5-turbo")
+        if self.status == "running":
+            result["execution_id"] = self.id
+            result["running_seconds"] = round(time.monotonic() - self.started)
+        return result
+
+
+class KernelConnection(object):
+    """Runs code on a kernel started by the notebook server, through its connection file.
+
+    Executions on one connection run one at a time, since they share the
+    iopub channel. Raises ValueError when there is no connection file for
+    the kernel, like for a remote kernel, and connect() fails when the
+    kernel doesn't answer.
+    """
+
+    def __init__(self, kernel_id):
+        if not KERNEL_ID.match(kernel_id):
+            raise ValueError(f"Invalid kernel id {kernel_id!r}")
+        connection_file = osp.join(jupyter_runtime_dir(), f"kernel-{kernel_id}.json")
+        if not osp.exists(connection_file):
+            raise ValueError(f"No running kernel with id {kernel_id}")
+        self.kernel_id = kernel_id
+        self.client = AsyncKernelClient()
+        self.client.load_connection_file(connection_file)
+        self.client.start_channels()
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        # Messages published before iopub is subscribed would be lost
+        await self.client.wait_for_ready(timeout=TERMINAL_START_TIMEOUT)
+
+    async def _drain_shell(self, msg_id):
+        # The outputs come on iopub, the execute_reply is read only so replies don't pile up
+        while True:
+            try:
+                reply = await self.client.get_shell_msg(timeout=SHELL_REPLY_TIMEOUT)
+            except queue.Empty:
+                return
+            if reply["parent_header"].get("msg_id") == msg_id:
+                return
+
+    async def execute(self, execution, on_output=None):
+        """Runs execution.code and records its outputs until the kernel is idle again.
+
+        on_output(output) is awaited for every output as it arrives.
+        """
+        async with self.lock:
+            msg_id = self.client.execute(execution.code, store_history=True, allow_stdin=False)
+            metrics.inc("terminal.kernel_executions")
+            try:
+                while True:
+                    msg = await self.client.get_iopub_msg()
+                    if msg["parent_header"].get("msg_id") != msg_id:
+                        continue
+                    if msg["msg_type"] == "status" and msg["content"]["execution_state"] == "idle":
+                        break
+                    output = execution.add(msg)
+                    if output is not None and on_output is not None:
+                        await on_output(output)
+                await self._drain_shell(msg_id)
+            except asyncio.CancelledError:
+                execution.status = "cancelled"
+                raise
+            finally:
+                if execution.status == "running":
+                    execution.status = "ok"
+                metrics.observe("terminal.kernel_execution_seconds", time.monotonic() - execution.started)
+                execution.done.set()
+
+    def close(self):
+        self.client.stop_channels()
@@ -0,0 +1,96 @@
+from ..metrics import metrics
+
+
+class ToolMemo(object):
+    """Results of the read-only tools during one agent run, by notebook and cell index.
+
+    Entries are kept for the write count of the NotebookStore they were
+    read at. Any other write to the notebook, from another session, a cell
+    finishing in the background or a save from the browser, changes the
+    count and drops all its entries. The agent's own writes call changed(),
+    inserted() or deleted() with the count the write left, which drop the
+    cell written and the summary and move the entries of the cells after an
+    inserted or deleted cell. That count is only adopted when nothing else
+    wrote in between.
+
+    Index None stands for read_notebook_summary_tool, other indexes for
+    read_cell_tool.
+    """
+
+    def __init__(self):
+        # path -> {"writes": write count of the store, "cells": {index: result}, "summary": result}
+        self._notebooks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        self._notebooks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, path, writes):
+        entry = self._notebooks.get(path)
+        if entry is None or entry["writes"] != writes:
+            entry = self._notebooks[path] = {"writes": writes, "cells": {}, "summary": None}
+        return entry
+
+    def get(self, path, writes, index=None):
+        """The result memoized at the store's write count writes, or None."""
+        entry = self._entry(path, writes)
+        result = entry["summary"] if index is None else entry["cells"].get(index)
+        if result is None:
+            self.misses += 1
+            metrics.inc("terminal.memo_misses")
+        else:
+            self.hits += 1
+            metrics.inc("terminal.memo_hits")
+        return result
+
+    def put(self, path, writes, index, result):
+        entry = self._notebooks.get(path)
+        # The notebook was written while the result was made
+        if entry is None or entry["writes"] != writes:
+            return
+        if index is None:
+            entry["summary"] = result
+        else:
+            entry["cells"][index] = result
+
+    def _written(self, path, writes):
+        entry = self._notebooks.get(path)
+        if entry is None:
+            return None
+        if writes is not None:
+            if entry["writes"] != writes - 1:
+                # Something else wrote too, the indexes can't be trusted
+                del self._notebooks[path]
+                return None
+            entry["writes"] = writes
+        entry["summary"] = None
+        return entry
+
+    def changed(self, path, index, writes=None):
+        """The cell at index was changed, writes is None when it wasn't through the store, like a run in the browser."""
+        entry = self._written(path, writes)
+        if entry is not None:
+            if index < 0:
+                entry["cells"] = {}
+            entry["cells"].pop(index, None)
+
+    def inserted(self, path, index, writes):
+        entry = self._written(path, writes)
+        if entry is not None:
+            if index < 0:
+                entry["cells"] = {}
+            entry["cells"] = {i + 1 if i >= index else i: result for i, result in entry["cells"].items()}
+
+    def deleted(self, path, index, writes):
+        entry = self._written(path, writes)
+        if entry is not None:
+            if index < 0:
+                entry["cells"] = {}
+            entry["cells"] = {i - 1 if i > index else i: result for i, result in entry["cells"].items() if i != index}
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return f"{self.hits} hits, {self.misses} misses ({self.hits / lookups if lookups else 0:.0%} hit rate)"
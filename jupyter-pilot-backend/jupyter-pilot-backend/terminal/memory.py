@@ -0,0 +1,97 @@
+import asyncio
+import traceback
+from typing import Any, Dict, List, Optional
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.schema.messages import BaseMessage, SystemMessage, get_buffer_string
+
+from .prompt import memory_summary_template
+from ..config import TERMINAL_MEMORY_MAX_TOKENS
+from ..llm_pool import llm_pool
+from ..metrics import metrics
+from ..scheduler import scheduler, user_key
+from ..tokens import count_tokens
+
+
+class RollingSummaryMemory(BaseChatMemory):
+    """Chat memory that keeps recent turns verbatim within max_tokens.
+
+    Turns pushed out of the budget are folded into a running summary by a
+    background task, so saving a turn never waits for the model. Until a
+    fold is done its turns are still shown verbatim after the summary, and
+    if folding fails they are dropped rather than kept forever.
+    """
+
+    memory_key: str = "memory"
+    max_tokens: int = TERMINAL_MEMORY_MAX_TOKENS
+    summary: str = ""
+    # Turns waiting to be folded into the summary
+    pending: List[BaseMessage] = []
+    model: str = "gpt-3.5-turbo"
+    llm: Any = None
+    openai_api_key: Optional[str] = None
+    fold_task: Any = None
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def configure(self, llm, openai_api_key, model):
+        self.llm = llm
+        self.openai_api_key = openai_api_key
+        self.model = model
+
+    def messages(self):
+        messages = []
+        if self.summary:
+            messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{self.summary}"))
+        return messages + self.pending + self.chat_memory.messages
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        messages = self.messages()
+        if self.return_messages:
+            return {self.memory_key: messages}
+        return {self.memory_key: get_buffer_string(messages)}
+
+    def tokens(self, messages):
+        return count_tokens(get_buffer_string(messages), self.model) if messages else 0
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+        buffer = self.chat_memory.messages
+        # Oldest turns go first, the latest turn always stays
+        while len(buffer) > 2 and self.tokens(buffer) > self.max_tokens:
+            self.pending.extend(buffer[:2])
+            del buffer[:2]
+        metrics.observe("terminal.memory_tokens", self.tokens(self.messages()))
+        if self.pending and (self.fold_task is None or self.fold_task.done()):
+            self.fold_task = asyncio.ensure_future(self.fold())
+
+    async def fold(self):
+        """Folds the pending turns into the summary, one model call per batch."""
+        while self.pending:
+            batch = list(self.pending)
+            try:
+                async with scheduler.slot(user_key(self.openai_api_key), "memory"):
+                    async with llm_pool.session(self.openai_api_key):
+                        summary = await self.llm.apredict(memory_summary_template.format(
+                            summary=self.summary or "None", new_lines=get_buffer_string(batch)
+                        ))
+            except Exception:
+                traceback.print_exc()
+                metrics.inc("terminal.memory_fold_errors")
+                # Better to forget these turns than to let them pile up
+                summary = self.summary + f"\n[{len(batch)} earlier messages were dropped]"
+            if self.pending[:len(batch)] != batch:
+                # Cleared while the model was summarizing
+                return
+            self.summary = summary.strip()
+            del self.pending[:len(batch)]
+            metrics.inc("terminal.memory_folds")
+
+    def clear(self) -> None:
+        super().clear()
+        if self.fold_task is not None:
+            self.fold_task.cancel()
+        self.summary = ""
+        self.pending = []
@@ -0,0 +1,128 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import nbformat
+from nbformat.v4 import new_notebook, new_code_cell, new_markdown_cell
+from notebook.services.contents.filemanager import FileContentsManager
+
+from ..metrics import metrics
+
+
+class MyContentsManager(FileContentsManager):
+    def __init__(self, **kwargs):
+        super(MyContentsManager, self).__init__(**kwargs)
+
+    def create_notebook(self, path):
+        # Create an empty notebook
+        nb = new_notebook()
+        nb.metadata.kernelspec = {
+            "display_name": "Python 3 (ipykernel)",
+            "language": "python",
+            "name": "python3"
+        }
+        super().save({"type": "notebook", "content": nb}, path)
+
+
+class NotebookStore(object):
+    """Reads and writes the notebooks under root_dir for the agent tools.
+
+    Parsed notebooks are cached until the file's mtime or size changes, so
+    repeated reads don't parse the file again, and writes go through the
+    contents manager like saves from the browser do. The file work runs on
+    one thread of its own, which keeps it off the event loop, serializes
+    writes and keeps the contents manager's notary database on the thread
+    that opened it.
+
+    Every notebook has a write count, bumped by each write and each read
+    that parses the file again, so callers can tell whether the notebook
+    changed since they last looked, whichever session or program changed it.
+    The last_modified time of each write is kept for the open copies of the
+    notebook in JupyterLab, which would otherwise take the next save from
+    the browser for a conflict.
+    """
+
+    def __init__(self, root_dir=None):
+        kwargs = {"root_dir": root_dir} if root_dir else {}
+        self.contents_manager = MyContentsManager(**kwargs)
+        # path -> ((mtime_ns, size), notebook)
+        self._cache = {}
+        # path -> write count
+        self._writes = {}
+        # path -> ISO last_modified of the store's last write
+        self._last_modified = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="notebook-store")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def _stat(self, path):
+        stat = os.stat(self.contents_manager._get_os_path(path))
+        return stat.st_mtime_ns, stat.st_size
+
+    def _bump(self, path):
+        self._writes[path] = self._writes.get(path, 0) + 1
+
+    def _read(self, path):
+        key = self._stat(path)
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == key:
+            metrics.inc("notebook_store.hits")
+            return cached[1], self._writes[path]
+        metrics.inc("notebook_store.misses")
+        nb = nbformat.read(self.contents_manager._get_os_path(path), as_version=4)
+        # The file may have been changed by something else since it was last parsed
+        self._bump(path)
+        self._cache[path] = (key, nb)
+        return nb, self._writes[path]
+
+    def _update(self, path, change):
+        nb, _ = self._read(path)
+        self._bump(path)
+        try:
+            result = change(nb)
+            saved = self.contents_manager.save({"type": "notebook", "content": nb}, path)
+            self._cache[path] = (self._stat(path), nb)
+            self._last_modified[path] = saved["last_modified"].isoformat()
+        except BaseException:
+            # The cached copy may be half changed
+            self._cache.pop(path, None)
+            raise
+        metrics.inc("notebook_store.writes")
+        return result, self._writes[path]
+
+    def _create(self, path):
+        self.contents_manager.create_notebook(path)
+        self._cache.pop(path, None)
+        self._bump(path)
+
+    def last_modified(self, path):
+        """When the store last wrote the notebook at path, as an ISO time, or None."""
+        return self._last_modified.get(path)
+
+    async def read(self, path):
+        """The parsed notebook at path. Callers must not modify it, use update() instead."""
+        nb, _ = await self._run(self._read, path)
+        return nb
+
+    async def read_versioned(self, path):
+        """The parsed notebook at path and its write count."""
+        return await self._run(self._read, path)
+
+    async def update(self, path, change):
+        """Applies change(notebook) to the notebook at path and saves it, returns what change returned."""
+        result, _ = await self._run(self._update, path, change)
+        return result
+
+    async def update_versioned(self, path, change):
+        """Like update(), returns what change returned and the write count after the change."""
+        return await self._run(self._update, path, change)
+
+    async def create(self, path):
+        await self._run(self._create, path)
+
+
+def new_cell(cell_type, source):
+    if cell_type == "markdown":
+        return new_markdown_cell(source)
+    return new_code_cell(source)
@@ -9,6 +9,7 @@ Don't list out raw data with many rows that you get from running a Jupyter lab c
 These packages are already installed in the Jupyter lab environment: numpy, pandas, scipy, scikit-learn, yfinance, statsmodels, plotly, matplotlib and geopandas
 Always make sure to to validate the inputs to the tools.
 Don't repeat yourself!
+When you need several tool calls that don't depend on each other, like reading a few cells, make them at once with multi_tool_use.
 
 If you don't know what to do next or need input from the user, then ask a question to the user with options to choose from.
 If there are no obvious question with options to ask, just reply: "What do you want to do next?"
@@ -24,81 +25,48 @@ No text can come after the question with options.
 """
 
 
-read_notebook_summary_template = """
-Use 0-indexing.
-Given the JSON of a jupyter lab notebook you are to summarize its code, markdown and outputs of the cells on the following format:
+read_cell_summary_template = """
+Given a cell of a jupyter lab notebook you are to summarize its code or markdown and its outputs on the following format:
 
-Summary:
-cell: <index of cell>
-type: <type of cell>
 content: <a short description of each function etc>
 output: <short summary of output of cell>
-...
 
-The following is an example:
-
-JSON:
-{{
- "cells": [
-  {{
-   "cell_type": "markdown",
-   "id": "db5fd2e4-5cf2-4338-b9dd-28c177506881",
-   "metadata": {{}},
-   "source": [
-    "In this notebook we will show the buildt-in print function of python and make a little function that prints `Hello world!` to the terminal"
-   ]
-  }},
-  {{
-   "cell_type": "code",
-   "execution_count": 2,
-   "id": "37668af4-9007-467c-982f-8511a2e6c56a",
-   "metadata": {{
-    "tags": []
-   }},
-   "outputs": ["Hello world!"],
-   "source": [
-    "def hello_world():\n",
-    "    print(\"Hello world!\")\n",
-    "hello_world()"
-   ]
-  }}
- ],
- "metadata": {{
-  "kernelspec": {{
-   "display_name": "Python 3 (ipykernel)",
-   "language": "python",
-   "name": "python3"
-  }},
-  "language_info": {{
-   "codemirror_mode": {{
-    "name": "ipython",
-    "version": 3
-   }},
-   "file_extension": ".py",
-   "mimetype": "text/x-python",
-   "name": "python",
-   "nbconvert_exporter": "python",
-   "pygments_lexer": "ipython3",
-   "version": "3.10.6"
-  }}
- }},
- "nbformat": 4,
- "nbformat_minor": 5
-}}
-
-Summary:
-cell: 0
+The following are examples:
+
+Cell:
 type: markdown
+source:
+In this notebook we will show the buildt-in print function of python and make a little function that prints `Hello world!` to the terminal
+
 content: Description of notebook
 output: None
 
-cell: 1
+Cell:
 type: code
+source:
+def hello_world():
+    print("Hello world!")
+hello_world()
+outputs:
+Hello world!
+
 content: definition and function call of hello_world() function.
-output: Runs successfully."
+output: Runs successfully.
+
+Cell:
+{cell}
+
+"""
+
+
+memory_summary_template = """
+Progressively summarize the lines of conversation between a user and an AI assistant working in a jupyter lab notebook, adding onto the previous summary and returning a new summary. Keep the names of notebooks, files, variables and functions, the decisions made and what is left to do.
+
+Current summary:
+{summary}
 
-JSON:
-{notebook}
+New lines of conversation:
+{new_lines}
 
-Summary:\n
+New summary:
 """
@@ -0,0 +1,701 @@
+import json
+import asyncio
+import time
+import traceback
+import uuid
+from langchain.tools import StructuredTool
+from langchain.schema.messages import SystemMessage
+from langchain.prompts import MessagesPlaceholder, PromptTemplate, SystemMessagePromptTemplate
+from langchain.chains import LLMChain
+from typing import List, Optional, Union
+from langchain.pydantic_v1 import BaseModel, Field
+
+from .prompt import *
+from .callback import DefaultCallbackHandler
+from .agent import OpenAIMultiFunctionsAgent, CheckpointedAgentExecutor
+from .notebook import NotebookStore, new_cell
+from .summary import CellSummaryCache
+from .compact import compact_cell
+from .kernel import CellExecution, KernelConnection
+from .shell import run_shell
+from .memory import RollingSummaryMemory
+from .memo import ToolMemo
+from ..llm_pool import llm_pool
+from ..scheduler import scheduler, user_key, SchedulerRejected
+from ..frames import wants_compact
+from ..metrics import metrics
+from ..config import TERMINAL_TOOL_TIMEOUT, TERMINAL_RUN_CELL_TIMEOUT, TERMINAL_RUN_TIMEOUT, TERMINAL_CELL_WAIT, TERMINAL_EXECUTION_TTL
+from ..config import TERMINAL_AGENT_MAX_RETRIES, TERMINAL_AGENT_RETRY_BACKOFF
+from ..config import TERMINAL_SHELL_TIMEOUT, TERMINAL_SHELL_CONCURRENCY, TERMINAL_MAX_SHELL_OUTPUT_TOKENS
+from ..prompt_budget import dedupe_repeated_lines, strip_ansi, truncate_middle
+
+
+class ShellInput(BaseModel):
+    commands: Union[str, List[str]] = Field(description="Required shell command, or list of commands, to run.")
+
+class CreateNewNotebookInput(BaseModel):
+    filename: str = Field(description="Required filename of the notebook.")
+
+class ReadCellInput(BaseModel):
+    index: int = Field(description="Required index of the cell to be read.")
+    filename: Optional[str] = Field(description="Optional filename of the notebook to read from. If no filename is given, the active notebook will be used.")
+
+class InsertCodeCellInput(BaseModel):
+    index: int = Field(description="Required index of where to insert the cell.")
+    code: str = Field(description="Required code to be inserted.")
+    filename: Optional[str] = Field(description="Optional filename of the notebook to insert code into. If no filename is given, the active notebook will be used.")
+
+class InsertMarkdownCellInput(BaseModel):
+    index: int = Field(description="Required index of where to insert the cell.")
+    text: str = Field(description="Required markdown text to be inserted.")
+    filename: Optional[str] = Field(description="Optional filename of the notebook to insert markdown into. If no filename is given, the active notebook will be used.")
+
+class EditCodeCellInput(BaseModel):
+    index: int = Field(description="Required index of which cell to edit.")
+    code: str = Field(description="Required code to be inserted.")
+    filename: Optional[str] = Field(description="Optional filename of the notebook to edit. If no filename is given, the active notebook will be used.")
+
+class EditMarkdownCellInput(BaseModel):
+    index: int = Field(description="Required index of which cell to edit.")
+    text: str = Field(description="Required markdown text to be inserted.")
+    filename: Optional[str] = Field(description="Optional filename of the notebook to edit. If no filename is given, the active notebook will be used.")
+
+class RunCellInput(BaseModel):
+    index: int = Field(description="Required index of which cell to run.")
+    filename: Optional[str] = Field(description="Optional filename of the notebook to run cell in. If no filename is given, the active notebook will be used.")
+
+class PollCellExecutionInput(BaseModel):
+    execution_id: str = Field(description="Required execution_id returned by run_code_cell_tool for a cell that is still running.")
+
+class DeleteCellInput(BaseModel):
+    index: int = Field(description="Required index of which cell to delete.")
+    filename: Optional[str] = Field(description="Optional filename of the notebook to delete cell from. If no filename is given, the active notebook will be used.")
+
+class ReadNotebookInput(BaseModel):
+    filename: Optional[str] = Field(description="Optional filename of the notebook to read. If no filename is given, the active notebook will be used.")
+
+
+def build_read_cell_summary_chain(llm):
+    prompt_template = PromptTemplate(input_variables=["cell"], template=read_cell_summary_template)
+    return LLMChain(
+        llm=llm,
+        prompt=prompt_template,
+        verbose=True
+    )
+
+
+# Tool requests that may legitimately take longer than TERMINAL_TOOL_TIMEOUT
+TOOL_TIMEOUTS = {
+    "runCode": TERMINAL_RUN_CELL_TIMEOUT,
+}
+
+
+# Tools that don't change notebooks, files or kernels, the agent may run these concurrently
+READ_ONLY_TOOLS = {
+    "read_cell_tool",
+    "read_notebook_summary_tool",
+    "poll_cell_execution_tool",
+}
+
+
+# Notebook changes sent to the frontends that the store has already saved
+SAVED_DELTA_OPS = {"insert", "edit", "delete", "executed"}
+
+
+def timeout_observation(method, timeout):
+    """What the agent sees when the frontend didn't answer a tool request in time."""
+    return json.dumps({
+        "status": "timeout",
+        "request": method,
+        "timeout_seconds": timeout,
+        "message": "The notebook did not answer in time, the browser tab may be closed or the cell may still be running. "
+                   "Don't repeat the same call, tell the user what happened instead."
+    })
+
+
+class AgentSession(object):
+    """One terminal connection: its agent, chat memory and the tool calls waiting on its frontend.
+
+    Tool requests go out on the session's primary websocket with a request
+    id, and the frontend answers on the same socket with an "answer" message
+    carrying that id. Agent runs are tasks, so answers can be read while a
+    run waits for them.
+
+    Notebooks are read and edited on the server through the shared
+    NotebookStore, and cells of the active notebook run on its kernel
+    directly. Open frontends are sent the edits and outputs as
+    notebookDelta frames. Opening a notebook, and running cells of a
+    notebook whose kernel isn't known, go through the browser.
+
+    Every tool request has a deadline (TOOL_TIMEOUTS or TERMINAL_TOOL_TIMEOUT)
+    and every run one of TERMINAL_RUN_TIMEOUT, so a browser that stops
+    answering can't keep a run and its memory alive.
+    """
+
+    def __init__(self, websocket, store=None, broadcast=None, summaries=None):
+        self.id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.store = store or NotebookStore()
+        self.summaries = summaries or CellSummaryCache()
+        # Sends notebook changes to every open frontend, not just this session's
+        self.broadcast = broadcast or self.send
+        # Notebook the user has open, used when a tool gets no filename, and its kernel
+        self.active_notebook = None
+        self.active_kernel = None
+        # kernel id -> KernelConnection
+        self.kernels = {}
+        # Cells still running after run_code_cell_tool returned, by execution id
+        self.executions = {}
+        self.shell_slots = asyncio.Semaphore(TERMINAL_SHELL_CONCURRENCY)
+        # Results of the read-only tools in the current run
+        self.memo = ToolMemo()
+        self.agent = None
+        self.agent_key = None
+        self.tools = None
+        self.memory = RollingSummaryMemory(memory_key="memory", return_messages=True)
+        # Tool calls waiting for the frontend: request id -> (method, future)
+        self.pending = {}
+        self.next_request_id = 0
+        self.tasks = set()
+        # Messages are still handled one at a time, in the order they arrive
+        self.lock = asyncio.Lock()
+
+    def dispatch(self, data):
+        """Handles a message from the primary websocket without blocking the read loop."""
+        if data.get("method") == "answer":
+            self.answer(data.get("request_id"), data.get("answer"), data.get("answer_to"))
+            return
+
+        async def run():
+            async with self.lock:
+                await self.handle_message(data)
+
+        task = asyncio.ensure_future(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, frame):
+        await self.websocket.send(json.dumps(frame))
+
+    def notebook_path(self, filename):
+        path = filename or self.active_notebook
+        if not path:
+            raise ValueError("No notebook is open, enter the filename of the notebook.")
+        return path
+
+    def action_order_key(self, action):
+        """Actions on the same notebook are ordered by action_read_only, shell commands run in order of their own."""
+        if action.tool == "poll_cell_execution_tool":
+            # Waits on a cell started in an earlier step
+            return None
+        if action.tool == "shell_tool":
+            return "shell"
+        tool_input = action.tool_input if isinstance(action.tool_input, dict) else {}
+        return tool_input.get("filename") or self.active_notebook or ""
+
+    def action_read_only(self, action):
+        """Reads wait for the earlier writes to their notebook, not for other reads."""
+        return action.tool in READ_ONLY_TOOLS
+
+    async def notify_change(self, path, op, index, cell=None, **fields):
+        """Tells open frontends about a change the agent made, so they don't have to reload the notebook.
+
+        The changes that were saved carry the notebook's new last_modified,
+        so JupyterLab doesn't take the user's next save for a conflict.
+        """
+        if op in SAVED_DELTA_OPS:
+            fields["last_modified"] = self.store.last_modified(path)
+        await self.broadcast(dict({"method": "notebookDelta", "path": path, "op": op, "index": index, "cell": cell}, **fields))
+
+    async def ask_frontend(self, request):
+        """Sends a tool request to this session's frontend and waits for its answer.
+
+        Returns a timeout observation as the answer's message when the
+        frontend doesn't answer before the request's deadline.
+        """
+        method = request["method"]
+        timeout = TOOL_TIMEOUTS.get(method, TERMINAL_TOOL_TIMEOUT)
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = (method, future)
+        start = time.monotonic()
+        try:
+            await self.websocket.send(json.dumps(dict(request, request_id=request_id)))
+            answer = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            print(f"AgentSession {self.id}: {method} request {request_id} timed out after {timeout} s")
+            metrics.inc("terminal.tool_timeouts")
+            metrics.inc(f"terminal.{method}.timeouts")
+            return {"message": timeout_observation(method, timeout)}
+        finally:
+            self.pending.pop(request_id, None)
+        elapsed = time.monotonic() - start
+        metrics.observe("terminal.tool_rtt_seconds", elapsed)
+        metrics.observe(f"terminal.{method}.rtt_seconds", elapsed)
+        return answer
+
+    def answer(self, request_id, data, method=None):
+        if request_id is None:
+            # Answers from the secondary port only know their method, take the oldest such request
+            request_id = next((rid for rid, (pending_method, _) in self.pending.items() if pending_method == method), None)
+        _, future = self.pending.get(request_id, (None, None))
+        if future is None or future.done():
+            print(f"AgentSession {self.id}: no pending request {request_id} ({method}) for answer")
+            return
+        future.set_result(data)
+
+    def close(self):
+        # Stop runs and unblock tools still waiting on a frontend that is gone
+        for task in list(self.tasks):
+            task.cancel()
+        for kernel in self.kernels.values():
+            kernel.close()
+        for method, future in self.pending.values():
+            if not future.done():
+                future.set_result({"message": "ERROR: the terminal was closed before answering."})
+
+    def get_tools(self):
+        if self.tools is None:
+            self.tools = [
+                self.get_shell_tool(),
+                self.get_create_new_notebook_tool(),
+                self.get_read_cell_tool(),
+                self.get_insert_code_cell_tool(),
+                self.get_insert_markdown_cell_tool(),
+                self.get_edit_code_cell_tool(),
+                self.get_edit_markdown_cell_tool(),
+                self.get_run_code_cell_tool(),
+                self.get_poll_cell_execution_tool(),
+                self.get_delete_cell_tool(),
+                self.get_read_notebook_summary_tool()
+            ]
+        return self.tools
+
+    def create_agent(self, model, temp, openai_api_key):
+        """Builds the agent, or keeps the current one when model, temperature and key are unchanged."""
+        model += "-0613" # Better functions calling model
+        agent_key = (model, temp, openai_api_key)
+        if self.agent is not None and self.agent_key == agent_key:
+            metrics.inc("terminal.agent_reused")
+            return
+        metrics.inc("terminal.agent_built")
+        self.agent_key = agent_key
+        self.model = model
+        self.temp = temp
+        self.openai_api_key = openai_api_key
+
+        llm = llm_pool.get_llm(openai_api_key, model, temp)
+        tools = self.get_tools()
+        self.memory.configure(llm_pool.get_llm(openai_api_key, model, 0), openai_api_key, model)
+
+        extra_prompt_messages = [
+            SystemMessagePromptTemplate.from_template("The current time and date is {current_time}"),
+            MessagesPlaceholder(variable_name="memory"),
+            SystemMessage(content="Let's work the following out in a step by step way to be sure we have the right answer. Let's first understand the problem and devise a plan to solve the problem.")
+        ]
+
+        prompt = OpenAIMultiFunctionsAgent.create_prompt(system_message=SystemMessage(content=agent_system_message), extra_prompt_messages=extra_prompt_messages)
+        # Filled in every time the prompt is formatted, so the agent can be reused across turns
+        prompt = prompt.partial(current_time=lambda: time.strftime('%c'))
+        agent = OpenAIMultiFunctionsAgent(
+            llm=llm,
+            tools=tools,
+            prompt=prompt,
+            max_iterations=15, 
+            verbose=True,
+            handle_parsing_errors=True
+        )
+        self.agent = CheckpointedAgentExecutor.from_agent_and_tools(
+            agent=agent,
+            tools=tools,
+            return_intermediate_steps=False,
+            handle_parsing_errors=True,
+            memory=self.memory,
+            order_key=self.action_order_key,
+            read_only=self.action_read_only,
+            max_retries=TERMINAL_AGENT_MAX_RETRIES,
+            retry_backoff=TERMINAL_AGENT_RETRY_BACKOFF
+        )
+
+    async def handle_message(self, data):
+        if data.get("method") == "clear":
+            # Cleared in place, the cached agent holds on to this memory
+            self.memory.clear()
+        else:
+            if data.get("notebook_path"):
+                self.active_notebook = data["notebook_path"]
+                self.active_kernel = data.get("kernel_id")
+            self.create_agent(data["model"], data["temp"], data["openai_api_key"])
+
+            async def send_queued(position):
+                await self.websocket.send(json.dumps({"method": "queued", "position": position}))
+
+            async def run():
+                async with scheduler.slot(user_key(self.openai_api_key), "agent", on_queued=send_queued):
+                    async with llm_pool.session(self.openai_api_key):
+                        self.memo.reset()
+                        try:
+                            await self.agent.arun(data["message"], callbacks=[DefaultCallbackHandler(self.websocket, compact=wants_compact(data))])
+                        finally:
+                            print(f"AgentSession {self.id}: tool memo {self.memo.report()}")
+
+            # Failed steps are retried inside the run, under the same deadline
+            try:
+                await asyncio.wait_for(run(), TERMINAL_RUN_TIMEOUT)
+            except SchedulerRejected as e:
+                await self.websocket.send(json.dumps({"method": "rejected", "message": str(e)}))
+            except asyncio.TimeoutError:
+                msg = f"The agent was stopped after running for {TERMINAL_RUN_TIMEOUT:g} s."
+                self.memory.save_context({"input": data["message"]}, {"output": msg})
+                metrics.inc("terminal.run_timeouts")
+                await self.websocket.send(json.dumps({"method": "systemError", "message": msg}))
+            except Exception as e:
+                msg = "Server error encountered during execution: " + str(e)
+                self.memory.save_context({"input": data["message"]}, {"output": msg})
+                traceback.print_exc()
+                response = {
+                    "method": "systemError",
+                    "message": msg
+                }
+                await self.websocket.send(json.dumps(response))
+
+    def get_shell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda commands: self.shell_tool(commands),
+            coroutine=lambda commands: self.shell_tool(commands),
+            name="shell_tool",
+            description=f"""Run shell commands on this machine, in the notebook directory. Commands are stopped after {TERMINAL_SHELL_TIMEOUT:g} seconds and can't read input.
+You should enter the commands to run.""",
+            args_schema=ShellInput
+        )
+
+    async def shell_tool(self, commands):
+        if isinstance(commands, list):
+            commands = ";".join(commands)
+
+        async def on_output(text):
+            await self.send({"method": "shellOutput", "text": text})
+
+        try:
+            async with self.shell_slots:
+                result = await run_shell(commands, TERMINAL_SHELL_TIMEOUT, self.store.contents_manager.root_dir, on_output)
+        except Exception as e:
+            traceback.print_exc()
+            return "ERROR: " + str(e)
+
+        output = dedupe_repeated_lines(strip_ansi(result.output.text()))
+        output, _ = truncate_middle(output, TERMINAL_MAX_SHELL_OUTPUT_TOKENS, self.model)
+        if result.timed_out:
+            return f"ERROR: The command was stopped after {TERMINAL_SHELL_TIMEOUT:g} seconds. Output so far:\n{output}"
+        if result.returncode:
+            return f"{output}\n[exit code {result.returncode}]"
+        return output
+
+    def get_create_new_notebook_tool(self):
+        return StructuredTool.from_function(
+            func=lambda filename: self.create_new_notebook_tool(filename),
+            coroutine=lambda filename: self.create_new_notebook_tool(filename),
+            name="create_new_notebook_tool",
+            description="""Useful when you want to start a new project with a Jupyter notebook and set it as the active notebook.
+You should enter the filename (remember to use ".ipynb" extension) of the notebook.""",
+            args_schema=CreateNewNotebookInput
+        )
+
+    async def create_new_notebook_tool(self, filename):
+        try:
+            await self.store.create(filename)
+            self.active_notebook = filename
+
+            request = {
+                "request": {"filename": filename}, 
+                "start": True, 
+                "method": "openNotebook"
+            }
+            answer = await self.ask_frontend(request)
+            return answer["message"]
+        except Exception as e:
+            traceback.print_exc()
+            return f"Notebook with filename: {filename} failed to be created. Ask user for what to do next."
+
+    def get_read_cell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda index, filename=None: self.read_cell_tool(index, filename),
+            coroutine=lambda index, filename=None: self.read_cell_tool(index, filename),
+            name="read_cell_tool",
+            description="""Useful when you want to read the conent of a cell of a Jupyter notebook. If no filename is given the active notebook will be used.
+This tool cannot read files, only cells from a jupyter notebook.
+You should enter the index of the cell you want to read.""",
+            args_schema=ReadCellInput
+        )
+
+    async def read_cell_tool(self, index, filename):
+        try:
+            path = self.notebook_path(filename)
+            nb, writes = await self.store.read_versioned(path)
+            if index < 0:
+                index += len(nb.cells)
+            result = self.memo.get(path, writes, index)
+            if result is None:
+                cell = compact_cell(nb.cells[index])
+                result = {"cell_type": cell["cell_type"], "content": cell["source"], "outputs": cell.get("outputs", [])}
+                self.memo.put(path, writes, index, result)
+            return result
+        except Exception as e:
+            return "ERROR: " + str(e)
+
+    def get_insert_code_cell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda code, index, filename=None: self.insert_code_cell_tool(code, index, filename),
+            coroutine=lambda code, index, filename=None: self.insert_code_cell_tool(code, index, filename),
+            name="insert_code_cell_tool",
+            description="""Useful when you want to insert a code cell in a Jupyter notebook. If no filename is given the active notebook will be used.
+You should enter code and index of the cell you want to insert.""",
+            args_schema=InsertCodeCellInput
+        )
+
+    async def insert_code_cell_tool(self, code, index, filename):
+        try:
+            path = self.notebook_path(filename)
+            _, writes = await self.store.update_versioned(path, lambda nb: nb.cells.insert(index, new_cell("code", code)))
+            self.memo.inserted(path, index, writes)
+            await self.notify_change(path, "insert", index, {"cell_type": "code", "source": code})
+            return f"Inserted code at index {index} successfully"
+        except Exception as e:
+            return "ERROR: " + str(e)
+
+    def get_insert_markdown_cell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda text, index, filename=None: self.insert_markdown_cell_tool(text, index, filename),
+            coroutine=lambda text, index, filename=None: self.insert_markdown_cell_tool(text, index, filename),
+            name="insert_markdown_cell_tool",
+            description="""Useful when you want to insert a mardkown cell in a Jupyter notebook. If no filename is given the active notebook will be used.
+You should enter markdown text and index of the cell you want to insert.""",
+            args_schema=InsertMarkdownCellInput
+        )
+    
+    async def insert_markdown_cell_tool(self, text, index, filename):
+        try:
+            path = self.notebook_path(filename)
+            _, writes = await self.store.update_versioned(path, lambda nb: nb.cells.insert(index, new_cell("markdown", text)))
+            self.memo.inserted(path, index, writes)
+            await self.notify_change(path, "insert", index, {"cell_type": "markdown", "source": text})
+            return f"Inserted markdown text at index {index} successfully"
+        except Exception as e:
+            return "ERROR: " + str(e)
+
+    def get_edit_code_cell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda code, index, filename=None: self.edit_code_cell_tool(code, index, filename),
+            coroutine=lambda code, index, filename=None: self.edit_code_cell_tool(code, index, filename),
+            name="edit_code_cell_tool",
+            description="""Useful when you want to edit a code cell in a Jupyter notebook. If no filename is given the active notebook will be used.
+You must always enter the code and the index of the cell to be edited.
+You should enter the code to be inserted and the index of the cell you want to edit.""",
+            args_schema=EditCodeCellInput
+        )
+
+    async def edit_code_cell_tool(self, code, index, filename):
+        return await self.edit_cell(index, filename, "code", code)
+
+    def get_edit_markdown_cell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda text, index, filename=None: self.edit_markdown_cell_tool(text, index, filename),
+            coroutine=lambda text, index, filename=None: self.edit_markdown_cell_tool(text, index, filename),
+            name="edit_markdown_cell_tool",
+            description="""Useful when you want to edit a markdown cell in a Jupyter notebook. If no filename is given the active notebook will be used.
+You must always enter the markdown text and the index of the cell to be edited.
+You should enter the markdown text to be inserted and the index of the cell you want to edit.""",
+            args_schema=EditMarkdownCellInput
+        )
+
+    async def edit_markdown_cell_tool(self, text, index, filename):
+        return await self.edit_cell(index, filename, "markdown", text)
+
+    async def edit_cell(self, index, filename, cell_type, source):
+        try:
+            path = self.notebook_path(filename)
+
+            def edit(nb):
+                cell = nb.cells[index]
+                if cell.cell_type != cell_type:
+                    return False
+                cell.source = source
+                return True
+
+            edited, writes = await self.store.update_versioned(path, edit)
+            self.memo.changed(path, index, writes)
+            if not edited:
+                return f"ERROR: Cell with index {index} is not a {cell_type} cell."
+            await self.notify_change(path, "edit", index, {"cell_type": cell_type, "source": source})
+            return f"Edited {cell_type} cell at index {index} successfully."
+        except Exception as e:
+            return "ERROR: " + str(e)
+
+    def get_run_code_cell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda index, filename=None: self.run_code_cell_tool(index, filename),
+            coroutine=lambda index, filename=None: self.run_code_cell_tool(index, filename),
+            name="run_code_cell_tool",
+            description=f"""Useful when you want to run a code cell in a Jupyter notebook. If no filename is given the active notebook will be used.
+The tool outputs the result of the execution. You should enter the index of the cell you want to run.
+If the cell is still running after {TERMINAL_CELL_WAIT:g} seconds the status is "running" and you get an execution_id to use with poll_cell_execution_tool.""",
+            args_schema=RunCellInput
+        )
+
+    async def run_code_cell_tool(self, index, filename):
+        try:
+            path = self.notebook_path(filename)
+            if self.active_kernel is None or path != self.active_notebook:
+                return await self.run_code_cell_in_browser(index, filename)
+
+            try:
+                kernel = await self.kernel_connection()
+            except Exception as e:
+                # Like a remote kernel or another runtime dir, the browser can still run the cell
+                print(f"AgentSession {self.id}: can't connect to kernel {self.active_kernel}, running in the browser: {e!r}")
+                return await self.run_code_cell_in_browser(index, filename)
+
+            nb = await self.store.read(path)
+            cell = nb.cells[index]
+            if cell.cell_type != "code":
+                return f"The cell with index {index} is not a code cell."
+            execution = CellExecution(path, index, cell.source)
+            self.start_execution(kernel, execution)
+            return await self.wait_for_execution(execution)
+        except Exception as e:
+            traceback.print_exc()
+            return "ERROR: " + str(e)
+
+    async def run_code_cell_in_browser(self, index, filename):
+        request = {
+            "request": {"index": index, "filename": filename}, 
+            "start": True,
+            "method": "runCode",
+        }
+        answer = await self.ask_frontend(request)
+        self.memo.changed(self.notebook_path(filename), index)
+        return answer["message"]
+
+    async def kernel_connection(self):
+        """The connection to the active kernel, kept once it has connected."""
+        kernel = self.kernels.get(self.active_kernel)
+        if kernel is None:
+            kernel = KernelConnection(self.active_kernel)
+            try:
+                await kernel.connect()
+            except BaseException:
+                kernel.close()
+                raise
+            self.kernels[self.active_kernel] = kernel
+        return kernel
+
+    def start_execution(self, kernel, execution):
+        self.executions[execution.id] = execution
+        execution.task = asyncio.ensure_future(self.execute(kernel, execution))
+        self.tasks.add(execution.task)
+        execution.task.add_done_callback(self.tasks.discard)
+        execution.task.add_done_callback(lambda _: self.forget_execution(execution))
+
+    def forget_execution(self, execution):
+        # A finished execution is kept a while for a poll_cell_execution_tool that comes later
+        asyncio.get_event_loop().call_later(TERMINAL_EXECUTION_TTL, self.executions.pop, execution.id, None)
+
+    async def execute(self, kernel, execution):
+        path, index = execution.path, execution.index
+        try:
+            await self.notify_change(path, "clearOutputs", index)
+
+            async def on_output(output):
+                await self.notify_change(path, "output", index, output=output)
+
+            await kernel.execute(execution, on_output)
+
+            def save_outputs(nb):
+                cell = nb.cells[index] if index < len(nb.cells) else None
+                # Cells may have moved while a long cell was running
+                if cell is None or cell.source != execution.code:
+                    return False
+                cell.outputs = execution.outputs
+                cell.execution_count = execution.execution_count
+                return True
+
+            saved, writes = await self.store.update_versioned(path, save_outputs)
+            self.memo.changed(path, index, writes)
+            if saved:
+                await self.notify_change(path, "executed", index, execution_count=execution.execution_count)
+        except Exception as e:
+            traceback.print_exc()
+            execution.status = "error"
+            execution.error.append("ERROR: " + str(e))
+            execution.done.set()
+
+    async def wait_for_execution(self, execution):
+        try:
+            await asyncio.wait_for(execution.done.wait(), TERMINAL_CELL_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        if execution.done.is_set():
+            self.executions.pop(execution.id, None)
+        return execution.observation(self.model)
+
+    def get_poll_cell_execution_tool(self):
+        return StructuredTool.from_function(
+            func=lambda execution_id: self.poll_cell_execution_tool(execution_id),
+            coroutine=lambda execution_id: self.poll_cell_execution_tool(execution_id),
+            name="poll_cell_execution_tool",
+            description=f"""Useful when run_code_cell_tool said a cell is still running. Waits up to {TERMINAL_CELL_WAIT:g} seconds for the cell to finish and outputs its status and output so far.
+You should enter the execution_id run_code_cell_tool returned.""",
+            args_schema=PollCellExecutionInput
+        )
+
+    async def poll_cell_execution_tool(self, execution_id):
+        execution = self.executions.get(execution_id)
+        if execution is None:
+            return f"ERROR: No running cell with execution_id {execution_id}."
+        return await self.wait_for_execution(execution)
+
+    def get_delete_cell_tool(self):
+        return StructuredTool.from_function(
+            func=lambda index, filename=None: self.delete_cell_tool(index, filename),
+            coroutine=lambda index, filename=None: self.delete_cell_tool(index, filename),
+            name="delete_cell_tool",
+            description="""Useful when you want to delete a code cell in a Jupyter notebook. If no filename is given the active notebook will be used.
+This tool cannot delete files! You should enter the index of the cell you want to delete.""",
+            args_schema=DeleteCellInput
+        )
+
+    async def delete_cell_tool(self, index, filename):
+        try:
+            path = self.notebook_path(filename)
+            _, writes = await self.store.update_versioned(path, lambda nb: nb.cells.pop(index))
+            self.memo.deleted(path, index, writes)
+            await self.notify_change(path, "delete", index)
+            return f"Deleted cell at index {index} successfully"
+        except Exception as e:
+            traceback.print_exc()
+            return "ERROR: " + str(e)
+
+    def get_read_notebook_summary_tool(self):
+        return StructuredTool.from_function(
+            func=lambda filename=None: self.read_notebook_summary_tool(filename),
+            coroutine=lambda filename=None: self.read_notebook_summary_tool(filename),
+            name="read_notebook_summary_tool",
+            description="""Useful when you want to get a summary of the whole notebook to see whats in each cell and its outputs.
+If you give no filename the active notebook will be used.You should enter the filename of the notebook.""",
+            args_schema=ReadNotebookInput
+        )
+
+    async def read_notebook_summary_tool(self, filename):
+        try:
+            path = self.notebook_path(filename)
+            nb, writes = await self.store.read_versioned(path)
+            summary = self.memo.get(path, writes)
+            if summary is None:
+                chain = llm_pool.get_chain(self.openai_api_key, self.model, self.temp, "read_cell_summary", build_read_cell_summary_chain)
+                summary = await self.summaries.summarize(nb, chain, self.model, self.openai_api_key)
+                self.memo.put(path, writes, None, summary)
+            return summary
+        except Exception as e:
+            traceback.print_exc()
+            return "ERROR: " + str(e)
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import signal
+import time
+
+from ..config import TERMINAL_MAX_SHELL_OUTPUT_CHARS
+from ..metrics import metrics
+from ..prompt_budget import CappedText
+
+
+class ShellResult(object):
+
+    def __init__(self):
+        self.output = CappedText(TERMINAL_MAX_SHELL_OUTPUT_CHARS)
+        self.returncode = None
+        self.timed_out = False
+
+
+def _kill(process):
+    # The command runs in a process group of its own, so its children go too
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_shell(command, timeout, cwd=None, on_output=None):
+    """Runs command in a shell without blocking the event loop.
+
+    stdout and stderr are read together as they arrive and passed to
+    on_output(text). The command is killed when it runs longer than
+    timeout seconds or the caller is cancelled.
+    """
+    result = ShellResult()
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_shell(
+        command, cwd=cwd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT, start_new_session=True
+    )
+    metrics.inc("terminal.shell_commands")
+
+    async def read():
+        while True:
+            chunk = await process.stdout.read(4096)
+            if not chunk:
+                break
+            text = chunk.decode(errors="replace")
+            result.output.append(text)
+            if on_output is not None:
+                await on_output(text)
+        await process.wait()
+
+    try:
+        await asyncio.wait_for(read(), timeout)
+    except asyncio.TimeoutError:
+        result.timed_out = True
+        metrics.inc("terminal.shell_timeouts")
+    finally:
+        if process.returncode is None:
+            _kill(process)
+            await process.wait()
+        metrics.observe("terminal.shell_seconds", time.monotonic() - start)
+    result.returncode = process.returncode
+    return result
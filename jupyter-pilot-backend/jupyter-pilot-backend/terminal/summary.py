@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+from .compact import cell_text, compact_notebook
+from ..config import TERMINAL_SUMMARY_CACHE_SIZE, TERMINAL_SUMMARY_CONCURRENCY
+from ..metrics import metrics
+
+
+class CellSummaryCache(object):
+    """Summaries of single notebook cells, by model and hash of the cell's compact text.
+
+    A notebook summary only asks the model about cells it hasn't seen
+    before, at most TERMINAL_SUMMARY_CONCURRENCY at a time. Concurrent
+    requests for the same cell with the same API key share one call, so
+    nobody's summaries are billed to another user's key, and a caller that
+    is cancelled doesn't cancel the call for the others waiting on it. Least
+    recently used entries are dropped past max_entries.
+    """
+
+    def __init__(self, max_entries=TERMINAL_SUMMARY_CACHE_SIZE, concurrency=TERMINAL_SUMMARY_CONCURRENCY):
+        self.max_entries = max_entries
+        self.concurrency = concurrency
+        self._summaries = OrderedDict()
+        # (api key, model, hash) -> future of the summary
+        self._inflight = {}
+
+    async def _summarize_cell(self, key, cell, chain, slots):
+        async with slots:
+            summary = await chain.arun(cell=cell)
+        summary = summary.strip()
+        self._summaries[key] = summary
+        if len(self._summaries) > self.max_entries:
+            self._summaries.popitem(last=False)
+        return summary
+
+    async def summarize(self, nb, chain, model, api_key=None):
+        """The summary of notebook nb, in the format of one "cell:" block per cell."""
+        cells = compact_notebook(nb)
+        slots = asyncio.Semaphore(self.concurrency)
+        jobs = []
+        hits = 0
+        for cell in cells:
+            if not cell["source"].strip():
+                jobs.append(None)
+                continue
+            text = cell_text(cell)
+            key = (model, hashlib.sha256(text.encode()).hexdigest())
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                jobs.append(self._summaries[key])
+                hits += 1
+                continue
+            inflight_key = (api_key,) + key
+            future = self._inflight.get(inflight_key)
+            if future is None:
+                future = asyncio.ensure_future(self._summarize_cell(key, text, chain, slots))
+                self._inflight[inflight_key] = future
+                future.add_done_callback(lambda _, inflight_key=inflight_key: self._inflight.pop(inflight_key, None))
+            jobs.append(future)
+
+        pending = [job for job in jobs if asyncio.isfuture(job)]
+        metrics.inc("notebook_summary.cell_hits", hits)
+        metrics.inc("notebook_summary.cell_misses", len(pending))
+        # Shielded, the calls may be shared with other sessions
+        results = dict(zip(map(id, pending), await asyncio.gather(*map(asyncio.shield, pending)))) if pending else {}
+
+        blocks = []
+        for index, (cell, job) in enumerate(zip(cells, jobs)):
+            if job is None:
+                summary = "content: Empty cell\noutput: None"
+            elif asyncio.isfuture(job):
+                summary = results[id(job)]
+            else:
+                summary = job
+            blocks.append(f"cell: {index}\ntype: {cell['cell_type']}\n{summary}")
+        return "Summary:\n" + "\n\n".join(blocks)
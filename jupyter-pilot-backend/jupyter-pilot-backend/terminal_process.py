@@ -0,0 +1,79 @@
+import asyncio
+import json
+import multiprocessing
+import time
+
+import tornado.web
+from notebook.base.handlers import IPythonHandler
+
+from .config import TERMINAL_SECONDARY_PORT, TERMINAL_START_TIMEOUT
+from .metrics import metrics
+
+
+def _run_terminal(root_dir):
+    # Runs in the child process, which is the only one that imports the agent stack
+    from .terminal.terminal import Terminal
+    asyncio.run(Terminal(root_dir=root_dir).start())
+
+
+class TerminalProcess(object):
+    """The terminal backend process, started once on demand.
+
+    The process is spawned rather than forked so it doesn't inherit the
+    server's running IOLoop, and ensure_started() waits until its last
+    websocket port accepts connections.
+    """
+
+    def __init__(self, port=TERMINAL_SECONDARY_PORT, timeout=TERMINAL_START_TIMEOUT):
+        self.port = port
+        self.timeout = timeout
+        # The notebook directory of the server, the agent reads and writes notebooks relative to it
+        self.root_dir = None
+        self.process = None
+        self._ready = None
+
+    def start(self):
+        if self.process is None or not self.process.is_alive():
+            self.process = multiprocessing.get_context("spawn").Process(target=_run_terminal, args=(self.root_dir,), daemon=True)
+            self.process.start()
+            self._ready = None
+            metrics.inc("terminal.process_starts")
+
+    async def ensure_started(self):
+        self.start()
+        if self._ready is None:
+            self._ready = asyncio.ensure_future(self._wait_until_listening())
+        return await asyncio.shield(self._ready)
+
+    async def _wait_until_listening(self):
+        start = time.monotonic()
+        while time.monotonic() - start < self.timeout:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                writer.close()
+                metrics.observe("terminal.start_seconds", time.monotonic() - start)
+                return True
+            except OSError:
+                if not self.process.is_alive():
+                    break
+                await asyncio.sleep(0.1)
+        print(f"TerminalProcess: terminal backend not listening on port {self.port}")
+        self._ready = None
+        return False
+
+
+terminal_process = TerminalProcess()
+
+
+class TerminalHandler(IPythonHandler):
+    """Starts the terminal backend if needed and reports whether it is up.
+
+    Starting it is a POST from a logged in user, so the server's XSRF check
+    keeps other pages from starting processes.
+    """
+
+    @tornado.web.authenticated
+    async def post(self):
+        ready = await terminal_process.ensure_started()
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ready": ready}))
@@ -0,0 +1,65 @@
+import sys
+import threading
+
+# model -> encoding, or None when token counts are estimated
+_encodings = {}
+# encoding name -> encoding or None, so models sharing an encoding load it once
+_by_name = {}
+_lock = threading.Lock()
+
+
+def _encoding_name(tiktoken, model):
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except (KeyError, AttributeError):
+        return "cl100k_base"
+
+
+def get_encoding(model="gpt-3.5-turbo", load=True):
+    """Returns the tiktoken encoding for model, or None when it can't be loaded.
+
+    tiktoken downloads its BPE files on first use, which blocks, so
+    warm_encoding() loads them on a worker thread at startup. With
+    load=False nothing is imported or downloaded, None is returned until
+    the encoding has been loaded. An offline server falls back to
+    estimating, and a failed encoding isn't tried again.
+    """
+    if model in _encodings:
+        return _encodings[model]
+    if not load:
+        tiktoken = sys.modules.get("tiktoken")
+        name = _encoding_name(tiktoken, model) if tiktoken is not None else None
+        return _by_name.get(name)
+    with _lock:
+        if model not in _encodings:
+            try:
+                import tiktoken
+            except ImportError as e:
+                print(f"tokens: tiktoken unavailable, estimating token counts: {e}")
+                _encodings[model] = None
+                return None
+            name = _encoding_name(tiktoken, model)
+            if name not in _by_name:
+                try:
+                    _by_name[name] = tiktoken.get_encoding(name)
+                except Exception as e:
+                    print(f"tokens: tiktoken encoding {name} unavailable, estimating token counts: {e}")
+                    _by_name[name] = None
+            _encodings[model] = _by_name[name]
+        return _encodings[model]
+
+
+def warm_encoding(model="gpt-3.5-turbo"):
+    """Loads the encoding for model, meant to run on a worker thread."""
+    get_encoding(model)
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    if not text:
+        return 0
+    # Never downloads on the caller's thread, counts are estimated until warm_encoding() is done
+    encoding = get_encoding(model, load=False)
+    if encoding is None:
+        # About four characters per token for English text and code
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
@@ -1,59 +1,228 @@
+import abc
+import asyncio
+import importlib
 import json
+import time
+import traceback
+from contextlib import asynccontextmanager
 import tornado.web
 import tornado.websocket
 import tornado.ioloop
-from langchain.chains.sequential import SequentialChain
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
-from langchain.memory import ConversationBufferWindowMemory
 
-from .prompt import debug_template, debug_explain_template, explain_template, refactor_template
-from .callback import DefaultCallbackHandler
+from .prompt import explain_template, refactor_template, DEBUG_EXPLANATION_MARKER
+from .config import DEBUG_MODE
+from .frames import wants_compact, replay_completion
+from .response_cache import response_cache
+from .memory_store import cell_memory_store
+from .llm_pool import llm_pool
+from .scheduler import scheduler, user_key, SchedulerRejected
+from .metrics import metrics
+from .tokens import count_tokens, warm_encoding
 
-class RefactorWebSocketHandler(tornado.websocket.WebSocketHandler):
+
+_chains_loaded = None
+
+
+async def load_chains():
+    """Imports langchain and the chains on a worker thread the first time a request needs them.
+
+    The import takes seconds, so it is kept out of server startup and off the IOLoop.
+    The tiktoken encoding is loaded there too, token counts are estimated until then.
+    """
+    global _chains_loaded
+    if _chains_loaded is None:
+        _chains_loaded = asyncio.get_event_loop().run_in_executor(None, _import_chains)
+    await asyncio.shield(_chains_loaded)
+
+
+def _import_chains():
+    start = time.monotonic()
+    warm_encoding()
+    importlib.import_module(".chains", __package__)
+    importlib.import_module(".callback", __package__)
+    metrics.observe("startup.chains_import_seconds", time.monotonic() - start)
+
+
+class Completion(object):
+    """A request being answered by one of the pilot handlers."""
+
+    def __init__(self, data, key):
+        self.data = data
+        self.key = key
+        self.task = None
+        self.callback = None
+        self.cancel_reason = None
+
+    def cancel(self, reason):
+        if self.task is not None and not self.task.done():
+            self.cancel_reason = reason
+            self.task.cancel()
+
+
+class PilotWebSocketHandler(tornado.websocket.WebSocketHandler, metaclass=abc.ABCMeta):
+    """Base for the pilot endpoints.
+
+    Each message is answered in its own task using the chains' async APIs,
+    so the IOLoop keeps serving other sockets while a completion streams and
+    the socket keeps reading, which lets a close cancel the completion.
+    A new request for the same notebook cell from the same client, a
+    browser tab, supersedes the running one. Clients that don't send a
+    clientId only supersede their own requests on the same connection.
+    """
+
+    name = "pilot"
+
+    # Running completions by (endpoint, client, notebook path, cell id) across all connections
+    inflight = {}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.cells = {}
+        self.completions = set()
 
     def check_origin(self, origin):
         # Override to enable support for allowing all cross-origin traffic
         return True
 
+    async def write_frame(self, frame):
+        try:
+            await self.write_message(frame)
+        except tornado.websocket.WebSocketClosedError:
+            print(f"{self.__class__.__name__}: client closed the socket, dropping frame")
+
     def on_message(self, message):
         data = json.loads(message)
+        key = None
+        if data.get("cellId"):
+            key = (self.name, data.get("clientId") or id(self), data.get("path"), data["cellId"])
+            previous = self.inflight.get(key)
+            if previous is not None:
+                previous.cancel("superseded")
+
+        completion = Completion(data, key)
+        completion.task = asyncio.ensure_future(self.run(completion))
+        completion.task.add_done_callback(lambda _: self.finished(completion))
+        self.completions.add(completion)
+        if key is not None:
+            self.inflight[key] = completion
+
+    def on_close(self):
+        for completion in list(self.completions):
+            completion.cancel("closed")
+
+    def finished(self, completion):
+        self.completions.discard(completion)
+        if completion.key is not None and self.inflight.get(completion.key) is completion:
+            del self.inflight[completion.key]
+
+    async def run(self, completion):
+        start = time.monotonic()
+        metrics.inc(f"{self.name}.requests")
+        try:
+            await load_chains()
+            completion.callback = self.create_callback(completion.data)
+            await self.handle(completion.data, completion.callback)
+        except SchedulerRejected as e:
+            await self.write_frame(json.dumps({"method": "rejected", "message": str(e)}))
+        except asyncio.CancelledError:
+            self.record_cancel(completion)
+            if completion.cancel_reason == "superseded" and completion.callback is not None:
+                # Let the superseded client finish its stream instead of waiting forever
+                await completion.callback.frames.done()
+        except Exception as e:
+            metrics.inc(f"{self.name}.errors")
+            print(f"{self.__class__.__name__}: error during completion: {e}")
+            traceback.print_exc()
+        finally:
+            metrics.observe(f"{self.name}.request_seconds", time.monotonic() - start)
+
+    def record_cancel(self, completion):
+        metrics.inc(f"{self.name}.cancelled_{completion.cancel_reason}")
+        frames = completion.callback.frames if completion.callback is not None else None
+        if frames is not None and frames.tokens and not frames.streaming:
+            return  # The answer was already complete
+        streamed = frames.tokens if frames is not None else 0
+        expected = self.expected_completion_tokens(completion.data)
+        metrics.inc("cancellation.tokens_streamed_before_cancel", streamed)
+        metrics.inc("cancellation.estimated_tokens_saved", max(0, expected - streamed))
+
+    @asynccontextmanager
+    async def llm_slot(self, data):
+        """Waits for a scheduler slot, then binds the pooled HTTP session for the request."""
+        openai_api_key = data.get("openai_api_key", None)
+        user = user_key(openai_api_key, self.request.remote_ip)
+        async with scheduler.slot(user, self.name, on_queued=self.send_queued):
+            async with llm_pool.session(openai_api_key):
+                yield
+
+    async def send_queued(self, position):
+        await self.write_frame(json.dumps({"method": "queued", "position": position}))
+
+    def create_callback(self, data):
+        from .callback import DefaultCallbackHandler
+        return DefaultCallbackHandler(self.write_frame, compact=wants_compact(data))
+
+    def expected_completion_tokens(self, data):
+        # Rewritten code and explanations come out at roughly the size of the cell
+        return count_tokens(data.get("code", ""), data.get("model", "gpt-3.5-turbo"))
+
+    @abc.abstractmethod
+    async def handle(self, data, callback):
+        """Answers the request data, streaming through callback."""
+
+
+class RefactorWebSocketHandler(PilotWebSocketHandler):
+
+    name = "refactor"
+
+    async def handle(self, data, callback):
+        from . import chains
         code = data.get('code', 'No code provided')
         model = data.get('model', 'gpt-3.5-turbo')
         temp = data.get('temp', 1)
         cell_id = data.get("cellId", None)
+        path = data.get("path", None)
         openai_api_key = data.get("openai_api_key", None)
 
-        memory = self.cells.get(cell_id)
-        if not memory:
+        if cell_id:
+            memory = cell_memory_store.get(path, cell_id)
+        else:
+            from langchain.memory import ConversationBufferWindowMemory
             memory = ConversationBufferWindowMemory(k=3, memory_key="memory", return_messages=True)
-            self.cells[cell_id] = memory
 
-        llm = ChatOpenAI(openai_api_key=openai_api_key, model=model, temperature=temp, streaming=True, callbacks=[DefaultCallbackHandler(self.write_message)])
-        
-        prompt_template = PromptTemplate(input_variables=["memory", "code"], template=refactor_template)
-        chain = LLMChain(
-            llm=llm,
-            prompt=prompt_template,
-            verbose=True,
-            memory=memory
-        )
-        chain({"code": code})
+        from langchain.schema.messages import get_buffer_string
+        history = get_buffer_string(memory.load_memory_variables({})["memory"])
 
+        cache_key = None
+        if response_cache.applies(temp, data):
+            # Earlier versions of the cell are part of the prompt, so they are part of the key
+            cache_key = response_cache.key("refactor", refactor_template, model, code, history)
+            text = await response_cache.get(cache_key)
+            if text is not None:
+                await replay_completion(self.write_frame, text, compact=wants_compact(data))
+                memory.save_context({"code": code}, {"text": text})
+                cell_memory_store.update(path, cell_id)
+                return
 
-class DebugWebSocketHandler(tornado.websocket.WebSocketHandler):
+        inputs = chains.refactor_assembler.assemble(model, {"code": code, "memory": history})
+        chain = llm_pool.get_chain(openai_api_key, model, temp, "refactor", chains.build_refactor_chain)
+        async with self.llm_slot(data):
+            result = await chain.acall(inputs, callbacks=[callback])
+        memory.save_context({"code": code}, {"text": result["text"]})
+        cell_memory_store.update(path, cell_id)
+        if cache_key:
+            await response_cache.put(cache_key, result["text"])
 
-    def check_origin(self, origin):
-        # Override to enable support for allowing all cross-origin traffic
-        return True
 
-    def on_message(self, message):
-        data = json.loads(message)
+class DebugWebSocketHandler(PilotWebSocketHandler):
+
+    name = "debug"
+
+    def expected_completion_tokens(self, data):
+        # Fixed code followed by an explanation of the fix
+        return 2 * super().expected_completion_tokens(data)
+
+    async def handle(self, data, callback):
+        from . import chains
         code = data.get('code', 'No code provided')
         output = data.get('output', 'No output provided')
         error = data.get('error', 'No error provided')
@@ -61,54 +230,49 @@ class DebugWebSocketHandler(tornado.websocket.WebSocketHandler):
         temp = data.get('temp', 1)
         openai_api_key = data.get("openai_api_key", None)
 
-        llm = ChatOpenAI(openai_api_key=openai_api_key, model=model, temperature=temp, streaming=True, callbacks=[DefaultCallbackHandler(self.write_message)])
-        
-        debug_prompt_template = PromptTemplate(input_variables=["code", "output", "error"], template=debug_template)
-        debug_chain = LLMChain(
-            llm=llm,
-            prompt=debug_prompt_template,
-            verbose=True,
-            output_key="refactored"
-        )
-
-        debug_explain_prompt_template = PromptTemplate(input_variables=["code", "output", "error", "refactored"], template=debug_explain_template)
-        debug_explain_chain = LLMChain(
-            llm=llm,
-            prompt=debug_explain_prompt_template,
-            verbose=True,
-            output_key="explanation"
-        )
-
-        overall_chain = SequentialChain(
-            chains=[debug_chain, debug_explain_chain],
-            input_variables=["code", "output", "error"],
-            # Here we return multiple variables
-            output_variables=["refactored", "explanation"],
-            verbose=True
-        )
-
-        overall_chain({"code": code, "output": output, "error": error})
-
-
-class ExplainWebSocketHandler(tornado.websocket.WebSocketHandler):
+        inputs = {"code": code, "output": output, "error": error}
 
-    def check_origin(self, origin):
-        # Override to enable support for allowing all cross-origin traffic
-        return True
+        if data.get("debug_mode", DEBUG_MODE) == "two_pass":
+            inputs = chains.debug_assembler.assemble(model, inputs)
+            overall_chain = llm_pool.get_chain(openai_api_key, model, temp, "debug", chains.build_debug_chain)
+            async with self.llm_slot(data):
+                await overall_chain.acall(inputs, callbacks=[callback])
+            return
 
-    def on_message(self, message):
-        data = json.loads(message)
+        inputs = chains.debug_single_pass_assembler.assemble(model, inputs)
+        chain = llm_pool.get_chain(openai_api_key, model, temp, "debug_single_pass", chains.build_debug_single_pass_chain)
+        async with self.llm_slot(data):
+            await chain.acall(inputs, callbacks=[callback])
+
+    def create_callback(self, data):
+        if data.get("debug_mode", DEBUG_MODE) == "two_pass":
+            return super().create_callback(data)
+        from .callback import SectionSplitCallbackHandler
+        return SectionSplitCallbackHandler(self.write_frame, DEBUG_EXPLANATION_MARKER, compact=wants_compact(data))
+
+
+class ExplainWebSocketHandler(PilotWebSocketHandler):
+
+    name = "explain"
+
+    async def handle(self, data, callback):
+        from . import chains
         code = data.get('code', 'No code provided')
         model = data.get('model', 'gpt-3.5-turbo')
         temp = data.get('temp', 1)
         openai_api_key = data.get("openai_api_key", None)
 
-        llm = ChatOpenAI(openai_api_key=openai_api_key, model=model, temperature=temp, streaming=True, callbacks=[DefaultCallbackHandler(self.write_message)])
-        
-        prompt_template = PromptTemplate(input_variables=["code"], template=explain_template)
-        chain = LLMChain(
-            llm=llm,
-            prompt=prompt_template,
-            verbose=True
-        )
-        chain({"code": code})
\ No newline at end of file
+        cache_key = None
+        if response_cache.applies(temp, data):
+            cache_key = response_cache.key("explain", explain_template, model, code)
+            text = await response_cache.get(cache_key)
+            if text is not None:
+                await replay_completion(self.write_frame, text, compact=wants_compact(data))
+                return
+
+        inputs = chains.explain_assembler.assemble(model, {"code": code})
+        chain = llm_pool.get_chain(openai_api_key, model, temp, "explain", chains.build_explain_chain)
+        async with self.llm_slot(data):
+            result = await chain.acall(inputs, callbacks=[callback])
+        if cache_key:
+            await response_cache.put(cache_key, result["text"])
@@ -47,6 +47,21 @@ export function getCellOutput(cellModel: CodeCellModel): any {
   }
 
 
+  // Compact stream frames are arrays: [0, text] token, [1] start, [2] done
+  export function parseFrame(raw: string): any {
+    const frame = JSON.parse(raw)
+    if (!Array.isArray(frame)) {
+      return frame
+    }
+    return {
+      "message": frame[0] === 0 ? frame[1] : null,
+      "start": frame[0] === 1,
+      "done": frame[0] === 2,
+      "method": "default"
+    }
+  }
+
+
   export class CodeBuffer {
     private undoBuffer: Array<string> = [];
     private redoBuffer: Array<string> = [];
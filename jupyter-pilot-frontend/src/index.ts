@@ -45,6 +45,7 @@ const extension: JupyterFrontEndPlugin<void> = {
         sharedService.setModel(settings.get('llm_backend').composite as string);
         sharedService.setTemp(settings.get('llm_temp').composite as number);
         sharedService.setOpenAIAPIKey(settings.get('openai_api_key').composite as string);
+        sharedService.setCacheResponses(settings.get('cache_responses').composite as boolean);
 
         // Listen for your setting changes.
         settings.changed.connect(() => {
@@ -52,6 +53,7 @@ const extension: JupyterFrontEndPlugin<void> = {
             sharedService.setModel(settings.get('llm_backend').composite as string);
             sharedService.setTemp(settings.get('llm_temp').composite as number);
             sharedService.setOpenAIAPIKey(settings.get('openai_api_key').composite as string);
+            sharedService.setCacheResponses(settings.get('cache_responses').composite as boolean);
         });
     });
 
@@ -1,6 +1,7 @@
 import { ToolbarButton } from '@jupyterlab/apputils';
 import { DocumentRegistry } from '@jupyterlab/docregistry';
 import { IDisposable, DisposableDelegate } from '@lumino/disposable';
+import { UUID } from '@lumino/coreutils';
 import {
   NotebookPanel,
   INotebookModel,
@@ -13,18 +14,20 @@ import { CodeCell, CodeCellModel } from '@jupyterlab/cells';
 import {
   JupyterFrontEnd
 } from '@jupyterlab/application';
-import { v4 as uuidv4 } from 'uuid';
 import { marked } from 'marked';
 import { markedHighlight } from "marked-highlight";
 import hljs from 'highlight.js';
 import DOMPurify from 'dompurify';
 
-import { getCellOutput, CodeBuffer } from './cell-utils';
+import { getCellOutput, CodeBuffer, parseFrame } from './cell-utils';
 import SharedService from './shared-service';
 
 
 export type LogFunction = (msg: IHtmlLog) => void;
 
+// Identifies this browser tab, a new request only supersedes the same tab's running request for a cell
+const CLIENT_ID = UUID.uuid4();
+
 
 /**
  * The toolbar with buttons for the Labpilot extension
@@ -56,7 +59,7 @@ export class ToolbarWidget
     // Refactor button
     const refactorAction = () => {
       const refactor = new Refactorer();
-      refactor.refactorCell(panel, this.sharedService.getModel(), this.sharedService.getTemp(), this.sharedService.getOpenAIAPIKey());
+      refactor.refactorCell(panel, this.sharedService.getModel(), this.sharedService.getTemp(), this.sharedService.getOpenAIAPIKey(), this.sharedService.getCacheResponses());
     };
 
     const refactorButton = new ToolbarButton({
@@ -82,7 +85,7 @@ export class ToolbarWidget
     // Explain button
     const explainAction = () => {
       const explain = new Explainer();
-      explain.explainCode(panel, this.sharedService.getModel(), this.sharedService.getTemp(), this.sharedService.getOpenAIAPIKey(), this.notebookTracker, this.app);
+      explain.explainCode(panel, this.sharedService.getModel(), this.sharedService.getTemp(), this.sharedService.getOpenAIAPIKey(), this.sharedService.getCacheResponses(), this.notebookTracker, this.app);
     };
 
     const explainButton = new ToolbarButton({
@@ -137,7 +140,7 @@ class Refactorer {
 
   private ws: WebSocket;
 
-  public refactorCell(notebookPanel: NotebookPanel, model: string, temp: number, openai_api_key: string) {
+  public refactorCell(notebookPanel: NotebookPanel, model: string, temp: number, openai_api_key: string, cache: boolean) {
     console.log("REFACTOR - using model: " + model)
     const activeCell = notebookPanel.content.activeCell as CodeCell
     const cellModel = activeCell.model as CodeCellModel
@@ -152,11 +155,6 @@ class Refactorer {
       (cellModel as any).code_buffer.addUndo(initial_code);
       (cellModel as any).code_buffer.clearRedoBuffer();
 
-      // Add unique id if not exist:
-      if ((cellModel as any).uniqueId == null) {
-        (cellModel as any).uniqueId = uuidv4();
-      }
-
       this.ws = new WebSocket("ws://localhost:8888/refactor", "echo-protocol")
       this.ws.onmessage = this.handleRefactorResponse.bind(this, activeCell)
       this.ws.onerror = (event: Event) => {
@@ -167,8 +165,13 @@ class Refactorer {
           code: initial_code,
           model: model,
           temp: temp,
-          cellId: (cellModel as any).uniqueId,
-          openai_api_key: openai_api_key
+          // The notebook's own cell id and path survive reloads, so the backend keeps the cell's history
+          cellId: cellModel.id,
+          path: notebookPanel.context.path,
+          clientId: CLIENT_ID,
+          openai_api_key: openai_api_key,
+          cache: cache,
+          frame_format: "compact"
         };
         this.ws.send(JSON.stringify(data))
       };
@@ -179,7 +182,10 @@ class Refactorer {
   }
 
   private handleRefactorResponse(activeCell: CodeCell, event: MessageEvent) {
-    const data = JSON.parse(event.data);
+    const data = parseFrame(event.data);
+    if (handleSchedulerFrame(data, this.ws)) {
+      return;
+    }
 
     const cellModel = activeCell.model as CodeCellModel;
     
@@ -231,7 +237,11 @@ class Debugger {
           error: output.errorText,
           model: model,
           temp: temp,
-          openai_api_key: openai_api_key
+          cellId: cellModel.id,
+          path: notebookPanel.context.path,
+          clientId: CLIENT_ID,
+          openai_api_key: openai_api_key,
+          frame_format: "compact"
         };
         this.ws.send(JSON.stringify(data))
       };
@@ -241,7 +251,10 @@ class Debugger {
   }
 
   private handleDebugResponse(activeCell: CodeCell, event: MessageEvent) {
-    const data = JSON.parse(event.data)
+    const data = parseFrame(event.data)
+    if (handleSchedulerFrame(data, this.ws)) {
+      return
+    }
 
     const cellModel = activeCell.model as CodeCellModel
     
@@ -275,7 +288,7 @@ class Explainer {
   private explanationCell: any;
   private ws: WebSocket;
 
-  public explainCode(notebookPanel: NotebookPanel, model: string, temp: number, openai_api_key: string, notebookTracker: INotebookTracker, app: JupyterFrontEnd) {
+  public explainCode(notebookPanel: NotebookPanel, model: string, temp: number, openai_api_key: string, cache: boolean, notebookTracker: INotebookTracker, app: JupyterFrontEnd) {
     console.log("EXPLAIN - using model:" + model);
     const activeCell = notebookPanel.content.activeCell as CodeCell;
     const cellModel = activeCell.model as CodeCellModel;
@@ -292,7 +305,12 @@ class Explainer {
           code: code,
           model: model,
           temp: temp,
-          openai_api_key: openai_api_key
+          cellId: cellModel.id,
+          path: notebookPanel.context.path,
+          clientId: CLIENT_ID,
+          openai_api_key: openai_api_key,
+          cache: cache,
+          frame_format: "compact"
         };
         this.ws.send(JSON.stringify(data));
       };
@@ -302,7 +320,10 @@ class Explainer {
   }
 
   private handleExplainResponse(notebookTracker: INotebookTracker, app: JupyterFrontEnd, event: MessageEvent) {
-    const data = JSON.parse(event.data);
+    const data = parseFrame(event.data);
+    if (handleSchedulerFrame(data, this.ws)) {
+      return;
+    }
 
     const activeCellIndex = notebookTracker.currentWidget.content.activeCellIndex;
 
@@ -363,6 +384,20 @@ function redo(notebookPanel: NotebookPanel) {
 }
 
 
+// Scheduler frames come before the stream starts, returns true when the frame was one of them
+function handleSchedulerFrame(data: any, ws: WebSocket): boolean {
+  if (data.method === "queued") {
+    sendNotification("pilotNotification", "Waiting for a free slot, " + data.position + " request(s) ahead")
+    return true
+  }
+  if (data.method === "rejected") {
+    sendNotification("pilotNotification", data.message)
+    ws.close()
+    return true
+  }
+  return false
+}
+
 function sendNotification(id: string, text: string) {
   marked.use(markedHighlight({
     highlight(code, lang) {
@@ -5,6 +5,7 @@ export default class SharedService {
     private temp: number;
     private model: string;
     private openai_api_key: string;
+    private cache_responses: boolean = false;
 
     constructor(model: string, temp: number) {
         this.model = model;
@@ -34,4 +35,12 @@ export default class SharedService {
     public getOpenAIAPIKey(): string {
         return this.openai_api_key;
     }
+
+    public setCacheResponses(cache_responses: boolean): void {
+        this.cache_responses = cache_responses;
+    }
+
+    public getCacheResponses(): boolean {
+        return this.cache_responses;
+    }
 }
\ No newline at end of file
@@ -4,18 +4,22 @@ import { FitAddon } from 'xterm-addon-fit'
 import { WebLinksAddon } from 'xterm-addon-web-links'
 
 import {
+  INotebookModel,
   INotebookTracker,
-  NotebookModel
+  NotebookPanel
 } from '@jupyterlab/notebook'
+import { DocumentRegistry } from '@jupyterlab/docregistry'
 import {
   JupyterFrontEnd
 } from '@jupyterlab/application'
-import { CodeCellModel, MarkdownCellModel } from "@jupyterlab/cells"
+import { CodeCellModel, MarkdownCell } from "@jupyterlab/cells"
+import { URLExt } from '@jupyterlab/coreutils'
+import { ServerConnection } from '@jupyterlab/services'
 
 
 import SharedService from './shared-service'
 import Spinner from "./spinner"
-import { getCellOutput, CodeBuffer } from './cell-utils'
+import { getCellOutput, CodeBuffer, parseFrame } from './cell-utils'
 
 
 const xtermjsTheme = {
@@ -96,23 +100,21 @@ function sleep(ms: number) {
   return new Promise((resolve) => setTimeout(resolve, ms))
 }
 
-function removeMedia(json: any) {
-  if (json.cells) {
-    json.cells.forEach(cell => {
-      if (cell.cell_type === "code" && cell.outputs) {
-        cell.outputs = cell.outputs.map((output: any) => keepProperty(output, "text/plain"))
-      }
-    })
-  }
-}
+// How long after the user's last edit of the notebook the agent works on it is saved, while the agent runs
+const EDIT_SYNC_DELAY_MS = 1000
 
-function keepProperty(obj: any, prop: string) {
-  return { [prop]: obj[prop] };
+function setLastModified(context: DocumentRegistry.IContext<INotebookModel>, lastModified: string) {
+  // The context compares this time with the file's before saving, and has no public setter for it
+  const contentsModel = context.contentsModel
+  if (contentsModel) {
+    (context as any)._updateContentsModel({ ...contentsModel, last_modified: lastModified })
+  }
 }
 
 export class XtermWidget extends Widget {
   private term: Terminal
   private ws: WebSocket;
+  private sessionId: string = null
   private fitAddon: FitAddon
   private curr_line: string = ""
   private curr_index: number = 0
@@ -132,6 +134,11 @@ export class XtermWidget extends Widget {
 
   private message: string = "";
 
+  // The notebook whose user edits are saved while the agent runs, so the agent reads them
+  private syncedPanel: NotebookPanel = null
+  private syncTimer: number = null
+  private applyingDelta: boolean = false
+
   constructor(
     private sharedService: SharedService,
     private notebookTracker: INotebookTracker, 
@@ -153,20 +160,31 @@ export class XtermWidget extends Widget {
     
     this.term.onData(this.handleUserInput.bind(this))
 
-    this.ws = new WebSocket("ws://localhost:8080", "echo-protocol");
-    this.ws.onmessage = this.handleResponse.bind(this)
-    this.ws.onerror = (event: Event) => {
-      console.error('Primary WebSocket error observed:', event)
-    }
-    this.ws.onopen = () => {
-      this.ws.send(JSON.stringify({"method": "clear"}))
-    }
+    this.connect()
 
     this.term.write("$ ")
   }
 
+  private connect(): void {
+    // The terminal backend is started on demand, so ask the server for it before connecting.
+    // makeRequest sends the token and XSRF header the server requires.
+    const settings = ServerConnection.makeSettings()
+    ServerConnection.makeRequest(URLExt.join(settings.baseUrl, "labpilot/terminal"), { method: "POST" }, settings)
+      .catch((error) => console.error('Starting terminal backend failed:', error))
+      .then(() => {
+        this.ws = new WebSocket("ws://localhost:8080", "echo-protocol");
+        this.ws.onmessage = this.handleResponse.bind(this)
+        this.ws.onerror = (event: Event) => {
+          console.error('Primary WebSocket error observed:', event)
+        }
+        this.ws.onopen = () => {
+          this.ws.send(JSON.stringify({"method": "clear"}))
+        }
+      })
+  }
+
   private handleResponse(msg: any): void {
-    let response = JSON.parse(msg.data)
+    let response = parseFrame(msg.data)
     if (response.method !== "default") console.log(response)
 
     if (response.start === true && response.method === "default") {
@@ -179,35 +197,31 @@ export class XtermWidget extends Widget {
     }
 
     switch (response.method) {
+      case "session":
+        this.sessionId = response.session_id
+        break
       case "systemError":
         this.systemError(response.message)
         break
-      case "openNotebook":
-        this.openNotebook(response.request.filename)
+      case "queued":
+        this.term.writeln(color("\rWaiting for a free slot, " + response.position + " request(s) ahead", "yellow"))
         break
-      case "readCell":
-        this.readCell(response.request.index, response.request.filename)
-        break
-      case "insertCodeCell":
-        this.insertCodeCell(response.request.code, response.request.index, response.request.filename)
+      case "rejected":
+        this.systemError(response.message)
+        this.term.write("$ ")
         break
-      case "insertMarkdownCell":  
-        this.insertMarkdownCell(response.request.text, response.request.index, response.request.filename)
+      case "openNotebook":
+        this.openNotebook(response.request.filename, response.request_id)
         break
-      case "editCodeCell":
-        this.editCodeCell(response.request.code, response.request.index, response.request.filename)
+      case "shellOutput":
+        // Output of a shell command the agent is running, as it arrives
+        this.term.write(response.text)
         break
-      case "editMarkdownCell":
-        this.editMarkdownCell(response.request.text, response.request.index, response.request.filename)
+      case "notebookDelta":
+        this.applyNotebookDelta(response)
         break
       case "runCode":
-        this.runCodeCell(response.request.index, response.request.filename)
-        break
-      case "deleteCell":
-        this.deleteCell(response.request.index, response.request.filename)
-        break
-      case "readNotebook":
-        this.readNotebook(response.request.filename)
+        this.runCodeCell(response.request.index, response.request.filename, response.request_id)
         break
       case "default":
       default:
@@ -220,6 +234,7 @@ export class XtermWidget extends Widget {
         if (response.done === true && this.waitingForAnswer === false) {
           const pattern = /(.*\?)((?:\n- .*)+)/
           const match = this.message.match(pattern)
+          this.stopSyncingEdits()
           if (match) {
             this.spinner.stop()
 
@@ -276,12 +291,13 @@ export class XtermWidget extends Widget {
   }
 
   private systemError(message: string) {
+    this.stopSyncingEdits()
     this.spinner.stop()
     this.waitingForAnswer = false
     this.term.writeln(color(message, "red"))
   }
 
-  private async openNotebook(filename: string) {
+  private async openNotebook(filename: string, requestId: number) {
     let data
     try {
       const { commands } = this.app
@@ -297,177 +313,102 @@ export class XtermWidget extends Widget {
         "system_message": true
       }
     } finally {
-      this.sendAnswer(data, "openNotebook")
+      this.sendAnswer(data, "openNotebook", requestId)
     }
   }
 
-  private async readCell(indexStr: string, filename: string) {
-    let data
-    try {
-      if (filename) {
-        const { commands } = this.app
-        commands.execute('docmanager:open', { path: filename, options: { mode: 'split-left' } })
-        await sleep(500)
-      }
-      const index = parseInt(indexStr)
-      const model = this.notebookTracker.currentWidget.content.model as NotebookModel
-      const modelJson = model.toJSON()
-      const cell = modelJson.cells[index]
-      data = {
-        "message": {
-          "cell_type": cell.cell_type,
-          "content": cell.source
-        }
-      }
-    } catch (error) {
-      data = {
-        "message": "ERROR: " + error,
-        "system_message": true
-      }
-    } finally {
-      this.sendAnswer(data, "readCell")
+  private applyNotebookDelta(delta: any) {
+    // The server already saved the change, apply it to the open copy of the notebook if there is one
+    const notebookPanel = this.notebookTracker.find(panel => panel.context.path === delta.path)
+    if (!notebookPanel) {
+      return
     }
-  }
-
-  private async insertCodeCell(code: string, indexstr: string, filename: string) {
-    let data
+    const model = notebookPanel.content.model
+    // Only the user's own changes count as unsaved, they stay unsaved after the agent's change
+    const dirty = model.dirty
+    this.applyingDelta = true
     try {
-      if (filename) {
-        const { commands } = this.app
-        commands.execute('docmanager:open', { path: filename, options: { mode: 'split-left' } })
-        await sleep(500)
-      }
-      const index = parseInt(indexstr)
-      const model = this.notebookTracker.currentWidget.content.model
-      const codeCell = model.contentFactory.createCell('code', {})
-      codeCell.value.text = code
-      model.cells.insert(index, codeCell)
-      data = {
-        "message": "Inserted code at index " + index + " successfully"
-      }
-    } catch (error) {
-      data = {
-        "message": "ERROR: " + error,
-        "system_message": true
-      }
+      this.applyDeltaToModel(notebookPanel, delta)
     } finally {
-      this.sendAnswer(data, "insertCodeCell")
+      this.applyingDelta = false
     }
-  }
-
-  private async insertMarkdownCell(markdown: string, indexstr: string, filename: string) {
-    let data
-    try {
-      if (filename) {
-        const { commands } = this.app
-        commands.execute('docmanager:open', { path: filename, options: { mode: 'split-left' } })
-        await sleep(500)
-      }
-      const index = parseInt(indexstr)
-      const model = this.notebookTracker.currentWidget.content.model
-      const cellModel = model.contentFactory.createCell('markdown', {})
-      cellModel.value.text = markdown
-      model.cells.insert(index, cellModel)
-
-      // Insert text into the markdown cell
-      cellModel.value.text = markdown
-      // Set the new cell as the active cell
-      this.notebookTracker.currentWidget.content.activeCellIndex = index
-      // Programmatically run the cell
-      this.app.commands.execute('notebook:run-cell')
-      data = {
-        "message": "Inserted markdown text at index " + index + " successfully"
-      }
-    } catch (error) {
-      data = {
-        "message": "ERROR: " + error,
-        "system_message": true
-      }
-    } finally {
-      this.sendAnswer(data, "insertMarkdownCell")
+    if (delta.last_modified) {
+      // The notebook on disk already has this change, so the next save from the browser isn't a conflict
+      setLastModified(notebookPanel.context, delta.last_modified)
     }
+    model.dirty = dirty
   }
 
-  private async editCodeCell(code: string, indexstr: string, filename: string) {
-    let data
-    try {
-      if (filename) {
-        const { commands } = this.app
-        commands.execute('docmanager:open', { path: filename, options: { mode: 'split-left' } })
-        await sleep(500)
-      }
-      const index = parseInt(indexstr)
-      const notebookPanel = this.notebookTracker.currentWidget
-      const notebook = notebookPanel.content
-      const cellModel = notebook.model.cells.get(index)
-      if (cellModel instanceof CodeCellModel) {
-        const initial_code = cellModel.value.text
-        // Save initial code from active cell
-        if ((cellModel as any).code_buffer == null) { 
-          (cellModel as any).code_buffer = new CodeBuffer();
-        }
-        (cellModel as any).code_buffer.addUndo(initial_code);
-        (cellModel as any).code_buffer.clearRedoBuffer();
-
-        cellModel.value.text = code
-        data = {
-          "message": "Edited code cell at index " + index + " successfully."
-        }
-      } else {
-        data = {
-          "message": "ERROR: Cell with index " + index + " is not a code cell."
+  private applyDeltaToModel(notebookPanel: NotebookPanel, delta: any) {
+    const model = notebookPanel.content.model
+    switch (delta.op) {
+      case "insert":
+        const cellModel = model.contentFactory.createCell(delta.cell.cell_type, {})
+        cellModel.value.text = delta.cell.source
+        model.cells.insert(delta.index, cellModel)
+        break
+      case "edit":
+        const editedModel = model.cells.get(delta.index)
+        if (editedModel instanceof CodeCellModel) {
+          // Save initial code so the edit can be undone
+          if ((editedModel as any).code_buffer == null) {
+            (editedModel as any).code_buffer = new CodeBuffer();
+          }
+          (editedModel as any).code_buffer.addUndo(editedModel.value.text);
+          (editedModel as any).code_buffer.clearRedoBuffer();
         }
+        editedModel.value.text = delta.cell.source
+        break
+      case "delete":
+        model.cells.remove(delta.index)
+        break
+      case "clearOutputs":
+        (model.cells.get(delta.index) as CodeCellModel).outputs.clear()
+        break
+      case "output":
+        // Outputs of a cell the agent is running on the kernel, the notebook is saved when it's done
+        (model.cells.get(delta.index) as CodeCellModel).outputs.add(delta.output)
+        break
+      case "executed":
+        (model.cells.get(delta.index) as CodeCellModel).executionCount = delta.execution_count
+        break
+    }
+    if (delta.cell && delta.cell.cell_type === "markdown") {
+      const cell = notebookPanel.content.widgets[delta.index]
+      if (cell instanceof MarkdownCell) {
+        cell.rendered = true
       }
-    } catch (error) {
-      data = {
-        "message": "ERROR: " + error,
-        "system_message": true
-      }
-    } finally {
-      this.sendAnswer(data, "editCodeCell")
     }
   }
 
-  private async editMarkdownCell(text: string, indexstr: string, filename: string) {
-    let data
-    try {
-      if (filename) {
-        const { commands } = this.app
-        commands.execute('docmanager:open', { path: filename, options: { mode: 'split-left' } })
-        await sleep(500)
-      }
-      const index = parseInt(indexstr)
-      const notebookPanel = this.notebookTracker.currentWidget
-      const notebook = notebookPanel.content
-      const cellModel = notebook.model.cells.get(index)
-
-      if (cellModel instanceof MarkdownCellModel) {
-        cellModel.value.text = text
+  private startSyncingEdits(notebookPanel: NotebookPanel) {
+    this.stopSyncingEdits()
+    this.syncedPanel = notebookPanel
+    notebookPanel.content.model.contentChanged.connect(this.onUserEdit, this)
+  }
 
-        // Set the new cell as the active cell
-        this.notebookTracker.currentWidget.content.activeCellIndex = index
-        // Programmatically run the cell
-        this.app.commands.execute('notebook:run-cell')
+  private stopSyncingEdits() {
+    if (this.syncedPanel) {
+      this.syncedPanel.content.model?.contentChanged.disconnect(this.onUserEdit, this)
+      this.syncedPanel = null
+    }
+    window.clearTimeout(this.syncTimer)
+  }
 
-        data = {
-          "message": "Edited markdown cell at index " + index + " successfully."
-        }
-      } else {
-        data = {
-          "message": "ERROR: Cell at index " + index + " is not a markdown cell."
-        }
-      }
-    } catch (error) {
-      data = {
-        "message": "ERROR: " + error,
-        "system_message": true
-      }
-    } finally {
-      this.sendAnswer(data, "editMarkdownCell")
+  private onUserEdit() {
+    if (this.applyingDelta) {
+      return
     }
+    const notebookPanel = this.syncedPanel
+    window.clearTimeout(this.syncTimer)
+    this.syncTimer = window.setTimeout(() => {
+      if (!notebookPanel.isDisposed && notebookPanel.context.model.dirty) {
+        notebookPanel.context.save()
+      }
+    }, EDIT_SYNC_DELAY_MS)
   }
 
-  private async runCodeCell(index: number, filename: string) {
+  private async runCodeCell(index: number, filename: string, requestId: number) {
     let data
     try {
       if (filename) {
@@ -517,56 +458,7 @@ export class XtermWidget extends Widget {
         "system_message": true
       }
     } finally {
-      this.sendAnswer(data, "runCode")
-    }
-  }
-
-  private async deleteCell(indexstr: string, filename: string) {
-    let data
-    try {
-      if (filename) {
-        const { commands } = this.app
-        commands.execute('docmanager:open', { path: filename, options: { mode: 'split-left' } })
-        await sleep(500)
-      }
-      const index = parseInt(indexstr)
-      const model = this.notebookTracker.currentWidget.content.model
-      model.cells.remove(index)
-      data = {
-        "message": "Deleted cell at index " + index + " successfully"
-      }
-    } catch (error) {
-      data = {
-        "message": "ERROR: " + error,
-        "system_message": true
-      }
-    } finally {
-      this.sendAnswer(data, "deleteCell")
-    }
-  }
-
-  private async readNotebook(filename: string) {
-    let data
-    try {
-      if (filename) {
-        const { commands } = this.app
-        commands.execute('docmanager:open', { path: filename, options: { mode: 'split-left' } })
-        await sleep(500)
-      }
-      const notebookPanel = this.notebookTracker.currentWidget
-      const notebookJson = notebookPanel.model.toJSON()
-      removeMedia(notebookJson)
-      console.log("notebookJson", notebookJson)
-      data = {
-        "message": notebookJson
-      }
-    } catch (error) {
-      data = {
-        "message": "ERROR: " + error,
-        "system_message": true
-      }
-    } finally {
-      this.sendAnswer(data, "readNotebook")
+      this.sendAnswer(data, "runCode", requestId)
     }
   }
 
@@ -612,9 +504,10 @@ export class XtermWidget extends Widget {
         "message": "None of the above.",
         "model": this.sharedService.getModel(), 
         "temp": this.sharedService.getTemp(),
-        "openai_api_key": this.sharedService.getOpenAIAPIKey()
+        "openai_api_key": this.sharedService.getOpenAIAPIKey(),
+        "frame_format": "compact"
       }
-      this.ws.send(JSON.stringify(data))
+      this.sendMessage(data)
       this.mode = "default"
     }
   }
@@ -661,9 +554,10 @@ export class XtermWidget extends Widget {
           "message": answer,
           "model": this.sharedService.getModel(), 
           "temp": this.sharedService.getTemp(),
-          "openai_api_key": this.sharedService.getOpenAIAPIKey()
+          "openai_api_key": this.sharedService.getOpenAIAPIKey(),
+          "frame_format": "compact"
         }
-        this.ws.send(JSON.stringify(data))
+        this.sendMessage(data)
         this.spinner = new Spinner(this.term)
         this.spinner.color("green")
         this.spinner.spin("dots")
@@ -688,10 +582,11 @@ export class XtermWidget extends Widget {
                 "message": this.curr_line,
                 "model": this.sharedService.getModel(), 
                 "temp": this.sharedService.getTemp(),
-                "openai_api_key": this.sharedService.getOpenAIAPIKey()
+                "openai_api_key": this.sharedService.getOpenAIAPIKey(),
+                "frame_format": "compact"
               }
               this.term.write("\n")
-              this.ws.send(JSON.stringify(data))
+              this.sendMessage(data)
               this.spinner = new Spinner(this.term)
               this.spinner.color("green")
               this.spinner.spin("dots")
@@ -746,16 +641,26 @@ export class XtermWidget extends Widget {
     }
   }
 
-  private sendAnswer(data: any, path: string) {
-    this.waitingForAnswer = false
-    const ws = new WebSocket("ws://localhost:8081/" + path, "echo-protocol")
-    ws.onopen = () => {
-      ws.send(JSON.stringify(data))
-      ws.close()
-    }
-    ws.onerror = (event: Event) => {
-      console.error('Secondary WebSocket error observed:', event)
+  private async sendMessage(data: any) {
+    // The agent reads notebooks on the server, so the open notebook is saved before it gets the message
+    const notebookPanel = this.notebookTracker.currentWidget
+    if (notebookPanel) {
+      data["notebook_path"] = notebookPanel.context.path
+      // Lets the agent run cells on the notebook's kernel without going through the browser
+      data["kernel_id"] = notebookPanel.sessionContext.session?.kernel?.id
+      if (notebookPanel.context.model.dirty) {
+        await notebookPanel.context.save()
+      }
+      // Edits the user makes while the agent runs are saved too
+      this.startSyncingEdits(notebookPanel)
     }
+    this.ws.send(JSON.stringify(data))
+  }
+
+  private sendAnswer(data: any, method: string, requestId?: number) {
+    this.waitingForAnswer = false
+    // Answers go back on the terminal's own connection, matched to the tool call by its request id
+    this.ws.send(JSON.stringify({"method": "answer", "request_id": requestId, "answer_to": method, "answer": data}))
   }
 
   onResize(msg: Widget.ResizeMessage) {
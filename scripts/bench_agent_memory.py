@@ -0,0 +1,83 @@
+"""Benchmark the prompt size of the terminal agent's chat memory as a session grows.
+
+Saves --turns turns into ConversationBufferMemory and RollingSummaryMemory
+and prints the tokens each would put into the agent prompt, and how long
+the turn took to save. Summaries come from a simulated model that replaces
+openai.ChatCompletion.acreate and waits --ttft seconds, so no API key is
+needed.
+
+    python scripts/bench_agent_memory.py --turns 60
+"""
+import argparse
+import asyncio
+import importlib
+import os.path as osp
+import sys
+import time
+
+import openai
+from langchain.memory import ConversationBufferMemory
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path.insert(0, osp.join(osp.dirname(HERE), "jupyter-pilot-backend"))
+memory = importlib.import_module("jupyter-pilot-backend.terminal.memory")
+llm_pool = importlib.import_module("jupyter-pilot-backend.llm_pool").llm_pool
+
+SUMMARY = "The user loaded sales.csv into df and the assistant plotted revenue by month in cell 3."
+
+
+class SimulatedModel(object):
+
+    def __init__(self, ttft):
+        self.ttft = ttft
+        self.calls = 0
+
+    async def acreate(self, *args, **kwargs):
+        self.calls += 1
+
+        async def stream():
+            await asyncio.sleep(self.ttft)
+            yield {"choices": [{"delta": {"content": SUMMARY}, "finish_reason": None}]}
+            yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+        return stream()
+
+
+async def run(args, model):
+    buffer = ConversationBufferMemory(memory_key="memory", return_messages=True)
+    rolling = memory.RollingSummaryMemory(memory_key="memory", return_messages=True, max_tokens=args.max_tokens)
+    rolling.configure(llm_pool.get_llm("sk-bench", "gpt-3.5-turbo", 0), "sk-bench", "gpt-3.5-turbo")
+
+    print(f"{'turn':>5} {'buffer tokens':>14} {'rolling tokens':>15} {'save ms':>8}")
+    for turn in range(1, args.turns + 1):
+        inputs = {"input": f"Turn {turn}: plot column {turn} of df against the date and explain the trend."}
+        outputs = {"output": "I added a cell that plots it. " + "The trend rises slowly over the year. " * 8}
+        buffer.save_context(inputs, outputs)
+        start = time.monotonic()
+        rolling.save_context(inputs, outputs)
+        elapsed = (time.monotonic() - start) * 1000
+        # Lets the background fold progress between turns, like a user typing the next message
+        await asyncio.sleep(args.think)
+        if turn % args.every == 0 or turn == args.turns:
+            print(f"{turn:5d} {rolling.tokens(buffer.chat_memory.messages):14d} "
+                  f"{rolling.tokens(rolling.messages()):15d} {elapsed:8.2f}")
+    if rolling.fold_task is not None:
+        await rolling.fold_task
+    print(f"summary calls {model.calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--every", type=int, default=10)
+    parser.add_argument("--max-tokens", type=int, default=2000)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--think", type=float, default=0.05)
+    args = parser.parse_args()
+
+    model = SimulatedModel(args.ttft)
+    openai.ChatCompletion.acreate = model.acreate
+    asyncio.run(run(args, model))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Benchmark the terminal agent's planning overhead per step, before the model is called.
+
+Each step builds the scratchpad, the prompt messages and the function
+schemas for a run that has taken `step` steps, with observations of
+--observation-chars characters. "cached" is the agent as it is, it only
+converts the newest step. "rebuild" drops the caches before every step and
+writes the scratchpad to /dev/null, which is what every step used to cost
+when the scratchpad was printed.
+
+    python scripts/bench_agent_planning.py --steps 15
+"""
+import argparse
+import importlib
+import logging
+import os
+import os.path as osp
+import statistics
+import sys
+import time
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path.insert(0, osp.join(osp.dirname(HERE), "jupyter-pilot-backend"))
+session = importlib.import_module("jupyter-pilot-backend.terminal.session")
+agent_module = importlib.import_module("jupyter-pilot-backend.terminal.agent")
+# Long runs are over the context budget on purpose, the warning for every step isn't what is measured
+logging.getLogger(agent_module.__name__).setLevel(logging.ERROR)
+
+
+def make_step(i, observation_chars):
+    action = agent_module._FunctionsAgentAction(
+        tool="read_cell_tool", tool_input={"index": i}, log=f"read cell {i}",
+        message_log=[agent_module.AIMessage(content="", additional_kwargs={
+            "function_call": {"name": "read_cell_tool", "arguments": f'{{"index": {i}}}'}
+        })]
+    )
+    return action, "x" * observation_chars
+
+
+def plan_overhead(agent, steps, inputs, rebuild, devnull):
+    start = time.perf_counter()
+    if rebuild:
+        agent._functions = None
+        agent._scratchpad_steps = []
+        agent._scratchpad = []
+        agent._scratchpad_tokens = []
+        agent._prefix_inputs = ()
+        print("AGENT SCRATCHPAD", agent_module._format_intermediate_steps(steps), file=devnull)
+    scratchpad = agent._format_scratchpad(steps)
+    agent._format_messages(scratchpad, **inputs)
+    agent.functions
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--observation-chars", type=int, default=2000)
+    args = parser.parse_args()
+
+    agent_session = session.AgentSession(None)
+    agent_session.create_agent("gpt-3.5-turbo", 0, "sk-bench")
+    agent = agent_session.agent.agent
+    devnull = open(os.devnull, "w")
+
+    for mode, rebuild in (("rebuild", True), ("cached", False)):
+        # Seconds of overhead of each step, over all runs
+        per_step = [[] for _ in range(args.steps)]
+        for _ in range(args.runs):
+            inputs = {"input": "Clean up the notebook", "memory": []}
+            steps = []
+            for step in range(args.steps):
+                per_step[step].append(plan_overhead(agent, steps, inputs, rebuild, devnull))
+                steps.append(make_step(step, args.observation_chars))
+        medians = [statistics.median(times) * 1e6 for times in per_step]
+        shown = "  ".join(f"{step + 1}:{median:6.0f}" for step, median in enumerate(medians) if step in (0, 4, 9, args.steps - 1))
+        print(f"{mode:<8} step:us  {shown}   run total {sum(medians) / 1000:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Benchmark the per message setup cost of the terminal agent.
+
+"rebuild" builds the LLM, tools, prompt, agent and executor for every
+message, which is what every turn used to cost. "reuse" is a turn with the
+session's cached agent, where only the current time is filled in when the
+prompt is formatted. Both include formatting the prompt once, so the cost
+of the time injection is part of "reuse".
+
+    python scripts/bench_agent_setup.py --turns 200
+"""
+import argparse
+import importlib
+import os.path as osp
+import statistics
+import sys
+import time
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path.insert(0, osp.join(osp.dirname(HERE), "jupyter-pilot-backend"))
+session = importlib.import_module("jupyter-pilot-backend.terminal.session")
+
+
+def turn(agent_session, rebuild):
+    start = time.perf_counter()
+    if rebuild:
+        agent_session.agent = None
+        agent_session.tools = None
+    agent_session.create_agent("gpt-3.5-turbo", 0, "sk-bench")
+    agent_session.agent.agent.prompt.format_messages(input="Read the first cell", memory=[], agent_scratchpad=[])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    agent_session = session.AgentSession(None)
+    agent_session.create_agent("gpt-3.5-turbo", 0, "sk-bench")
+    for mode, rebuild in (("rebuild", True), ("reuse", False)):
+        samples = [turn(agent_session, rebuild) for _ in range(args.turns)]
+        print(f"{mode:<8} per turn median {statistics.median(samples) * 1e6:8.0f} us   "
+              f"p95 {sorted(samples)[int(len(samples) * 0.95) - 1] * 1e6:8.0f} us")
+
+
+if __name__ == "__main__":
+    main()
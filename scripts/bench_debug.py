@@ -0,0 +1,158 @@
+"""Benchmark the single pass debug pipeline against the two chained calls.
+
+Runs DebugWebSocketHandler over a real tornado websocket on localhost with
+openai.ChatCompletion.acreate replaced by a simulated streaming model, so no
+API key is needed. The simulated model waits --ttft seconds (plus
+--prefill-ms per 1000 prompt tokens) before its first token and then emits
+one token every --token-ms milliseconds.
+
+    python scripts/bench_debug.py --runs 5 --ttft 0.4 --token-ms 15
+
+Prompt tokens are counted over the messages actually sent to the model.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os.path as osp
+import statistics
+import sys
+import time
+
+import openai
+import tornado.web
+import tornado.websocket
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path.insert(0, osp.join(osp.dirname(HERE), "jupyter-pilot-backend"))
+websocket_handler = importlib.import_module("jupyter-pilot-backend.websocket_handler")
+prompt = importlib.import_module("jupyter-pilot-backend.prompt")
+tokens = importlib.import_module("jupyter-pilot-backend.tokens")
+
+CODE = """import pandas as pd
+
+df = pd.DataFrame({"a": [1, 2, 3], "b": [4, 5, 6]})
+df["c"] = df["a"] + df["d"]
+print(df.describe())
+"""
+
+ERROR = """KeyError: 'd'
+---------------------------------------------------------------------------
+KeyError                                  Traceback (most recent call last)
+Cell In[4], line 4
+----> 4 df["c"] = df["a"] + df["d"]
+KeyError: 'd'
+"""
+
+FIXED = CODE.replace('df["d"]', 'df["b"]')
+
+EXPLANATION = """The DataFrame only has the columns `a` and `b`, so looking up `df["d"]` raises a `KeyError`.
+The sum now uses the existing column `b`, which is most likely what was intended.
+"""
+
+
+def split_tokens(text):
+    # Roughly the 4 characters per token the OpenAI tokenizer produces
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+class SimulatedModel(object):
+
+    def __init__(self, ttft, token_delay, prefill_per_1k):
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.prefill_per_1k = prefill_per_1k
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+
+    def reply_for(self, prompt_text):
+        if prompt.DEBUG_EXPLANATION_MARKER in prompt_text:
+            return FIXED + "\n" + prompt.DEBUG_EXPLANATION_MARKER + "\n" + EXPLANATION
+        if prompt_text.rstrip().endswith("explanation:"):
+            return EXPLANATION
+        return FIXED
+
+    async def acreate(self, *args, **kwargs):
+        prompt_text = "\n".join(message["content"] for message in kwargs["messages"])
+        prompt_tokens = tokens.count_tokens(prompt_text)
+        reply = split_tokens(self.reply_for(prompt_text))
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += len(reply)
+
+        async def stream():
+            await asyncio.sleep(self.ttft + self.prefill_per_1k * prompt_tokens / 1000)
+            for i, token in enumerate(reply):
+                if i:
+                    await asyncio.sleep(self.token_delay)
+                yield {"choices": [{"delta": {"content": token}, "finish_reason": None}]}
+            yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+        return stream()
+
+
+async def debug_once(port, mode):
+    ws = await tornado.websocket.websocket_connect(f"ws://localhost:{port}/debug")
+    start = time.monotonic()
+    ws.write_message(json.dumps({
+        "code": CODE, "output": "", "error": ERROR, "temp": 0,
+        "openai_api_key": "sk-bench", "debug_mode": mode, "frame_format": "compact"
+    }))
+    sections = [[], []]
+    section = 0
+    first_explanation_token = None
+    while True:
+        frame = json.loads(await ws.read_message())
+        if frame[0] == 0:
+            if section == 1 and first_explanation_token is None:
+                first_explanation_token = time.monotonic() - start
+            sections[section].append(frame[1])
+        elif frame[0] == 2:
+            if section == 1:
+                break
+            section = 1
+    total = time.monotonic() - start
+    ws.close()
+    return "".join(sections[0]), "".join(sections[1]), first_explanation_token, total
+
+
+async def run(mode, args, model):
+    app = tornado.web.Application([("/debug", websocket_handler.DebugWebSocketHandler)])
+    server = app.listen(0)
+    port = list(server._sockets.values())[0].getsockname()[1]
+
+    model.calls = model.prompt_tokens = model.completion_tokens = 0
+    firsts, totals = [], []
+    for _ in range(args.runs):
+        code, explanation, first, total = await debug_once(port, mode)
+        assert code.strip() == FIXED.strip(), f"{mode}: unexpected code {code!r}"
+        assert explanation.strip() == EXPLANATION.strip(), f"{mode}: unexpected explanation {explanation!r}"
+        firsts.append(first)
+        totals.append(total)
+    server.stop()
+
+    print(f"{mode:<10} calls/debug {model.calls / args.runs:4.1f}   "
+          f"prompt tokens/debug {model.prompt_tokens / args.runs:7.0f}   "
+          f"completion tokens/debug {model.completion_tokens / args.runs:5.0f}   "
+          f"first explanation token {statistics.median(firsts) * 1000:7.0f} ms   "
+          f"end-to-end {statistics.median(totals) * 1000:7.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--ttft", type=float, default=0.4, help="seconds before the first token of each call")
+    parser.add_argument("--token-ms", type=float, default=15, help="milliseconds between streamed tokens")
+    parser.add_argument("--prefill-ms", type=float, default=0, help="extra first token latency per 1000 prompt tokens")
+    args = parser.parse_args()
+
+    model = SimulatedModel(args.ttft, args.token_ms / 1000, args.prefill_ms / 1000)
+    openai.ChatCompletion.acreate = model.acreate
+
+    print(f"{args.runs} debug requests per mode, ttft {args.ttft * 1000:g} ms, {args.token_ms:g} ms/token")
+    for mode in ("two_pass", "single"):
+        asyncio.run(run(mode, args, model))
+
+
+if __name__ == "__main__":
+    main()
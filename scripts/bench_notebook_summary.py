@@ -0,0 +1,90 @@
+"""Benchmark read_notebook_summary_tool with the per cell summary cache.
+
+Summarizes a generated notebook of --cells cells three times: cold, again
+without changes, and after editing one cell. The model is simulated by
+replacing openai.ChatCompletion.acreate, it waits --ttft seconds and then
+--token-ms per completion token, so no API key is needed.
+
+    python scripts/bench_notebook_summary.py --cells 40
+"""
+import argparse
+import asyncio
+import importlib
+import os.path as osp
+import sys
+import tempfile
+import time
+
+import nbformat
+import openai
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path.insert(0, osp.join(osp.dirname(HERE), "jupyter-pilot-backend"))
+session = importlib.import_module("jupyter-pilot-backend.terminal.session")
+notebook = importlib.import_module("jupyter-pilot-backend.terminal.notebook")
+tokens = importlib.import_module("jupyter-pilot-backend.tokens")
+
+SUMMARY = "content: computes a value from the previous cells.\noutput: Runs successfully."
+
+
+class SimulatedModel(object):
+
+    def __init__(self, ttft, token_delay):
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.calls = 0
+        self.prompt_tokens = 0
+
+    async def acreate(self, *args, **kwargs):
+        self.calls += 1
+        self.prompt_tokens += tokens.count_tokens("\n".join(message["content"] for message in kwargs["messages"]))
+        reply = [SUMMARY[i:i + 4] for i in range(0, len(SUMMARY), 4)]
+
+        async def stream():
+            await asyncio.sleep(self.ttft)
+            for token in reply:
+                await asyncio.sleep(self.token_delay)
+                yield {"choices": [{"delta": {"content": token}, "finish_reason": None}]}
+            yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+        return stream()
+
+
+async def run(args, model):
+    root_dir = tempfile.mkdtemp(prefix="labpilot-summary-")
+    cells = [nbformat.v4.new_code_cell(f"x{i} = {i} * 2\nprint(x{i})", outputs=[
+        nbformat.v4.new_output("stream", text=f"{i * 2}\n")
+    ]) for i in range(args.cells)]
+    nbformat.write(nbformat.v4.new_notebook(cells=cells), osp.join(root_dir, "bench.ipynb"))
+
+    agent_session = session.AgentSession(None, notebook.NotebookStore(root_dir))
+    agent_session.create_agent("gpt-3.5-turbo", 0, "sk-bench")
+    agent_session.active_notebook = "bench.ipynb"
+
+    async def summarize(label):
+        calls, prompt_tokens = model.calls, model.prompt_tokens
+        start = time.monotonic()
+        summary = await agent_session.read_notebook_summary_tool(None)
+        assert summary.count("cell: ") == args.cells, summary
+        print(f"{label:<16} {(time.monotonic() - start) * 1000:7.0f} ms   "
+              f"model calls {model.calls - calls:4d}   prompt tokens {model.prompt_tokens - prompt_tokens:7d}")
+
+    await summarize("cold")
+    await summarize("unchanged")
+    await agent_session.edit_code_cell_tool("x0 = 42\nprint(x0)", 0, None)
+    await summarize("one cell edited")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cells", type=int, default=40)
+    parser.add_argument("--ttft", type=float, default=0.4)
+    parser.add_argument("--token-ms", type=float, default=15)
+    args = parser.parse_args()
+
+    model = SimulatedModel(args.ttft, args.token_ms / 1000)
+    openai.ChatCompletion.acreate = model.acreate
+    asyncio.run(run(args, model))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark import time and memory of the server extension.
+
+Each sample runs in a fresh interpreter and reports the wall time and peak
+RSS of importing the package, the same way jupyter does when it loads the
+extension. The "lazy" profile is the default startup, "eager" also imports
+what the first request and the terminal backend need, which is what every
+startup used to pay. "first request" is the extra time the lazy profile
+spends on the first refactor/debug/explain request.
+
+    python scripts/bench_startup.py --samples 5
+"""
+import argparse
+import json
+import os
+import os.path as osp
+import statistics
+import subprocess
+import sys
+
+HERE = osp.abspath(osp.dirname(__file__))
+BACKEND = osp.join(osp.dirname(HERE), "jupyter-pilot-backend")
+
+PROBE = r"""
+import importlib, json, resource, sys, time
+sys.path.insert(0, {backend!r})
+start = time.perf_counter()
+importlib.import_module("jupyter-pilot-backend")
+imported = time.perf_counter() - start
+extra = 0.0
+if {mode!r} in ("eager", "first_request"):
+    start = time.perf_counter()
+    importlib.import_module("jupyter-pilot-backend.chains")
+    importlib.import_module("jupyter-pilot-backend.callback")
+    if {mode!r} == "eager":
+        importlib.import_module("jupyter-pilot-backend.terminal.terminal")
+    extra = time.perf_counter() - start
+print(json.dumps({{
+    "import": imported,
+    "extra": extra,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+    "langchain": "langchain" in sys.modules,
+}}))
+"""
+
+
+def sample(mode):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(backend=BACKEND, mode=mode)],
+        check=True, capture_output=True, text=True, env=env
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=5)
+    args = parser.parse_args()
+
+    for mode in ("lazy", "eager", "first_request"):
+        runs = [sample(mode) for _ in range(args.samples)]
+        total = statistics.median(run["import"] + run["extra"] for run in runs)
+        if mode == "first_request":
+            print(f"{'first request':<14} chain import {statistics.median(run['extra'] for run in runs) * 1000:7.0f} ms "
+                  f"(off the IOLoop)")
+            continue
+        print(f"{mode:<14} startup {total * 1000:7.0f} ms   "
+              f"peak rss {statistics.median(run['rss_mb'] for run in runs):6.1f} MB   "
+              f"modules {runs[0]['modules']:5d}   langchain imported {runs[0]['langchain']}")
+
+
+if __name__ == "__main__":
+    main()
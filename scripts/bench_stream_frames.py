@@ -0,0 +1,126 @@
+"""Benchmark websocket frames and CPU per streamed completion.
+
+Streams simulated completions through FrameCoalescer over a real tornado
+websocket on localhost and compares one-frame-per-token (the old behaviour)
+with the coalesced and compact frame formats.
+
+    python scripts/bench_stream_frames.py --streams 20 --tokens 400 --rate 60
+
+CPU time is the process time of the benchmark, which includes the in-process
+clients decoding the frames, divided by the number of completions.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os.path as osp
+import sys
+import time
+
+import tornado.web
+import tornado.websocket
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path.insert(0, osp.join(osp.dirname(HERE), "jupyter-pilot-backend"))
+frames = importlib.import_module("jupyter-pilot-backend.frames")
+
+SAMPLE = """def fibonacci(n):
+    if n <= 0:
+        raise ValueError("n must be a positive integer")
+    elif n == 1 or n == 2:
+        return 1
+    else:
+        return fibonacci(n - 1) + fibonacci(n - 2)
+"""
+
+
+def make_tokens(count):
+    # Roughly the 3-4 characters per token the OpenAI tokenizer produces for code
+    text = SAMPLE * (count * 4 // len(SAMPLE) + 1)
+    return [text[i:i + 4] for i in range(0, count * 4, 4)]
+
+
+class StreamHandler(tornado.websocket.WebSocketHandler):
+
+    def initialize(self, config):
+        self.config = config
+
+    async def on_message(self, message):
+        config = self.config
+        coalescer = frames.FrameCoalescer(
+            self.write_message,
+            compact=config["compact"],
+            flush_interval=config["flush_interval"],
+            flush_bytes=config["flush_bytes"]
+        )
+        await coalescer.start()
+        for token in config["tokens"]:
+            await asyncio.sleep(config["delay"])
+            await coalescer.token(token)
+        await coalescer.done()
+
+
+async def client(port):
+    ws = await tornado.websocket.websocket_connect(f"ws://localhost:{port}/stream")
+    ws.write_message("{}")
+    count = 0
+    text = []
+    while True:
+        frame = json.loads(await ws.read_message())
+        count += 1
+        if isinstance(frame, list):
+            if frame[0] == frames.COMPACT_TOKEN:
+                text.append(frame[1])
+            elif frame[0] == frames.COMPACT_DONE:
+                break
+        elif frame.get("done"):
+            break
+        elif frame.get("message"):
+            text.append(frame["message"])
+    ws.close()
+    return count, "".join(text)
+
+
+async def run(name, config, streams):
+    app = tornado.web.Application([("/stream", StreamHandler, {"config": config})])
+    server = app.listen(0)
+    port = list(server._sockets.values())[0].getsockname()[1]
+
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    results = await asyncio.gather(*[client(port) for _ in range(streams)])
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    server.stop()
+
+    expected = "".join(config["tokens"])
+    assert all(text == expected for _, text in results), "stream content differs"
+    total_frames = sum(count for count, _ in results)
+    print(f"{name:<12} frames/completion {total_frames / streams:8.1f}   "
+          f"frames/sec {total_frames / wall:9.1f}   "
+          f"cpu ms/completion {cpu * 1000 / streams:7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=20, help="concurrent completions")
+    parser.add_argument("--tokens", type=int, default=400, help="tokens per completion")
+    parser.add_argument("--rate", type=float, default=60, help="tokens per second per completion")
+    parser.add_argument("--flush-ms", type=float, default=50)
+    parser.add_argument("--flush-bytes", type=int, default=512)
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.tokens)
+    base = {"tokens": tokens, "delay": 1 / args.rate}
+    runs = [
+        ("per-token", dict(base, compact=False, flush_interval=0, flush_bytes=0)),
+        ("coalesced", dict(base, compact=False, flush_interval=args.flush_ms / 1000, flush_bytes=args.flush_bytes)),
+        ("compact", dict(base, compact=True, flush_interval=args.flush_ms / 1000, flush_bytes=args.flush_bytes)),
+    ]
+    print(f"{args.streams} completions x {args.tokens} tokens at {args.rate:g} tokens/s")
+    for name, config in runs:
+        asyncio.run(run(name, config, args.streams))
+
+
+if __name__ == "__main__":
+    main()
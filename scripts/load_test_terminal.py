@@ -0,0 +1,157 @@
+"""Load test the terminal backend with many simultaneous agent sessions.
+
+Starts a Terminal in-process on free ports and connects --agents clients
+at once. Each client has a notebook of its own with a secret in its first
+cell and asks its agent to call --tool a few times. read_cell_tool is
+answered by the server from the notebook, run_code_cell_tool by the client
+with the secret as the cell's output. The agent's final answer has to
+contain the client's secret, so results that reach the wrong session are
+counted as leaks. The LLM is simulated by replacing
+openai.ChatCompletion.acreate, so no API key is needed.
+
+Answers to run_code_cell_tool go back on the primary connection with
+their request id, or with --transport secondary over a new connection to
+the secondary port per answer, the way older frontends do. Tool round trip
+is the time from sending a request to the frontend until its answer
+arrives.
+
+    python scripts/load_test_terminal.py --agents 50 --tool-calls 5
+    python scripts/load_test_terminal.py --agents 50 --tool-calls 5 --tool run_code_cell_tool --transport secondary
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os.path as osp
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+import nbformat
+import openai
+import websockets
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path.insert(0, osp.join(osp.dirname(HERE), "jupyter-pilot-backend"))
+terminal = importlib.import_module("jupyter-pilot-backend.terminal.terminal")
+scheduler = importlib.import_module("jupyter-pilot-backend.scheduler").scheduler
+metrics = importlib.import_module("jupyter-pilot-backend.metrics").metrics
+
+
+class FakeLLM(object):
+    """Calls tool tool_calls times, then answers with what the tool returned."""
+
+    def __init__(self, ttft, token_delay, tool_calls, tool):
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.tool_calls = tool_calls
+        self.tool = tool
+        self.calls = 0
+
+    async def acreate(self, *args, **kwargs):
+        self.calls += 1
+        results = [message["content"] for message in kwargs["messages"] if message["role"] == "function"]
+        if len(results) >= self.tool_calls:
+            deltas = [{"content": token} for token in ["FINAL "] + results]
+        else:
+            deltas = [{"function_call": {"name": self.tool, "arguments": json.dumps({"index": 0})}}]
+
+        async def stream():
+            await asyncio.sleep(self.ttft)
+            for delta in deltas:
+                await asyncio.sleep(self.token_delay)
+                yield {"choices": [{"delta": delta, "finish_reason": None}]}
+            yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+        return stream()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def agent_client(index, port, secondary_port, transport):
+    secret = f"secret-{index}"
+    start = time.monotonic()
+    async with websockets.connect(f"ws://localhost:{port}") as ws:
+        session_id = json.loads(await ws.recv())["session_id"]
+        await ws.send(json.dumps({
+            "message": "Read the first cell", "model": "gpt-3.5-turbo", "temp": 0,
+            "openai_api_key": f"sk-load-{index}", "frame_format": "compact",
+            "notebook_path": f"agent-{index}.ipynb"
+        }))
+        text = ""
+        while True:
+            frame = json.loads(await ws.recv())
+            if isinstance(frame, dict):
+                if frame.get("method") == "runCode":
+                    answer = {"message": {"output": secret, "error": ""}}
+                    if transport == "secondary":
+                        async with websockets.connect(f"ws://localhost:{secondary_port}/{session_id}/runCode") as secondary:
+                            await secondary.send(json.dumps(answer))
+                    else:
+                        await ws.send(json.dumps({"method": "answer", "request_id": frame["request_id"], "answer": answer}))
+                elif frame.get("method") in ("systemError", "rejected"):
+                    return time.monotonic() - start, False, frame["message"]
+                continue
+            if frame[0] == 0:
+                text += frame[1]
+            elif frame[0] == 2 and "FINAL" in text:
+                break
+    return time.monotonic() - start, secret in text, text
+
+
+async def run(args):
+    root_dir = tempfile.mkdtemp(prefix="labpilot-load-")
+    for i in range(args.agents):
+        nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(f"print('secret-{i}')")])
+        nbformat.write(nb, osp.join(root_dir, f"agent-{i}.ipynb"))
+
+    port, secondary_port = free_port(), free_port()
+    server = terminal.Terminal(port=port, secondary_port=secondary_port, root_dir=root_dir)
+    server_task = asyncio.ensure_future(server.start())
+    await asyncio.sleep(0.5)
+
+    start = time.monotonic()
+    results = await asyncio.gather(*[agent_client(i, port, secondary_port, args.transport) for i in range(args.agents)])
+    wall = time.monotonic() - start
+    server_task.cancel()
+
+    latencies = sorted(latency for latency, _, _ in results)
+    leaks = [text for _, ok, text in results if not ok]
+    timings = metrics.snapshot()["timings"]
+    stalls = timings.get("terminal.loop_stall_seconds", {})
+    rtt = timings.get("terminal.tool_rtt_seconds", {"count": 0, "mean": 0, "max": 0})
+    print(f"{args.agents} agents in {wall:.2f} s, {len(leaks)} failed or crossed sessions")
+    print(f"frontend round trip ({args.transport}) mean {rtt['mean'] * 1000:.1f} ms   "
+          f"max {rtt['max'] * 1000:.1f} ms   over {rtt['count']} calls")
+    print(f"latency p50 {statistics.median(latencies) * 1000:.0f} ms   "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms   "
+          f"max {latencies[-1] * 1000:.0f} ms")
+    print(f"max event loop stall {stalls.get('max', 0) * 1000:.1f} ms")
+    for text in leaks[:5]:
+        print("  failed:", text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before each simulated completion starts")
+    parser.add_argument("--token-ms", type=float, default=5)
+    parser.add_argument("--tool", choices=("read_cell_tool", "run_code_cell_tool"), default="read_cell_tool")
+    parser.add_argument("--tool-calls", type=int, default=1, help="tool calls per agent run")
+    parser.add_argument("--transport", choices=("primary", "secondary"), default="primary", help="where the client sends run_code_cell_tool answers")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="override the scheduler's concurrency cap")
+    args = parser.parse_args()
+
+    openai.ChatCompletion.acreate = FakeLLM(args.ttft, args.token_ms / 1000, args.tool_calls, args.tool).acreate
+    if args.max_concurrent:
+        scheduler.max_concurrent = args.max_concurrent
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()